@@ -7,17 +7,28 @@ lukasrier@outlook.com
 """
 import re
 import os
+import sys
+import queue
 import logging
+import threading
+import traceback
+from concurrent.futures import Future
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
+from tkinter import simpledialog
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from clean_data import check_valid_number
+from data_cache import SESSION_CACHE
+from cycle_store import CycleStore
+from preview import DecimatedLine
 import clean_data as cld
 import cycling_plots as cyc
 
+# interval at which the GUI checks the messages of the analysis worker (ms)
+WORKER_POLL_MS: int = 50
 
 
 class App(tk.Tk):
@@ -32,7 +43,7 @@ class App(tk.Tk):
         if os.path.isfile(iconfile):
             self.iconbitmap(iconfile)
         self.call('tk', 'scaling', 1.5)
-        self.geometry('1100x250')
+        self.geometry('1100x290')
         self.resizable(False, False)
 
 
@@ -96,6 +107,14 @@ class CyclingFrame(ttk.Frame):
                                                onvalue=True,
                                                offvalue=False)
 
+        # select whether to save the separate cycles to one Parquet file
+        self.cycles_single_file = tk.BooleanVar(value=False)
+        self.cycles_single_file_cb = ttk.Checkbutton(self,
+                                                     text="Save pairs to one\nParquet file.",
+                                                     variable=self.cycles_single_file,
+                                                     onvalue=True,
+                                                     offvalue=False)
+
         # select whether to use parquet file format
         self.do_parquet = tk.BooleanVar(value=False)
         self.do_parquet_cb = ttk.Checkbutton(self,
@@ -104,10 +123,50 @@ class CyclingFrame(ttk.Frame):
                                              onvalue=True,
                                              offvalue=False)
 
+        # select whether to save the cycles in the long (one row per sample) layout
+        self.long_layout = tk.BooleanVar(value=False)
+        self.long_layout_cb = ttk.Checkbutton(self,
+                                              text="Long (ragged) output",
+                                              variable=self.long_layout,
+                                              onvalue=True,
+                                              offvalue=False)
+
+        # select whether to calculate capacities as current x elapsed time (earlier versions)
+        self.legacy_capacity = tk.BooleanVar(value=False)
+        self.legacy_capacity_cb = ttk.Checkbutton(self,
+                                                  text="Legacy capacity (I x t)",
+                                                  variable=self.legacy_capacity,
+                                                  onvalue=True,
+                                                  offvalue=False)
+
+        # select whether to save heatmaps of all cycles resampled onto common grids
+        self.heatmaps = tk.BooleanVar(value=False)
+        self.heatmaps_cb = ttk.Checkbutton(self,
+                                           text="Cycle ageing heatmaps",
+                                           variable=self.heatmaps,
+                                           onvalue=True,
+                                           offvalue=False)
+
+        # engine, codec, compression level and row group size of the Parquet files
+        self.parquet_options_btn = ttk.Button(self, text="Parquet options...",
+                                              command=lambda: ParquetOptionsDialog(self))
+
+        # resolution and format of the saved plots
+        self.plot_options_btn = ttk.Button(self, text="Plot options...",
+                                           command=lambda: PlotOptionsDialog(self))
+
         # confirm and run clean data/plots
         self.run_plots_btn = ttk.Button(
             self, text="Run Cycling", command=self.run_plots_button_callback)
 
+        # progress of the analysis, which runs in a worker thread (see AnalysisWorker)
+        self.worker = None
+        self.progress_lbl = ttk.Label(self, text="")
+        self.progress_bar = ttk.Progressbar(self, orient=tk.HORIZONTAL, length=300,
+                                            mode='determinate', maximum=1)
+        self.cancel_btn = ttk.Button(self, text="Cancel", command=self.cancel_button_callback,
+                                     state=tk.DISABLED)
+
         # hysteresis plots
         self.do_hysteresis_btn = ttk.Button(self, text="Get Hysteresis Plot",
                                             command=self.run_hysteresis)
@@ -123,9 +182,18 @@ class CyclingFrame(ttk.Frame):
         self.save_indv_cycles_cb.grid(row=5, column=0, sticky=tk.W, **options)
         self.current_varies_cb.grid(row=6, column=0, sticky=tk.W, **options)
         self.charge_first_cb.grid(row=7, column=0, sticky=tk.W, **options)
+        self.cycles_single_file_cb.grid(row=8, column=0, sticky=tk.W, **options)
         self.do_parquet_cb.grid(row=6, column=4, sticky=tk.W, **options)
+        self.long_layout_cb.grid(row=7, column=4, sticky=tk.W, **options)
+        self.legacy_capacity_cb.grid(row=5, column=4, sticky=tk.W, **options)
+        self.heatmaps_cb.grid(row=9, column=4, sticky=tk.W, **options)
+        self.parquet_options_btn.grid(row=8, column=4, sticky=tk.W, **options)
+        self.plot_options_btn.grid(row=8, column=5, sticky=tk.E, **options)
         self.run_plots_btn.grid(row=6, column=5, sticky=tk.E, **options)
         self.do_hysteresis_btn.grid(row=7, column=5, sticky=tk.E, **options)
+        self.progress_lbl.grid(row=10, column=0, columnspan=2, sticky=tk.W, **options)
+        self.progress_bar.grid(row=10, column=2, columnspan=3, sticky=tk.W, **options)
+        self.cancel_btn.grid(row=10, column=5, sticky=tk.E, **options)
 
         # add padding to the frame and show it
         self.grid(padx=0, pady=0)
@@ -143,7 +211,8 @@ class CyclingFrame(ttk.Frame):
         """
 
         self.file = filedialog.askopenfilename(
-            filetypes=[('Text files', '*.txt')])
+            filetypes=[('Text files', '*.txt'), ('BioLogic raw files', '*.mpr'),
+                       ('Spreadsheets', '*.xlsx')])
         self.filen_entry.delete(0, len(self.tk_file_var.get()))
         self.filen_entry.insert(0, self.file)
 
@@ -153,7 +222,7 @@ class CyclingFrame(ttk.Frame):
 
         
         # configure log file name and formatting
-        log_fname = self.file[:-4] + '_LOG.log'
+        log_fname = os.path.splitext(self.file)[0] + '_LOG.log'
         logging.basicConfig(filename=log_fname, level=logging.WARNING,
                             filemode='w', format='%(asctime)s %(message)s')
         
@@ -167,8 +236,7 @@ class CyclingFrame(ttk.Frame):
         plt.ion()
 
         # plot current data to inspect and help with options
-        data = cld.data_from_file(self.file, active_mass_input=1)[1]
-        (_potential, _time, _current) = cld.parse_data(data)
+        (_potential, _time, _current) = cld.load_parsed(self.file)
 
         #check there is data
         if (_potential.size == 0) or (_time.size == 0) or (_current.size == 0):
@@ -186,18 +254,19 @@ class CyclingFrame(ttk.Frame):
                                 message="Non-numeric data found in the file.")
             raise Exception("Non-numeric data found in the file")
         
+        # both lines are decimated to the resolution of the window, again after zooming
         plt.figure(figsize=(9, 4))
         ax = plt.subplot(2,1,1)
-        ax.plot(_time, _current, 'k')
-        ax.plot(_time, 0.98 * np.max(_current) * np.ones((len(_current))), 'r')
-        ax.plot(_time, 0.98 * np.min(_current) * np.ones((len(_current))), 'b')
+        DecimatedLine(ax, _time, _current, 'k')
+        ax.axhline(0.98 * np.max(_current), color='r')
+        ax.axhline(0.98 * np.min(_current), color='b')
         plt.ylabel('Current / mA')
         # plt.xlabel('Experiment time / s')
         plt.legend(['Current','Charge threshold\n0.98 of max',
                     'Discharge threshold\n0.98 of min'],loc='center left', bbox_to_anchor=(1, 0.5))
 
-        ax2 = plt.subplot(2,1,2)
-        ax2.plot(_time, _potential, 'k')
+        ax2 = plt.subplot(2,1,2, sharex=ax)
+        DecimatedLine(ax2, _time, _potential, 'k')
         plt.ylabel('Potential / V')
         plt.xlabel('Experiment time / s')
         # plt.legend(['Potential','Charge threshold\n0.98 of max',
@@ -239,9 +308,13 @@ class CyclingFrame(ttk.Frame):
         the function creates data frames, calculates charge and discharge capacities, cycles and saves data, and
         creates plots of max capacity, coulombic efficiency, capacity vs. potential, and hysteresis.
 
+        The analysis runs in a worker thread, so that the window keeps responding and shows its progress.
+
         Returns:
         None
         """
+        if self.worker is not None:
+            return
         print(self.current_varies_checkbox_var.get())
         if self.current_varies_checkbox_var.get():
             logging.warning('Creating dataframe. Assuming applied current varies')
@@ -250,57 +323,87 @@ class CyclingFrame(ttk.Frame):
 
         if self.do_parquet.get():
             logging.warning('Using Parquet format instead of CSV!')
-        out_df, _, save_dir, pos_count, neg_count = cld.create_data_frame(self.file,
-                                                                          self.mass,
-                                                                          not(self.current_varies_checkbox_var.get()),
-                                                                          self.do_parquet.get())
-        
-        if self.separate_cycles_checkbox_var.get() is True:
-            logging.warning('Saving individual cycles...')
-            cld.create_cycles_separate(out_df, save_dir, self.do_parquet.get())
-
-        (coulombic_efficiency, max_charge_cap,
-         max_discharge_cap) = cyc.calculate_max_cap_and_coulombic_eff(out_df, pos_count, neg_count)
-
-        cycle_no = cyc.get_cycle_no(pos_count)
+        if self.long_layout.get():
+            logging.warning('Using the long (one row per sample) layout!')
+        if self.legacy_capacity.get():
+            logging.warning('Calculating capacities as current x elapsed time!')
+        run = lambda: cyc.run_cycling(self.file,
+                                      self.mass,
+                                      not(self.current_varies_checkbox_var.get()),
+                                      self.do_parquet.get(),
+                                      self.separate_cycles_checkbox_var.get(),
+                                      self.first_cyc_charge_checkbox_var.get(),
+                                      "long" if self.long_layout.get() else "wide",
+                                      capacity_method="legacy" if self.legacy_capacity.get() else "trapezoid",
+                                      cycles_single_file=self.cycles_single_file.get(),
+                                      heatmaps=self.heatmaps.get())
+
+        self.worker = AnalysisWorker(run)
+        cld.PROGRESS_CALLBACK = self.worker.progress
+        cld.GUI_CALLER = self.worker.call_in_gui
+        self.run_plots_btn.config(state=tk.DISABLED)
+        self.cancel_btn.config(state=tk.NORMAL)
+        self.progress_bar['value'] = 0
+        self.progress_lbl.config(text="Starting...")
+        self.worker.start()
+        self.after(WORKER_POLL_MS, self.poll_worker)
+
+    def poll_worker(self):
+        """
+        Handles the messages of the analysis worker: updates the progress bar, runs the figures
+        and dialogs the worker asks for and shows the plots once the analysis has finished.
 
-        # max cap and coulombic efficiency plot
-        logging.warning('Plotting maximum capacity and efficiency...')
-        cyc.plot_max_cap_and_efficiency(
-            cycle_no, max_charge_cap, max_discharge_cap, coulombic_efficiency, save_dir)
-        
-        logging.warning('Saving table of max capacities...')
-        cyc.save_max_cap_csv(save_dir, cycle_no, max_charge_cap,
-                             max_discharge_cap, coulombic_efficiency)
-        
-        logging.warning('Creating capacity vs potential plot...')
-        cyc.plot_caps_vs_potentials(out_df, pos_count, neg_count, save_dir)
-
-        # plot first cycle hysteresis
-        logging.warning('Creating hysteresis plot for cycle 1...')
-        match_c = '(C1)'
-        current_charge_cols = [col for col in out_df.columns if match_c in col]
-        match_d = '(D1)'
-        current_discharge_cols = [
-            col for col in out_df.columns if match_d in col]
-        usecols = current_charge_cols + current_discharge_cols
-        cycle_1 = out_df[usecols]
-        c_capacity, c_potential, d_capacity, d_potential = cyc.hysteresis_data_from_frame(
-            cycle_1, str(1))
-        charge_first = self.first_cyc_charge_checkbox_var.get()
-        if charge_first is True:
-            logging.warning('Assuming first cycle is charge')
-        else:
-            logging.warning('Assuming first cycle is discharge')
-        cyc.plot_hysteresis(c_capacity, c_potential, d_capacity,
-                            d_potential, str(1), save_dir, charge_first)
-        
+        Returns:
+        None
+        """
+        finished = False
+        while True:
+            try:
+                kind, content = self.worker.messages.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                stage, done, total = content
+                self.progress_lbl.config(text=stage if total <= 1 else f"{stage} ({done}/{total})")
+                self.progress_bar['value'] = done / total if total > 0 else 0
+            elif kind == 'call':
+                func, args, kwargs, future = content
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            else:
+                finished = True
+                self.progress_bar['value'] = 1 if kind == 'done' else 0
+                self.progress_lbl.config(text={'done': "Finished",
+                                               'cancelled': "Cancelled"}.get(kind, "Failed, see the log"))
+
+        if not finished:
+            self.after(WORKER_POLL_MS, self.poll_worker)
+            return
+        cld.PROGRESS_CALLBACK = None
+        cld.GUI_CALLER = None
+        self.worker = None
+        self.run_plots_btn.config(state=tk.NORMAL)
+        self.cancel_btn.config(state=tk.DISABLED)
         plt.draw_all()
         plt.show()
+
+    def cancel_button_callback(self):
+        """
+        Callback function for the 'Cancel' button. Asks the analysis to stop at its next step or cycle.
+
+        Returns:
+        None
+        """
+        if self.worker is not None:
+            self.worker.cancelled.set()
+            self.progress_lbl.config(text="Cancelling...")
                 
     def run_hysteresis(self):
         """Open a file dialog to select a specific cycle file, load the file into a pandas dataframe, and plot the hysteresis
-        curve of the cycle.
+        curve of the cycle. For an output holding all cycles, the cycle number is asked for and
+        only that cycle is loaded (see cycle_store.CycleStore).
 
         Raises:
         ValueError: If the selected file is not a valid cycle file generated using the GUI.
@@ -313,26 +416,46 @@ class CyclingFrame(ttk.Frame):
         else:
             filetype = ('CSV files', '*.csv')
         logging.warning('Choosing file for hysteresis plots')
-        cycle_file = filedialog.askopenfilename(filetypes=[filetype],
+        filetypes = [filetype]
+        if not self.do_parquet.get():
+            filetypes.append(('All cycles file', cld.CYCLES_DATASET))
+        cycle_file = filedialog.askopenfilename(filetypes=filetypes,
                                                 title='Open file for a specific cycle')
         cyc_filepath = os.path.abspath(cycle_file)
 
         pattern = re.compile(r'Cycle_\d+')
-        fname_match = re.findall(pattern, cycle_file)
+        fname_match = re.findall(pattern, os.path.basename(cycle_file))
 
         if len(fname_match) != 1:
-            msg = 'This is not a valid file.\n Generate separate cycling files using the GUI'
-            tk.messagebox.showerror(title='File error',
-                                    message=msg)
-            logging.error(msg)
-            raise ValueError(msg)
-
-        if self.do_parquet.get():
-            cycle_df = pd.read_parquet(cyc_filepath)
-            hyst_cycle_no = re.findall(r'Cycle_(\d+).parquet', cycle_file)[0]
+            # load only the chosen cycle from an output holding all cycles
+            try:
+                store = SESSION_CACHE.load(cyc_filepath, 'cycle_store', CycleStore)
+            except (ValueError, KeyError) as e:
+                msg = 'This is not a valid file.\n Generate cycling files using the GUI'
+                tk.messagebox.showerror(title='File error',
+                                        message=msg)
+                logging.error(f"{msg} ({e})")
+                raise ValueError(msg)
+            hyst_cycle_no = simpledialog.askinteger(title='Cycle number',
+                                                    prompt='Cycle number for the hysteresis plot:',
+                                                    minvalue=1)
+            if hyst_cycle_no is None:
+                return
+            if hyst_cycle_no not in store:
+                msg = f'Cycle {hyst_cycle_no} was not found in this file.'
+                tk.messagebox.showerror(title='File error',
+                                        message=msg)
+                logging.error(msg)
+                raise ValueError(msg)
+            cycle_df = store[hyst_cycle_no]
+            hyst_cycle_no = str(hyst_cycle_no)
         else:
-            cycle_df = pd.read_csv(cyc_filepath)
-            hyst_cycle_no = re.findall(r'Cycle_(\d+).csv', cycle_file)[0]
+            if self.do_parquet.get():
+                cycle_df = SESSION_CACHE.load(cyc_filepath, 'cycle', pd.read_parquet)
+                hyst_cycle_no = re.findall(r'Cycle_(\d+).parquet', cycle_file)[0]
+            else:
+                cycle_df = SESSION_CACHE.load(cyc_filepath, 'cycle', pd.read_csv)
+                hyst_cycle_no = re.findall(r'Cycle_(\d+).csv', cycle_file)[0]
         logging.warning(f'Generating hysteresis plot for cycle {hyst_cycle_no}.')
         cyc_save_dir = os.path.dirname(cyc_filepath)
         c_capacity, c_potential, d_capacity, d_potential = cyc.hysteresis_data_from_frame(
@@ -342,7 +465,167 @@ class CyclingFrame(ttk.Frame):
                             d_potential, hyst_cycle_no, cyc_save_dir, charge_first)
 
 
+class AnalysisWorker(threading.Thread):
+    """Runs an analysis in a worker thread, passing its progress and the figures and dialogs
+    it needs to the GUI through a queue."""
+
+    def __init__(self, target):
+        """Initialize the AnalysisWorker class.
+
+        Parameters:
+        target (callable): The analysis to run.
+        """
+        super().__init__(daemon=True)
+        self.target = target
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def run(self):
+        """Run the analysis and report how it ended ('done', 'cancelled' or 'failed')."""
+        try:
+            self.messages.put(('done', self.target()))
+        except cld.RunCancelled:
+            logging.warning('Run cancelled!')
+            self.messages.put(('cancelled', None))
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            self.messages.put(('failed', e))
+
+    def progress(self, stage, done=0, total=1):
+        """Pass the progress of the analysis to the GUI (see clean_data.report_progress), or stop it if
+        it has been cancelled."""
+        if self.cancelled.is_set():
+            raise cld.RunCancelled(stage)
+        self.messages.put(('progress', (stage, done, total)))
+
+    def call_in_gui(self, func, *args, **kwargs):
+        """Run a function that shows figures or dialogs on the thread of the GUI and wait for its result
+        (see clean_data.call_in_gui)."""
+        future = Future()
+        self.messages.put(('call', (func, args, kwargs, future)))
+        return future.result()
+
+
+class ParquetOptionsDialog(tk.Toplevel):
+    """Dialog to choose the engine, codec, compression level and row group size of Parquet files."""
+
+    def __init__(self, container):
+        """Initialize the dialog with the current settings (see clean_data.set_parquet_options).
+
+        Args:
+            container (object): Parent widget of the dialog.
+        """
+        super().__init__(container)
+        self.title('Parquet options')
+        self.resizable(False, False)
+        self.transient(container)
+
+        options = {'padx': 5,
+                   'pady': 5}
+
+        self.engine = tk.StringVar(self, value=cld.PARQUET_ENGINE)
+        self.codec = tk.StringVar(self, value=cld.PARQUET_COMPRESSION)
+        self.level = tk.StringVar(self, value='' if cld.PARQUET_COMPRESSION_LEVEL is None
+                                  else str(cld.PARQUET_COMPRESSION_LEVEL))
+        self.row_group_size = tk.StringVar(self, value='' if cld.PARQUET_ROW_GROUP_SIZE is None
+                                           else str(cld.PARQUET_ROW_GROUP_SIZE))
+
+        fields = (("Engine", ttk.Combobox(self, textvariable=self.engine, state='readonly',
+                                          values=cld.PARQUET_ENGINES)),
+                  ("Codec", ttk.Combobox(self, textvariable=self.codec, state='readonly',
+                                         values=cld.PARQUET_CODECS)),
+                  ("Compression level\n(zstd/gzip, blank: default)",
+                   ttk.Entry(self, textvariable=self.level, width=10)),
+                  ("Rows per row group\n(blank: default)",
+                   ttk.Entry(self, textvariable=self.row_group_size, width=10)))
+        for row, (text, widget) in enumerate(fields):
+            ttk.Label(self, text=text).grid(row=row, column=0, sticky=tk.W, **options)
+            widget.grid(row=row, column=1, sticky=tk.W, **options)
+
+        ttk.Button(self, text="Apply", command=self.apply).grid(
+            row=len(fields), column=0, sticky=tk.W, **options)
+        ttk.Button(self, text="Save as default", command=self.save).grid(
+            row=len(fields), column=1, sticky=tk.E, **options)
+
+    def apply(self):
+        """
+        Applies the chosen settings and closes the dialog.
+
+        Returns:
+        bool: Whether the settings were valid.
+        """
+        level, rows = self.level.get().strip(), self.row_group_size.get().strip()
+        if ((level and not level.lstrip('-').isdigit()) or (rows and not rows.isdigit())):
+            tk.messagebox.showerror(title=None, message="Enter whole numbers or leave blank!",
+                                    parent=self)
+            return False
+        try:
+            cld.set_parquet_options(self.engine.get(), self.codec.get(),
+                                    int(level) if level else None, int(rows) if rows else None)
+        except ValueError as e:
+            tk.messagebox.showerror(title=None, message=str(e), parent=self)
+            return False
+        logging.warning(f"Parquet options: {cld.parquet_kwargs()}")
+        self.destroy()
+        return True
+
+    def save(self):
+        """Applies the chosen settings and saves them to the config file (see clean_data.load_config)."""
+        if self.apply():
+            try:
+                cld.save_config()
+            except OSError as e:
+                tk.messagebox.showerror(title=None,
+                                        message=f"Could not save {cld.CONFIG_FILE}:\n{e}")
+
+
+class PlotOptionsDialog(tk.Toplevel):
+    """Dialog to choose the resolution and file format of the saved plots."""
+
+    def __init__(self, container):
+        """Initialize the dialog with the current settings (see cycling_plots.PLOT_DPI and PLOT_FORMAT).
+
+        Args:
+            container (object): Parent widget of the dialog.
+        """
+        super().__init__(container)
+        self.title('Plot options')
+        self.resizable(False, False)
+        self.transient(container)
+
+        options = {'padx': 5,
+                   'pady': 5}
+
+        self.dpi = tk.StringVar(self, value=str(cyc.PLOT_DPI))
+        self.fmt = tk.StringVar(self, value=cyc.PLOT_FORMAT)
+
+        ttk.Label(self, text="Resolution (dpi)").grid(row=0, column=0, sticky=tk.W, **options)
+        ttk.Combobox(self, textvariable=self.dpi, values=(150, 300, 600), width=8).grid(
+            row=0, column=1, sticky=tk.W, **options)
+        ttk.Label(self, text="Format").grid(row=1, column=0, sticky=tk.W, **options)
+        ttk.Combobox(self, textvariable=self.fmt, state='readonly', values=cyc.PLOT_FORMATS,
+                     width=8).grid(row=1, column=1, sticky=tk.W, **options)
+        ttk.Button(self, text="Apply", command=self.apply).grid(
+            row=2, column=1, sticky=tk.E, **options)
+
+    def apply(self):
+        """Applies the chosen settings and closes the dialog."""
+        if not self.dpi.get().strip().isdigit() or int(self.dpi.get()) < 1:
+            tk.messagebox.showerror(title=None, message="Enter a whole number of dpi!",
+                                    parent=self)
+            return
+        cyc.PLOT_DPI = int(self.dpi.get())
+        cyc.PLOT_FORMAT = self.fmt.get()
+        logging.warning(f"Saving plots as {cyc.PLOT_FORMAT} at {cyc.PLOT_DPI} dpi.")
+        self.destroy()
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        import cli
+        sys.exit(cli.main(sys.argv[1:]))
+    # settings of the config file next to the program
+    cld.load_config()
     app = App()
     CyclingFrame(app)
     app.mainloop()
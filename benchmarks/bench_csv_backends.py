@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Read time of the data files with each CSV backend of clean_data (pandas and pyarrow).
+
+For each size a synthetic export is written (see synthetic_cell) and read with
+read_data_file and parse_data by every installed backend. The parsed potential, time and
+current of each backend are checked against those of pandas: the same headings, dtypes and
+lengths, and the same values to a relative tolerance of 1e-15. pyarrow rounds every value
+correctly, while the default float parser of pandas can be a few units in the last place
+off, far below the precision of the exported values.
+
+Usage:
+    python benchmarks/bench_csv_backends.py [n_rows ...] [--extra-columns n] [--comma]
+        [--repeat n] [--files file ...]
+
+The sizes accept suffixes, e.g. 100k 10M. Existing data files can be given with --files.
+"""
+import os
+import sys
+import argparse
+import tempfile
+import time as timer
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clean_data as cld
+from synthetic_cell import make_export, parse_size
+
+DEFAULT_SIZES = ('100k', '1M')
+
+
+def backends():
+    """Returns the usable CSV backends."""
+    found = ['pandas']
+    try:
+        import pyarrow
+        found.append('pyarrow')
+    except ImportError:
+        pass
+    return found
+
+
+def read_parsed(file, backend):
+    """Returns the parsed potential, time and current of a file read with a backend."""
+    cld.set_csv_backend(backend)
+    return cld.parse_data(cld.read_data_file(file))
+
+
+def check_same(reference, parsed):
+    """Raises an AssertionError unless two parsed triples match column for column."""
+    for expected, actual in zip(reference, parsed):
+        assert expected.name == actual.name, (expected.name, actual.name)
+        assert expected.dtype == actual.dtype, (expected.dtype, actual.dtype)
+        assert len(expected) == len(actual), (len(expected), len(actual))
+        np.testing.assert_allclose(actual.to_numpy(), expected.to_numpy(), rtol=1e-15, atol=0)
+
+
+def time_backends(file, repeat):
+    """Returns the best read time of a file with each backend."""
+    reference, rows = None, []
+    for backend in backends():
+        best = np.inf
+        for _ in range(repeat):
+            t0 = timer.perf_counter()
+            parsed = read_parsed(file, backend)
+            best = min(best, timer.perf_counter() - t0)
+        if reference is None:
+            reference = parsed
+        else:
+            check_same(reference, parsed)
+        rows.append((backend, len(parsed[0]), best))
+    return rows
+
+
+def run(sizes, files, extra_columns, delimiter, repeat):
+    """Returns a table of the read time of each file with each backend."""
+    rows = []
+    for file in files:
+        for backend, n_rows, seconds in time_backends(file, repeat):
+            rows.append((os.path.basename(file), backend, n_rows, seconds))
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes:
+            file = os.path.join(folder, f"synthetic_{size}.txt")
+            make_export(file, size, extra_columns=extra_columns, delimiter=delimiter)
+            for backend, n_rows, seconds in time_backends(file, repeat):
+                rows.append((os.path.basename(file), backend, n_rows, seconds))
+            os.remove(file)
+    table = pd.DataFrame(rows, columns=['file', 'backend', 'rows', 'read / s'])
+    table['rows / s'] = table['rows'] / table['read / s']
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('sizes', nargs='*', default=DEFAULT_SIZES,
+                        help=f"rows of the synthetic exports (default: {' '.join(DEFAULT_SIZES)})")
+    parser.add_argument('--files', nargs='+', default=[], help='also read these data files')
+    parser.add_argument('--extra-columns', type=int, default=30,
+                        help='columns that are not analysed in the synthetic exports (default: 30)')
+    parser.add_argument('--comma', action='store_true', help='comma instead of tab separated exports')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per measurement')
+    args = parser.parse_args()
+
+    cld.SHOW_DIALOGS = False
+    print(f"{os.cpu_count()} CPUs, backends: {', '.join(backends())}")
+    table = run([parse_size(size) for size in args.sizes], args.files, args.extra_columns,
+                ',' if args.comma else '\t', args.repeat)
+    pd.set_option('display.width', 120)
+    print(table.to_string(index=False, float_format='%.4f'))
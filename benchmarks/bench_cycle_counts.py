@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Speed comparison of the vectorised cycle segmentation in clean_data against
+the original per-sample loop of get_cycle_counts.
+
+Usage:
+    python benchmarks/bench_cycle_counts.py [n_samples ...]
+"""
+import os
+import sys
+import time as timer
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clean_data as cld
+
+
+def loop_cycle_counts(time, is_pos, is_neg):
+    """
+    Reference implementation: the per-sample loop get_cycle_counts used before
+    the segmentation engine (without the logging and dialogs).
+    """
+    pos_edge, neg_edge = cld.find_edges(is_pos), cld.find_edges(is_neg)
+
+    pos_cycle_no = np.zeros(time.shape)*np.nan
+    pos_count = 0
+    neg_cycle_no = np.zeros(time.shape)*np.nan
+    neg_count = 0
+
+    for i, _ in enumerate(time):
+        if is_pos[i]:
+            if pos_edge[i] == 1:
+                pos_count += 1
+                pos_cycle_no[i-2] = pos_count
+            pos_cycle_no[i] = pos_count
+
+        if is_neg[i]:
+            if neg_edge[i] == 1:
+                neg_count += 1
+                neg_cycle_no[i-2] = neg_count
+            neg_cycle_no[i] = neg_count
+
+    if pos_count > neg_count:
+        pos_cycle_no[pos_cycle_no > neg_count] = np.nan
+        pos_count = neg_count
+    elif pos_count < neg_count:
+        neg_cycle_no[neg_cycle_no > pos_count] = np.nan
+        neg_count = pos_count
+
+    return pos_count, neg_count, pos_cycle_no, neg_cycle_no
+
+
+def square_wave_current(n_samples, points_per_cycle=500, seed=0):
+    """
+    Constant-current charge/rest/discharge/rest pattern with some jitter in
+    the length of each step.
+    """
+    rng = np.random.default_rng(seed)
+    current = np.empty(n_samples)
+    pos = 0
+    while pos < n_samples:
+        for level in (1.0, 0.0, -1.0, 0.0):
+            step = max(1, int(rng.normal(points_per_cycle / 4, points_per_cycle / 40)))
+            if level == 0.0:
+                step = int(rng.integers(1, 4))
+            current[pos:pos+step] = level
+            pos += step
+    return current[:n_samples]
+
+
+def check_equal(reference, result):
+    """Raise AssertionError if the two get_cycle_counts results differ."""
+    assert reference[0] == result[0] and reference[1] == result[1]
+    np.testing.assert_array_equal(reference[2], result[2])
+    np.testing.assert_array_equal(reference[3], result[3])
+
+
+def run(n_samples):
+    current = square_wave_current(n_samples)
+    time = np.arange(n_samples, dtype=float)
+    is_pos, is_neg = current > 0.98, current < -0.98
+
+    t0 = timer.perf_counter()
+    reference = loop_cycle_counts(time, is_pos, is_neg)
+    t_loop = timer.perf_counter() - t0
+
+    t0 = timer.perf_counter()
+    result = cld.get_cycle_counts(time, is_pos, is_neg)
+    t_vec = timer.perf_counter() - t0
+
+    check_equal(reference, result)
+    return t_loop, t_vec
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    rows = []
+    for n in sizes:
+        t_loop, t_vec = run(n)
+        rows.append((n, t_loop, t_vec))
+    print(f"{'samples':>12} {'loop / s':>10} {'segments / s':>13} {'speed-up':>9}")
+    for n, t_loop, t_vec in rows:
+        print(f"{n:>12d} {t_loop:>10.3f} {t_vec:>13.4f} {t_loop / t_vec:>8.0f}x")
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Write time, read time and size of the cycling outputs for each Parquet engine and codec.
+
+Both output layouts (wide and long) of each data file are written with every combination
+of engine and codec and read back with the same engine. Data files that cannot be analysed
+are skipped; without any usable files a synthetic cell is used.
+
+Usage:
+    python benchmarks/bench_parquet.py [data file ...] [--mass mg] [--repeat n]
+"""
+import os
+import sys
+import glob
+import argparse
+import tempfile
+import time as timer
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clean_data as cld
+from bench_cycle_counts import square_wave_current
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+
+def engines():
+    """Returns the installed Parquet engines."""
+    found = []
+    for engine in cld.PARQUET_ENGINES:
+        try:
+            __import__(engine)
+            found.append(engine)
+        except ImportError:
+            pass
+    return found
+
+
+def synthetic_columns(n_samples=500_000):
+    """Time, potential and current (mA) of a synthetic constant-current cell."""
+    current = square_wave_current(n_samples, points_per_cycle=5000)
+    time = np.arange(n_samples, dtype=float)
+    potential = 3.5 + 0.5*np.tanh(np.cumsum(current) / 2500)
+    return time, potential, current
+
+
+def output_frames(time, potential, current, active_mass):
+    """Returns the wide and long output frames of one data set."""
+    time, potential, current = (pd.Series(np.asarray(col, dtype=float))
+                                for col in (time, potential, current))
+    is_pos, is_neg = cld.current_thresholds(current, 0.98, True)
+    _, _, segments = cld.get_cycle_segments(is_pos, is_neg)
+    wide = cld.cycles_to_frame(time, potential, current, segments, active_mass)
+    long, _ = cld.cycles_to_long_frame(time, potential, current, segments, active_mass)
+    return {'wide': wide, 'long': long}
+
+
+def data_sets(files, active_mass):
+    """Yields the name and output frames of each usable data file."""
+    cld.SHOW_DIALOGS = False
+    cld.USE_SIDECAR = False
+    for file in files:
+        try:
+            potential, time, current = cld.load_parsed(file)
+            frames = output_frames(time, potential, current, active_mass)
+        except Exception as e:
+            print(f"skipping {os.path.basename(file)}: {type(e).__name__}: {e}")
+            continue
+        if len(frames['long']):
+            yield os.path.basename(file), frames
+        else:
+            print(f"skipping {os.path.basename(file)}: no complete cycles")
+
+
+def time_parquet(frame, index, engine, codec, folder, repeat):
+    """Returns the best write time, best read time and size of one frame with one codec."""
+    cld.set_parquet_options(engine, codec)
+    path = os.path.join(folder, f"{engine}_{codec}.parquet")
+    t_write, t_read = np.inf, np.inf
+    for _ in range(repeat):
+        t0 = timer.perf_counter()
+        frame.to_parquet(path, index=index, **cld.parquet_kwargs())
+        t_write = min(t_write, timer.perf_counter() - t0)
+        t0 = timer.perf_counter()
+        pd.read_parquet(path, engine=engine)
+        t_read = min(t_read, timer.perf_counter() - t0)
+    return t_write, t_read, os.path.getsize(path)
+
+
+def run(sets, repeat):
+    """Returns a table of the timings of all data sets, layouts, engines and codecs."""
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name, frames in sets:
+            for layout, frame in frames.items():
+                for engine in engines():
+                    for codec in cld.PARQUET_CODECS:
+                        try:
+                            result = time_parquet(frame, layout == 'wide', engine, codec,
+                                                  folder, repeat)
+                        except Exception as e:
+                            print(f"{engine}/{codec} failed: {type(e).__name__}: {e}")
+                            continue
+                        rows.append((name, layout, engine, codec, *result))
+    return pd.DataFrame(rows, columns=['file', 'layout', 'engine', 'codec',
+                                       'write / s', 'read / s', 'size / MB']).assign(
+        **{'size / MB': lambda df: df['size / MB'] / 2**20})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('files', nargs='*', help='data files (default: the example data sets)')
+    parser.add_argument('--mass', type=float, default=1.0, help='active mass (mg)')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per measurement')
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob(os.path.join(EXAMPLES, '*.txt')))
+    sets = list(data_sets(files, args.mass / 1000))
+    if not sets:
+        print("No usable data files, using a synthetic cell.")
+        sets = [('synthetic', output_frames(*synthetic_columns(), args.mass / 1000))]
+
+    table = run(sets, args.repeat)
+    pd.set_option('display.width', 120)
+    print(table.to_string(index=False, float_format='%.4f'))
+    print("\nTotals over all files and layouts:")
+    print(table.groupby(['engine', 'codec'])[['write / s', 'read / s', 'size / MB']].sum()
+          .sort_values('write / s').to_string(float_format='%.4f'))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Options of the pytest-benchmark suites: the synthetic exports they run on, the number of
+rounds of each stage and whether the slow, large sizes are run.
+"""
+import os
+import sys
+import matplotlib
+matplotlib.use('Agg')
+import pytest
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+sys.path.insert(0, BENCHMARKS)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('galvanalyze benchmarks')
+    group.addoption('--run-slow', action='store_true',
+                    help='also run the large sizes (several GB of memory)')
+    group.addoption('--points-per-cycle', type=int, default=1000,
+                    help='samples per cycle of the synthetic exports (default: 1000)')
+    group.addoption('--current', choices=['constant', 'stepped'], default='constant',
+                    help='constant current, or stepped rates analysed as a variable current')
+    group.addoption('--layout', choices=['wide', 'long'], default='long',
+                    help='output layout (default: long)')
+    group.addoption('--rounds', type=int, default=3, help='rounds of each stage (default: 3)')
+    group.addoption('--dpi', type=int, default=100,
+                    help='resolution of the plots (default: 100)')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: large sizes, only run with --run-slow')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-slow'):
+        return
+    skip_slow = pytest.mark.skip(reason='large size, use --run-slow to run it')
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip_slow)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic cycler exports of any size, for benchmarks and for trying out large files.
+
+The test starts with a rest period at zero current. Each cycle is then a charge and a
+discharge of the same number of samples, each followed by a rest period. The potential
+follows an open circuit voltage curve of the state of charge plus an IR drop and Gaussian
+noise, and the capacity fades slightly from cycle to cycle. The current is either constant, or stepped between rates every few cycles
+as in a rate test (which needs the "Applied current varies" option).
+
+The files are tab separated with one of the supported sets of headings (see HEADINGS), or
+BioLogic .mpr files (see write_mpr).
+
+Usage:
+    python benchmarks/synthetic_cell.py out.txt [--cycles n] [--points-per-cycle n]
+        [--current constant|stepped] [--rest n] [--noise V] [--headings name]
+        [--extra-columns n] [--comma]
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clean_data as cld
+import biologic
+
+# supported headings of the time, potential and current columns (see clean_data)
+HEADINGS = {'ecell': ('time/s', 'Ecell/V', '<I>/mA'),
+            'ewe': ('time/s', 'Ewe/V', 'I/mA'),
+            'spaced': ('time /s', 'E /V', 'I /mA'),
+            'amps': ('time/s', 'Voltage(V)', 'Current(A)')}
+# current of each step of a stepped test, relative to the current setting
+RATE_STEPS = (0.1, 0.2, 0.5, 1.0, 2.0)
+# rows written at once
+WRITE_BLOCK_ROWS: int = 1_000_000
+# column type IDs of the .mpr files: flags (mode, error and control changes), time/s,
+# control/V/mA, Ewe/V, I/mA, dq/mA.h and cycle number, as in galvanostatic EC-Lab files
+MPR_COLUMN_IDS = (1, 3, 21, 4, 5, 6, 8, 7, 24)
+# suffixes of the sizes given on the command line
+SIZE_SUFFIXES = {'k': 1_000, 'M': 1_000_000}
+
+
+def parse_size(text):
+    """Returns the number of rows of a size such as 5000, 10k or 50M."""
+    scale = SIZE_SUFFIXES.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+def open_circuit_voltage(soc):
+    """Open circuit voltage (V) of the synthetic cell at a state of charge between 0 and 1."""
+    return 3.25 + 0.45*soc + 0.08*np.tanh(12*(soc - 0.5))
+
+
+def synthetic_cycles(n_cycles=100, points_per_cycle=1000, current='constant', current_ma=1.0,
+                     rest_points=20, noise=0.002, capacity_mah=1.0, capacity_fade=1e-4,
+                     resistance_ohm=20.0, rest_interval_s=10.0, cycles_per_step=5, seed=0):
+    """
+    Generates the time, potential and current of a cycling test.
+
+    Parameters:
+    n_cycles (int): Number of charge-discharge cycles.
+    points_per_cycle (int): Samples per cycle, including both rest periods.
+    current (str): 'constant', or 'stepped' to change the rate every cycles_per_step cycles
+        (see RATE_STEPS).
+    current_ma (float): The applied current (mA).
+    rest_points (int): Samples of the first rest period and of the rest after each charge
+        and discharge.
+    noise (float): Standard deviation of the noise of the potential (V).
+    capacity_mah (float): Capacity of the first cycle (mAh).
+    capacity_fade (float): Relative loss of capacity per cycle.
+    resistance_ohm (float): Internal resistance of the cell (Ohm).
+    rest_interval_s (float): Time between the samples of a rest period (s).
+    cycles_per_step (int): Cycles at each rate of a stepped test.
+    seed (int): Seed of the noise.
+
+    Returns:
+    tuple: the time (s), potential (V) and current (mA) of each sample, as ndarrays.
+    """
+    if current not in ('constant', 'stepped'):
+        raise ValueError(f"current must be 'constant' or 'stepped', not {current!r}")
+    half = (points_per_cycle - 2*rest_points) // 2
+    if half < 2:
+        raise ValueError("points_per_cycle must leave at least two samples per charge and discharge.")
+    rng = np.random.default_rng(seed)
+
+    # an initial rest, then four steps per cycle: charge, rest, discharge, rest
+    cycle = np.arange(n_cycles)
+    rate = (np.asarray(RATE_STEPS)[(cycle // cycles_per_step) % len(RATE_STEPS)]
+            if current == 'stepped' else np.ones(n_cycles)) * current_ma
+    capacity = capacity_mah * (1 - capacity_fade)**cycle
+    levels = np.concatenate(([0.0], np.column_stack((rate, 0*rate, -rate, 0*rate)).ravel()))
+    lengths = np.concatenate(([rest_points], np.tile([half, rest_points, half, rest_points],
+                                                     n_cycles)))
+    # samples are spread evenly over the time the capacity takes at the applied rate
+    rest_dt = np.full(n_cycles, rest_interval_s)
+    step_dt = np.concatenate(([rest_interval_s],
+                              np.column_stack((capacity * 3600 / rate / half, rest_dt,
+                                               capacity * 3600 / rate / half, rest_dt)).ravel()))
+    # state of charge at the start of each step, and its change per sample
+    soc_start = np.concatenate(([0.0], np.tile([0.0, 1.0, 1.0, 0.0], n_cycles)))
+    soc_step = np.concatenate(([0.0], np.tile([1.0 / half, 0.0, -1.0 / half, 0.0], n_cycles)))
+
+    step = np.repeat(np.arange(len(lengths)), lengths)
+    position = np.arange(len(step)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    current_col = levels[step]
+    time_col = np.cumsum(step_dt[step]) - step_dt[step[0]]
+    soc = soc_start[step] + soc_step[step] * (position + 1)
+    potential_col = open_circuit_voltage(soc) + current_col / 1000 * resistance_ohm
+    if noise > 0:
+        potential_col += rng.normal(0, noise, len(step))
+    return time_col, potential_col, current_col
+
+
+def write_export(path, time, potential, current, headings='ecell', extra_columns=0, delimiter='\t',
+                 block_rows=WRITE_BLOCK_ROWS):
+    """
+    Writes the columns of a test as a cycler export.
+
+    Parameters:
+    path (str): Path of the file.
+    time, potential, current (array-like): The time (s), potential (V) and current (mA).
+    headings (str): The name of the set of headings (see HEADINGS).
+    extra_columns (int): The number of further columns that are not analysed, as in vendor
+        exports with 20-40 columns.
+    delimiter (str): The column delimiter.
+    block_rows (int): The number of rows written at once.
+
+    Returns:
+    str: The path of the file.
+    """
+    time_head, potential_head, current_head = HEADINGS[headings]
+    scale = dict(cld.CURRENT_HEADINGS)[current_head]
+    current = np.asarray(current) / scale
+    extra_heads = [f"extra {k}/a.u." for k in range(extra_columns)]
+    with open(path, 'w', newline='') as fh:
+        fh.write(delimiter.join([time_head, potential_head, current_head] + extra_heads) + '\n')
+        for start in range(0, len(time), block_rows):
+            stop = start + block_rows
+            block = pd.DataFrame({time_head: time[start:stop], potential_head: potential[start:stop],
+                                  current_head: current[start:stop]})
+            for k, head in enumerate(extra_heads):
+                block[head] = block[potential_head] * (k + 1)
+            block.to_csv(fh, sep=delimiter, header=False, index=False, float_format='%.9g')
+    return path
+
+
+def write_mpr(path, time, potential, current, column_ids=MPR_COLUMN_IDS, version=2):
+    """
+    Writes the columns of a test as a BioLogic .mpr file with a settings module and a data
+    module (see biologic). Columns other than time, potential and current are zero.
+
+    Parameters:
+    path (str): Path of the file.
+    time, potential, current (array-like): The time (s), potential (V) and current (mA).
+    column_ids (tuple): The column type IDs of the data module.
+    version (int): The version of the data module (see biologic.DATA_OFFSETS).
+
+    Returns:
+    str: The path of the file.
+    """
+    dtype = biologic.record_dtype(column_ids)
+    records = np.zeros(len(time), dtype=dtype)
+    records['time/s'], records['Ewe/V'], records['I/mA'] = time, potential, current
+
+    header = np.zeros(biologic.DATA_OFFSETS[version], dtype=np.uint8)
+    header[:4] = np.frombuffer(np.uint32(len(records)).tobytes(), dtype=np.uint8)
+    header[4] = len(column_ids)
+    header[5:5 + 2*len(column_ids)] = np.frombuffer(
+        np.asarray(column_ids, dtype='<u2').tobytes(), dtype=np.uint8)
+
+    def module(shortname, longname, version, length):
+        fields = np.zeros(1, dtype=biologic.MODULE_HEADER)
+        fields[0] = (shortname, longname, length, version, b'10/18/26')
+        return biologic.MODULE_MAGIC + fields.tobytes()
+
+    settings = b'Galvanostatic Cycling with Potential Limitation'.ljust(1024, b'\x00')
+    with open(path, 'wb') as fh:
+        fh.write(biologic.MPR_MAGIC)
+        fh.write(module(b'VMP Set   ', b'VMP settings', 0, len(settings)))
+        fh.write(settings)
+        fh.write(module(biologic.DATA_MODULE, b'VMP data', version,
+                        header.nbytes + records.nbytes))
+        fh.write(header.tobytes())
+        for start in range(0, len(records), WRITE_BLOCK_ROWS):
+            fh.write(records[start:start + WRITE_BLOCK_ROWS].tobytes())
+    return path
+
+
+def make_export(path, n_rows, points_per_cycle=1000, headings='ecell', extra_columns=0,
+                delimiter='\t', **kwargs):
+    """
+    Writes a synthetic export of about n_rows samples (whole cycles, at least one), as an
+    .mpr file if the path ends with .mpr.
+
+    Parameters:
+    path (str): Path of the file.
+    n_rows (int): The approximate number of samples.
+    points_per_cycle (int): Samples per cycle.
+    headings (str): The name of the set of headings (see HEADINGS).
+    extra_columns (int): The number of further columns (see write_export).
+    delimiter (str): The column delimiter.
+    **kwargs: Further settings of synthetic_cycles.
+
+    Returns:
+    str: The path of the file.
+    """
+    n_cycles = max(1, round(n_rows / points_per_cycle))
+    columns = synthetic_cycles(n_cycles, points_per_cycle, **kwargs)
+    if biologic.is_mpr_file(path):
+        return write_mpr(path, *columns)
+    return write_export(path, *columns, headings=headings, extra_columns=extra_columns,
+                        delimiter=delimiter)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('path', help='output file (*.txt, or *.mpr for a BioLogic raw file)')
+    parser.add_argument('--cycles', type=int, default=100, help='number of cycles (default: 100)')
+    parser.add_argument('--points-per-cycle', type=int, default=1000,
+                        help='samples per cycle, including the rests (default: 1000)')
+    parser.add_argument('--current', choices=['constant', 'stepped'], default='constant',
+                        help='constant current, or rates stepped every few cycles (default: constant)')
+    parser.add_argument('--current-ma', type=float, default=1.0, help='applied current (mA)')
+    parser.add_argument('--rest', type=int, default=20,
+                        help='samples of each rest period (default: 20)')
+    parser.add_argument('--noise', type=float, default=0.002,
+                        help='noise of the potential (V, default: 0.002)')
+    parser.add_argument('--headings', choices=sorted(HEADINGS), default='ecell',
+                        help='column headings (default: ecell)')
+    parser.add_argument('--extra-columns', type=int, default=0,
+                        help='further columns that are not analysed (default: 0)')
+    parser.add_argument('--comma', action='store_true', help='comma instead of tab separated')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the noise')
+    args = parser.parse_args()
+
+    columns = synthetic_cycles(args.cycles, args.points_per_cycle, args.current, args.current_ma,
+                               args.rest, args.noise, seed=args.seed)
+    if biologic.is_mpr_file(args.path):
+        write_mpr(args.path, *columns)
+    else:
+        write_export(args.path, *columns, headings=args.headings,
+                     extra_columns=args.extra_columns, delimiter=',' if args.comma else '\t')
+    print(f"{len(columns[0])} rows written to {args.path}")
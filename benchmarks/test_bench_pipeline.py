@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Time of each stage of the analysis pipeline on synthetic cycler exports of growing size,
+as a pytest-benchmark suite.
+
+For each size a synthetic export is written (see synthetic_cell) and every stage is a
+separate benchmark on it: reading and parsing the file, finding the cycles, building the
+output frame, saving the separate cycles and each plot. The file is read again for every
+round, as the session cache and the binary sidecar are switched off.
+
+Usage:
+    python -m pytest benchmarks/test_bench_pipeline.py [--run-slow] [--points-per-cycle n]
+        [--current constant|stepped] [--layout wide|long] [--rounds n] [--dpi n]
+        [-k stage] [--benchmark-group-by param:size] [--benchmark-save name]
+
+The sizes 10M and 50M are marked slow and need several GB of memory; the wide layout and
+the separate cycles are slow with many cycles, use -k to leave stages out.
+"""
+import os
+import pytest
+import matplotlib.pyplot as plt
+import clean_data as cld
+import cycling_plots as cyc
+from synthetic_cell import make_export, parse_size
+
+pytest.importorskip('pytest_benchmark')
+
+SIZES = ('10k', '100k', '1M', pytest.param('10M', marks=pytest.mark.slow),
+         pytest.param('50M', marks=pytest.mark.slow))
+# the timed stages, in the order of the pipeline
+STAGES = ('data_from_file', 'parse_data', 'current_thresholds', 'get_cycle_counts',
+          'create_data_frame', 'create_cycles_separate', 'plot_max_cap_and_efficiency',
+          'plot_caps_vs_potentials', 'plot_cycle_heatmaps', 'plot_hysteresis')
+
+
+class Pipeline:
+    """The inputs of each stage of the pipeline on one file, computed once."""
+
+    def __init__(self, file, is_constant, layout, save_dir):
+        self.file = file
+        self.is_constant = is_constant
+        self.layout = layout
+        self.save_dir = save_dir
+        self.data = cld.read_data_file(file)
+        self.potential, self.time, self.current = cld.parse_data(self.data)
+        self.incycle_thresh = None if is_constant else cld.get_incycle_thresh(self.current)
+        self.is_pos, self.is_neg = self.current_thresholds()
+        (self.out_df, _, _,
+         self.pos_count, self.neg_count, self.result) = self.create_data_frame()
+        self.max_caps = cyc.calculate_max_cap_and_coulombic_eff(self.result, self.pos_count,
+                                                                self.neg_count)
+        self.heatmaps = cyc.cycle_heatmaps(self.result)
+        self.hysteresis = cyc.hysteresis_data_from_frame(self.result, '1')
+
+    def current_thresholds(self):
+        """Finds the samples in charge and discharge cycles."""
+        return cld.current_thresholds(self.current, 0.98, self.is_constant, self.incycle_thresh)
+
+    def create_data_frame(self):
+        """Runs create_data_frame without the segments cached by the previous run."""
+        cld.SESSION_CACHE.clear()
+        return cld.create_data_frame(self.file, '1', self.is_constant, False, self.layout,
+                                     self.incycle_thresh, return_result=True)
+
+    def stages(self):
+        """Returns the name and a function running each stage."""
+        cycle_no = cyc.get_cycle_no(self.pos_count)
+        coulombic_efficiency, max_charge_cap, max_discharge_cap = self.max_caps
+        return {
+            'data_from_file': lambda: cld.data_from_file(self.file, '1'),
+            'parse_data': lambda: cld.parse_data(self.data),
+            'current_thresholds': self.current_thresholds,
+            'get_cycle_counts': lambda: cld.get_cycle_counts(self.time, self.is_pos, self.is_neg),
+            'create_data_frame': self.create_data_frame,
+            'create_cycles_separate': lambda: cld.create_cycles_separate(self.out_df,
+                                                                         self.save_dir),
+            'plot_max_cap_and_efficiency': lambda: cyc.plot_max_cap_and_efficiency(
+                cycle_no, max_charge_cap, max_discharge_cap, coulombic_efficiency, self.save_dir),
+            'plot_caps_vs_potentials': lambda: cyc.plot_caps_vs_potentials(
+                self.result, self.pos_count, self.neg_count, self.save_dir),
+            'plot_cycle_heatmaps': lambda: cyc.plot_cycle_heatmaps(self.heatmaps, self.save_dir),
+            'plot_hysteresis': lambda: cyc.plot_hysteresis(*self.hysteresis, '1', self.save_dir),
+        }
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def pipeline(request, tmp_path_factory):
+    """The pipeline on a synthetic export of each size, shared by the stages."""
+    options = request.config.getoption
+    cld.SHOW_DIALOGS = False
+    cld.USE_SIDECAR = False
+    cyc.PLOT_DPI = options('--dpi')
+    n_rows = parse_size(request.param)
+    file = str(tmp_path_factory.mktemp('pipeline') / f"synthetic_{n_rows}.txt")
+    make_export(file, n_rows, options('--points-per-cycle'), current=options('--current'))
+    yield Pipeline(file, options('--current') == 'constant', options('--layout'),
+                   cld.make_save_dir(file))
+    plt.close('all')
+    os.remove(file)
+
+
+@pytest.mark.parametrize('stage', STAGES)
+def test_stage(benchmark, pipeline, stage, request):
+    """Times one stage of the pipeline, closing the figures of the plots after each round."""
+    benchmark.extra_info.update(rows=len(pipeline.time), cycles=pipeline.pos_count)
+    benchmark.pedantic(pipeline.stages()[stage], teardown=lambda: plt.close('all'),
+                       rounds=request.config.getoption('--rounds'))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Reader of BioLogic EC-Lab raw data files (.mpr), without exporting them to text first.
+
+An .mpr file starts with a magic string, followed by modules that each have a header
+(short name, long name, length, version and date) and a body. The body of the data module
+("VMP data") holds the number of points, the number of columns and the type ID of each
+column, and after a fixed-size block the points as packed little-endian records. The record
+layout follows from the column type IDs (see COLUMN_TYPES and FLAG_COLUMNS).
+
+The records are read with np.frombuffer over a memory-mapped file, so the columns are views
+of the file: nothing is copied, and only the pages of the columns that are used are read
+from disk.
+"""
+import os
+import mmap
+import numpy as np
+import pandas as pd
+
+MPR_MAGIC = b'BIO-LOGIC MODULAR FILE\x1a'.ljust(48) + b'\x00\x00\x00\x00'
+MODULE_MAGIC = b'MODULE'
+# header of each module. Newer EC-Lab versions write a second layout, recognised by the
+# maximum length of 0xFFFFFFFF that precedes the length
+MODULE_HEADER = np.dtype([('shortname', 'S10'), ('longname', 'S25'), ('length', '<u4'),
+                          ('version', '<u4'), ('date', 'S8')])
+MODULE_HEADER_V2 = np.dtype([('shortname', 'S10'), ('longname', 'S25'), ('max_length', '<u4'),
+                             ('length', '<u4'), ('version', '<u4'), ('unknown', '<u4'),
+                             ('date', 'S8')])
+DATA_MODULE = b'VMP data  '
+# offset of the first record in the body of the data module, per version of the module
+DATA_OFFSETS = {0: 100, 2: 405, 3: 406}
+
+# name and dtype of the column type IDs of the data module
+COLUMN_TYPES = {4: ('time/s', '<f8'),
+                5: ('control/V/mA', '<f4'),
+                6: ('Ewe/V', '<f4'),
+                7: ('dq/mA.h', '<f8'),
+                8: ('I/mA', '<f4'),
+                9: ('Ece/V', '<f4'),
+                11: ('I/mA', '<f8'),
+                13: ('(Q-Qo)/mA.h', '<f8'),
+                19: ('control/V', '<f4'),
+                20: ('control/mA', '<f4'),
+                23: ('dQ/mA.h', '<f8'),
+                24: ('cycle number', '<f8'),
+                26: ('Rapp/Ohm', '<f4'),
+                70: ('P/W', '<f4'),
+                74: ('Energy/W.h', '<f8'),
+                76: ('<I>/mA', '<f4'),
+                77: ('<Ewe>/V', '<f4'),
+                123: ('Energy charge/W.h', '<f8'),
+                124: ('Energy discharge/W.h', '<f8'),
+                125: ('Capacitance charge/uF', '<f8'),
+                126: ('Capacitance discharge/uF', '<f8'),
+                131: ('Ns', '<u2')}
+# column type IDs of flags, which all share one byte of the record
+FLAG_COLUMNS = {1: 'mode', 2: 'ox/red', 3: 'error', 21: 'control changes', 31: 'Ns changes',
+                65: 'counter inc.'}
+
+
+def is_mpr_file(file):
+    """
+    Returns whether a file is a BioLogic raw data file, by its extension.
+
+    Parameters:
+    file (str): Path of the file.
+
+    Returns:
+    bool: Whether the file is an .mpr file.
+    """
+    return os.path.splitext(str(file))[1].lower() == '.mpr'
+
+
+def record_dtype(column_ids):
+    """
+    Returns the dtype of the records of the data module for its column type IDs.
+
+    Parameters:
+    column_ids (iterable): The column type IDs, in the order of the file.
+
+    Returns:
+    numpy.dtype: The packed record dtype. Repeated names get a number appended, and the
+        flags are one 'flags' byte.
+    """
+    fields = []
+    names = set()
+    for column_id in column_ids:
+        column_id = int(column_id)
+        if column_id in FLAG_COLUMNS:
+            if 'flags' not in names:
+                fields.append(('flags', 'u1'))
+                names.add('flags')
+            continue
+        if column_id not in COLUMN_TYPES:
+            raise ValueError(f"Unsupported column type {column_id} in the .mpr file.")
+        name, dtype = COLUMN_TYPES[column_id]
+        unique, k = name, 2
+        while unique in names:
+            unique, k = f"{name} {k}", k + 1
+        fields.append((unique, dtype))
+        names.add(unique)
+    return np.dtype(fields)
+
+
+def read_modules(buffer):
+    """
+    Lists the modules of an .mpr file.
+
+    Parameters:
+    buffer (buffer): The contents of the file, e.g. a memory map.
+
+    Returns:
+    list: A dictionary per module with its 'shortname', 'longname', 'version', 'date', and the
+        'offset' and 'length' of its body in the file.
+    """
+    if bytes(buffer[:len(MPR_MAGIC)]) != MPR_MAGIC:
+        raise ValueError("Not a BioLogic .mpr file.")
+    modules = []
+    offset = len(MPR_MAGIC)
+    while offset < len(buffer):
+        if bytes(buffer[offset:offset + len(MODULE_MAGIC)]) != MODULE_MAGIC:
+            raise ValueError(f"Corrupt .mpr file: no module found at byte {offset}.")
+        offset += len(MODULE_MAGIC)
+        header = np.frombuffer(buffer, dtype=MODULE_HEADER, count=1, offset=offset)[0]
+        if header['length'] == 0xFFFFFFFF:
+            header = np.frombuffer(buffer, dtype=MODULE_HEADER_V2, count=1, offset=offset)[0]
+        offset += header.dtype.itemsize
+        modules.append({'shortname': header['shortname'], 'longname': header['longname'],
+                        'version': int(header['version']), 'date': header['date'],
+                        'offset': offset, 'length': int(header['length'])})
+        offset += int(header['length'])
+    return modules
+
+
+def read_mpr(file):
+    """
+    Memory-maps the data records of an .mpr file.
+
+    Parameters:
+    file (str): Path of the file.
+
+    Returns:
+    numpy.ndarray: The records, a read-only structured array over the memory-mapped file.
+    """
+    if os.path.getsize(file) == 0:
+        raise pd.errors.EmptyDataError("No data found in the file.")
+    with open(file, 'rb') as fh:
+        buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    data_module = next((m for m in read_modules(buffer) if m['shortname'] == DATA_MODULE), None)
+    if data_module is None:
+        raise ValueError("No data module found in the .mpr file.")
+    if data_module['version'] not in DATA_OFFSETS:
+        raise ValueError(f"Unsupported version {data_module['version']} of the data module.")
+    start = data_module['offset']
+    n_points = int(np.frombuffer(buffer, dtype='<u4', count=1, offset=start)[0])
+    n_columns = int(np.frombuffer(buffer, dtype='u1', count=1, offset=start + 4)[0])
+    column_ids = np.frombuffer(buffer, dtype='<u2', count=n_columns, offset=start + 5)
+    dtype = record_dtype(column_ids)
+    first = start + DATA_OFFSETS[data_module['version']]
+    if first + n_points * dtype.itemsize > start + data_module['length']:
+        raise ValueError("Corrupt .mpr file: the data module is shorter than its records.")
+    return np.frombuffer(buffer, dtype=dtype, count=n_points, offset=first)
+
+
+def mpr_frame(file):
+    """
+    Returns the columns of an .mpr file as a DataFrame. This copies them, unlike read_mpr.
+
+    Parameters:
+    file (str): Path of the file.
+
+    Returns:
+    pandas.DataFrame: One column per column of the file, named as in EC-Lab text exports.
+    """
+    records = read_mpr(file)
+    return pd.DataFrame({name: records[name] for name in records.dtype.names})
+
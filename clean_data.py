@@ -7,6 +7,10 @@ lukasrier@outlook.com
 """
 import sys
 import os
+import io
+import re
+import shutil
+import tempfile
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import simpledialog
@@ -14,10 +18,317 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import logging
-
-# parameters for parquet compression
-PARQUET_COMPRESSION: str = "gzip"
+import configparser
+from data_cache import SESSION_CACHE, ColumnSpill, read_sidecar, write_sidecar
+from preview import DecimatedLine, shade_cycles
+from biologic import is_mpr_file, read_mpr, mpr_frame
+from spreadsheet import is_xlsx_file, open_workbook, find_sheet, durations_to_seconds
+import run_report
+
+# show dialogs for errors and missing inputs (switched off for headless batch runs)
+SHOW_DIALOGS: bool = True
+
+# keep a binary copy of the parsed columns next to each data file for fast reloads
+# (see data_cache.read_sidecar)
+USE_SIDECAR: bool = True
+
+# how capacities are calculated: "trapezoid" integrates the current over the time of each
+# cycle, "legacy" multiplies the current of each sample by its elapsed time
+CAPACITY_METHODS = ('trapezoid', 'legacy')
+CAPACITY_METHOD: str = "trapezoid"
+
+# parameters for parquet output (see set_parquet_options and the config file)
+PARQUET_ENGINES = ('fastparquet', 'pyarrow')
+PARQUET_CODECS = ('zstd', 'snappy', 'lz4', 'gzip', 'none')
+# codecs with a compression level
+PARQUET_LEVEL_CODECS = ('zstd', 'gzip')
+PARQUET_COMPRESSION: str = "snappy"
 PARQUET_ENGINE: str = "fastparquet"
+# compression level, None for the default level of the codec
+PARQUET_COMPRESSION_LEVEL = None
+# maximum number of rows per row group, None for the default of the engine
+PARQUET_ROW_GROUP_SIZE = None
+
+# settings file read on start-up, next to the program
+CONFIG_FILE: str = os.path.join(os.path.dirname(os.path.abspath(
+    sys.executable if getattr(sys, 'frozen', False) else __file__)), "GalvAnalyze.ini")
+
+# supported column headings, in order of preference. More can be added with register_headings
+# or in the [headings] section of the config file (see load_config)
+POTENTIAL_HEADINGS = ('Ecell/V', 'E /V', 'Ewe/V', 'E/V', 'Voltage/V', 'Voltage(V)')
+# (heading, factor to convert to mA)
+CURRENT_HEADINGS = (('<I>/mA', 1), ('I /mA', 1), ('I/mA', 1), ('Current/mA', 1),
+                    ('Current(A)', 1000), ('Current(mA)', 1))
+# 'Total Time' of Neware exports is a duration such as '25:13:04' (see parse_data)
+TIME_HEADINGS = ('time/s', 'time /s', 'Test_Time(s)', 'Total Time')
+# column delimiters recognised in the header line of a data file, the first is the default
+DELIMITERS = ('\t', ',', ';')
+# parser of the data files: "pandas", or "pyarrow" for the multi-threaded CSV reader of pyarrow,
+# which falls back to pandas if pyarrow is missing or cannot read a file (see set_csv_backend)
+CSV_BACKENDS = ('pandas', 'pyarrow')
+CSV_BACKEND: str = "pandas"
+# sheet of spreadsheet (.xlsx) files to read, None to find the sheet of the record of every
+# sample (see read_xlsx_file)
+XLSX_SHEET = None
+
+# trailing part number of the files of a test split over several files, e.g. "_02" or " part 3",
+# and the suffix naming the outputs of the stitched test instead (see stitched_file)
+PART_NUMBER = re.compile(r'[ _-]+(part[ _-]*)?\d+$', re.IGNORECASE)
+STITCHED_SUFFIX: str = "_stitched"
+# samples copied at once when the parts of a test are stitched together
+STITCH_BLOCK_ROWS: int = 1_000_000
+
+# file name of the single Parquet file holding all cycles, one row group per cycle
+CYCLES_DATASET: str = "All_cycles.parquet"
+
+# column headings of the long (one row per sample) output layout
+LONG_COLUMNS = ('cycle', 'direction', 'Elapsed_time/s', 'Capacity/mA.h.g^-1', 'Ecell/V')
+
+# called as PROGRESS_CALLBACK(stage, done, total) as an analysis runs (see report_progress),
+# e.g. by the GUI to update its progress bar
+PROGRESS_CALLBACK = None
+
+# runs the functions that show figures or dialogs when the analysis does not run on the thread
+# of the GUI (see call_in_gui)
+GUI_CALLER = None
+
+
+class RunCancelled(Exception):
+    """Raised by a progress callback to stop an analysis between two steps or cycles."""
+
+
+def report_progress(stage, done=0, total=1):
+    """
+    Reports the progress of an analysis to PROGRESS_CALLBACK, if it is set. The callback may
+    raise RunCancelled to stop the analysis.
+
+    Parameters:
+    stage (str): What the analysis is doing.
+    done (int): The number of steps of the stage that are finished, e.g. cycles written.
+    total (int): The number of steps of the stage.
+    """
+    if PROGRESS_CALLBACK is not None:
+        PROGRESS_CALLBACK(stage, done, total)
+
+
+def call_in_gui(func, *args, **kwargs):
+    """
+    Calls a function that shows figures or dialogs. Tk and pyplot only work on the thread of
+    the GUI, so the call is passed to GUI_CALLER if it is set.
+
+    Parameters:
+    func (callable): The function to call.
+    *args, **kwargs: The arguments of the function.
+
+    Returns:
+    The return value of the function.
+    """
+    if GUI_CALLER is None:
+        return func(*args, **kwargs)
+    return GUI_CALLER(func, *args, **kwargs)
+
+
+def show_error(message):
+    """
+    Shows an error message in a dialog, unless dialogs are switched off (see SHOW_DIALOGS).
+
+    Parameters:
+    message (str): the message to be shown.
+    """
+    if SHOW_DIALOGS:
+        call_in_gui(tk.messagebox.showerror, title=None, message=message)
+
+
+def set_parquet_options(engine, compression, compression_level=None, row_group_size=None):
+    """
+    Sets the engine, codec, compression level and row group size of the Parquet outputs.
+
+    Parameters:
+    engine (str): 'fastparquet' or 'pyarrow'.
+    compression (str): One of PARQUET_CODECS ('none' for no compression).
+    compression_level (int): Compression level of zstd or gzip, None for the default level.
+    row_group_size (int): Maximum number of rows per row group, None for the default of the engine.
+    """
+    global PARQUET_ENGINE, PARQUET_COMPRESSION, PARQUET_COMPRESSION_LEVEL, PARQUET_ROW_GROUP_SIZE
+    engine, compression = str(engine).lower(), str(compression).lower()
+    if engine not in PARQUET_ENGINES:
+        raise ValueError(f"Unknown Parquet engine '{engine}', use one of {PARQUET_ENGINES}.")
+    if compression not in PARQUET_CODECS:
+        raise ValueError(f"Unknown Parquet codec '{compression}', use one of {PARQUET_CODECS}.")
+    if row_group_size is not None and int(row_group_size) < 1:
+        raise ValueError("The row group size must be at least 1.")
+    PARQUET_ENGINE = engine
+    PARQUET_COMPRESSION = compression
+    PARQUET_COMPRESSION_LEVEL = None if compression_level is None else int(compression_level)
+    PARQUET_ROW_GROUP_SIZE = None if row_group_size is None else int(row_group_size)
+
+
+def set_csv_backend(backend):
+    """
+    Sets the parser of the data files.
+
+    Parameters:
+    backend (str): One of CSV_BACKENDS.
+    """
+    global CSV_BACKEND
+    backend = str(backend).lower()
+    if backend not in CSV_BACKENDS:
+        raise ValueError(f"Unknown CSV backend '{backend}', use one of {CSV_BACKENDS}.")
+    CSV_BACKEND = backend
+
+
+def parquet_kwargs(row_groups=True, frame=None):
+    """
+    Returns the keyword arguments of DataFrame.to_parquet for the current Parquet settings.
+
+    Parameters:
+    row_groups (bool): Whether to include the row group size.
+    frame (pandas.DataFrame): The frame to be written. fastparquet cannot apply a compression
+        level to the dictionary of categorical columns, so these columns are compressed at
+        the default level of the codec.
+
+    Returns:
+    dict: The engine, compression and row group arguments.
+    """
+    codec = None if PARQUET_COMPRESSION == 'none' else PARQUET_COMPRESSION
+    level = PARQUET_COMPRESSION_LEVEL if codec in PARQUET_LEVEL_CODECS else None
+    kwargs = {'engine': PARQUET_ENGINE, 'compression': codec}
+    if PARQUET_ENGINE == 'pyarrow':
+        if level is not None:
+            kwargs['compression_level'] = level
+        if row_groups and PARQUET_ROW_GROUP_SIZE is not None:
+            kwargs['row_group_size'] = PARQUET_ROW_GROUP_SIZE
+    else:
+        if level is not None:
+            # fastparquet passes the args on to the compressor of the codec
+            kwargs['compression'] = {'_default': {
+                'type': codec.upper(),
+                'args': {'level' if codec == 'zstd' else 'compresslevel': level}}}
+            if frame is not None:
+                kwargs['compression'].update(
+                    (name, codec) for name, dtype in frame.dtypes.items()
+                    if isinstance(dtype, pd.CategoricalDtype))
+        if row_groups and PARQUET_ROW_GROUP_SIZE is not None:
+            kwargs['row_group_offsets'] = PARQUET_ROW_GROUP_SIZE
+    return kwargs
+
+
+def pyarrow_writer_kwargs():
+    """
+    Returns the compression arguments of pyarrow.parquet.ParquetWriter for the current Parquet settings.
+    """
+    kwargs = parquet_kwargs(row_groups=False)
+    del kwargs['engine']
+    return kwargs
+
+
+def load_config(path=None):
+    """
+    Reads the settings of a config file, if it exists. The file has the format
+
+        [parquet]
+        engine = pyarrow
+        compression = zstd
+        compression_level = 3
+        row_group_size = 1000000
+
+        [report]
+        enabled = true
+        trace_memory = false
+
+        [reading]
+        csv_backend = pyarrow
+        xlsx_sheet = record
+
+        [headings]
+        potential = U/V, Voltage /V
+        time = Test Time/s
+        current = I/A * 1000, I/uA * 0.001
+
+    and settings missing from it are left unchanged. Invalid settings are logged and ignored.
+    Importing the module does not read it: the GUI and the command line load it when they start.
+
+    Parameters:
+    path (str): Path of the config file. Defaults to CONFIG_FILE.
+
+    Returns:
+    bool: Whether the settings were read.
+    """
+    global XLSX_SHEET
+    path = CONFIG_FILE if path is None else path
+    config = configparser.ConfigParser(interpolation=None)
+    try:
+        if not config.read(path):
+            return False
+        if config.has_section('parquet'):
+            section = config['parquet']
+            level = section.get('compression_level', str(PARQUET_COMPRESSION_LEVEL))
+            rows = section.get('row_group_size', str(PARQUET_ROW_GROUP_SIZE))
+            set_parquet_options(section.get('engine', PARQUET_ENGINE),
+                                section.get('compression', PARQUET_COMPRESSION),
+                                None if level.strip().lower() in ('', 'none') else int(level),
+                                None if rows.strip().lower() in ('', 'none') else int(rows))
+        if config.has_section('report'):
+            run_report.ENABLED = config['report'].getboolean('enabled', run_report.ENABLED)
+            run_report.TRACE_MEMORY = config['report'].getboolean('trace_memory',
+                                                                  run_report.TRACE_MEMORY)
+        if config.has_section('reading'):
+            set_csv_backend(config['reading'].get('csv_backend', CSV_BACKEND))
+            XLSX_SHEET = config['reading'].get('xlsx_sheet', XLSX_SHEET) or None
+        if config.has_section('headings'):
+            names = {key: [h.strip() for h in config['headings'].get(key, '').split(',') if h.strip()]
+                     for key in ('potential', 'time', 'current')}
+            current = []
+            for item in names['current']:
+                heading, _, scale = item.partition('*')
+                current.append((heading.strip(), float(scale) if scale.strip() else 1))
+            register_headings(names['potential'], names['time'], current)
+    except (configparser.Error, ValueError) as e:
+        logging.warning(f"Ignoring the settings in {path}: {e}")
+        return False
+    return True
+
+
+def save_config(path=None):
+    """
+    Saves the current Parquet settings to a config file (see load_config).
+
+    Parameters:
+    path (str): Path of the config file. Defaults to CONFIG_FILE.
+    """
+    path = CONFIG_FILE if path is None else path
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    config['parquet'] = {'engine': PARQUET_ENGINE,
+                         'compression': PARQUET_COMPRESSION,
+                         'compression_level': str(PARQUET_COMPRESSION_LEVEL),
+                         'row_group_size': str(PARQUET_ROW_GROUP_SIZE)}
+    with open(path, 'w') as fh:
+        config.write(fh)
+
+
+def select_file():
+    """
+    Shows a file dialog to select a data file.
+
+    Returns:
+    str: the file path of the selected data file
+    """
+    root = tk.Tk()
+    root.withdraw()
+    try:
+        file = filedialog.askopenfilename(parent=root,
+                                          filetypes=[('Text files',
+                                                      '*.txt'),
+                                                     ('BioLogic raw files',
+                                                      '*.mpr'),
+                                                     ('Spreadsheets',
+                                                      '*.xlsx')])
+        file = os.path.abspath(file)
+    except FileNotFoundError:
+        sys.exit()
+    root.destroy()
+    return file
 
 
 def data_from_file(file=None, active_mass_input=None):
@@ -31,37 +342,321 @@ def data_from_file(file=None, active_mass_input=None):
     Returns:
     tuple: a tuple containing:
         - str: the file path of the data file
-        - pandas.DataFrame: the loaded data
+        - pandas.DataFrame: the loaded potential, time and current columns
         - float: the active mass in grams
     """
     if file is None:
-        root = tk.Tk()
-        root.withdraw()
+        file = select_file()
+
+    data = read_data_file(file)
+
+    active_mass = get_active_mass(active_mass_input)
+
+    return file, data, active_mass
+
+
+def sniff_header(file):
+    """
+    Reads the header line of a data file and finds its delimiter, the one of DELIMITERS
+    that occurs most often in it.
+
+    Parameters:
+    file (str): the file path to be read.
+
+    Returns:
+    tuple: a tuple containing:
+        - str: the delimiter
+        - pandas.Index: the column headings
+    """
+    with open(file, encoding='utf-8', errors='replace', newline='') as fh:
+        header_line = fh.readline()
+    if not header_line.strip():
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    delimiter = max(DELIMITERS, key=header_line.count)
+    if header_line.count(delimiter) == 0:
+        delimiter = DELIMITERS[0]
+    columns = pd.read_csv(io.StringIO(header_line), delimiter=delimiter, nrows=0).columns
+    return delimiter, columns
+
+
+def read_csv_columns(file, delimiter, usecols=None, dtype=None):
+    """
+    Reads columns of a delimited file with the CSV_BACKEND, falling back to the pandas parser
+    if pyarrow is not installed or cannot read the file.
+
+    pyarrow rounds every value correctly, while the default pandas parser can be a few units
+    in the last place off, so the two may differ by that much.
+
+    Parameters:
+    file (str): the file path to be read.
+    delimiter (str): the column delimiter.
+    usecols (list): the headings of the columns to read, None for all columns.
+    dtype (dict): the dtype of each column, None to infer them.
+
+    Returns:
+    pandas.DataFrame: the loaded columns
+    """
+    if CSV_BACKEND == 'pyarrow':
         try:
-            file = filedialog.askopenfilename(parent=root,
-                                              filetypes=[('Text files',
-                                                          '*.txt')])
-            file = os.path.abspath(file)
-        except FileNotFoundError:
-            sys.exit()
+            return pd.read_csv(file, delimiter=delimiter, usecols=usecols, dtype=dtype,
+                               engine='pyarrow')
+        except (ImportError, ValueError) as e:
+            logging.warning(f"Reading the file with pandas instead of pyarrow: {e}")
+    return pd.read_csv(file, delimiter=delimiter, usecols=usecols, dtype=dtype)
+
+
+def read_data_file(file):
+    """
+    Reads the potential, time and current columns of a data file as floats, skipping all
+    other columns. The delimiter and the headings are found from the header line (see
+    sniff_header and find_headings), and the file is parsed by the CSV_BACKEND (see
+    read_csv_columns). Columns with values that are not numbers are read as they are, and
+    a file without any supported heading is read completely, for parse_data to report.
+    All columns of BioLogic .mpr files are read (see biologic.mpr_frame), and spreadsheets
+    are read with read_xlsx_file.
+
+    Parameters:
+    file (str): the file path to be read.
 
+    Returns:
+    pandas.DataFrame: the loaded data
+    """
     print(file)
     try:
-        data = pd.read_csv(file, delimiter='\t' or ',')
+        if is_mpr_file(file):
+            return mpr_frame(file)
+        if is_xlsx_file(file):
+            return read_xlsx_file(file)
+        delimiter, columns = sniff_header(file)
+        headings = find_headings(columns)[:3]
+        usecols = list(dict.fromkeys(h for h in headings if h is not None))
+        if not usecols:
+            return read_csv_columns(file, delimiter)
+        try:
+            data = read_csv_columns(file, delimiter, usecols, dict.fromkeys(usecols, np.float64))
+        except ValueError as e:
+            logging.warning(f"Reading the data columns as text: {e}")
+            data = read_csv_columns(file, delimiter, usecols)
     except pd.errors.EmptyDataError as e:
         logging.error(e)
         logging.error("No data found in the file.")
-        tk.messagebox.showerror(title=None,
-                                message="No data found in the file.")
+        show_error("No data found in the file.")
+        raise(e)
+    return data
+
+
+def read_xlsx_file(file, sheet=None):
+    """
+    Reads the potential, time and current columns of a spreadsheet export (.xlsx) of a
+    Neware or Arbin cycler with the fastest installed engine (see spreadsheet.xlsx_engine).
+
+    Parameters:
+    file (str): the file path to be read.
+    sheet (str): the sheet to read. Defaults to XLSX_SHEET, and if that is None, the first
+        sheet with supported potential, time and current headings (see spreadsheet.find_sheet).
+
+    Returns:
+    pandas.DataFrame: the loaded data
+    """
+    try:
+        workbook = open_workbook(file)
+    except ImportError as e:
+        logging.error(e)
+        show_error(str(e))
         raise(e)
+    with workbook:
+        sheet = XLSX_SHEET if sheet is None else sheet
+        try:
+            if sheet is None:
+                sheet = find_sheet(workbook, lambda columns: None not in find_headings(columns)[:3])
+            headings = find_headings(workbook.parse(sheet, nrows=0).columns)[:3]
+        except ValueError as e:
+            logging.error(e)
+            show_error("Non-valid column headings found!")
+            raise(e)
+        logging.warning(f"Reading the sheet '{sheet}'.")
+        usecols = list(dict.fromkeys(h for h in headings if h is not None))
+        return workbook.parse(sheet, usecols=usecols or None)
+
+
+def load_parsed(file, cache=True):
+    """
+    Returns the potential, time and current data of a file, reading and parsing it only
+    the first time (see data_cache.SESSION_CACHE).
+
+    If USE_SIDECAR is set, the parsed columns are also saved to the sidecar of the file and
+    memory-mapped from it in later sessions, as long as the file is unchanged. BioLogic .mpr
+    files need no sidecar, as their columns are memory-mapped directly (see parse_mpr).
+
+    Parameters:
+    file (str): the file path to be read.
+    cache (bool): whether to keep the data in the session cache.
+
+    Returns:
+    tuple: a tuple containing:
+        - pandas.Series: the potential data
+        - pandas.Series: the time data
+        - pandas.Series: the current data
+    """
+    parsed = SESSION_CACHE.get(file, 'parsed')
+    if parsed is None and is_mpr_file(file):
+        parsed = parse_mpr(file)
+        if cache:
+            SESSION_CACHE.put(file, 'parsed', parsed)
+    if parsed is None and USE_SIDECAR:
+        parsed = parsed_from_sidecar(file)
+        if parsed is not None and cache:
+            SESSION_CACHE.put(file, 'parsed', parsed)
+    if parsed is None:
+        potential, time, current = parse_data(read_data_file(file))
+        parsed = tuple(col.copy() if isinstance(col, pd.Series) else col
+                       for col in (potential, time, current))
+        if all(isinstance(col, pd.Series) for col in parsed):
+            if cache:
+                SESSION_CACHE.put(file, 'parsed', parsed)
+            if USE_SIDECAR and all(pd.api.types.is_numeric_dtype(col) for col in parsed):
+                potential, time, current = parsed
+                write_sidecar(file, time.to_numpy(), potential.to_numpy(), current.to_numpy(),
+                              {'time': time.name, 'potential': potential.name,
+                               'current': current.name,
+                               'current_scale': find_headings([current.name])[3]})
+    return parsed
+
+
+def parsed_from_sidecar(file):
+    """
+    Memory-maps the potential, time and current data of a file from its sidecar.
+
+    Parameters:
+    file (str): the file path to be read.
+
+    Returns:
+    tuple: the potential, time and current data as in load_parsed, or None if the file
+        has no up to date sidecar.
+    """
+    sidecar = read_sidecar(file)
+    if sidecar is None:
+        return None
+    columns, headings = sidecar
+    return (pd.Series(columns['potential'], name=headings['potential'], copy=False),
+            pd.Series(columns['time'], name=headings['time'], copy=False),
+            pd.Series(columns['current'], name=headings['current'], copy=False))
+
+
+def stitched_file(files):
+    """
+    Returns the path the outputs of a test split over several files are named after: the
+    first file without its part number, with STITCHED_SUFFIX appended, e.g. test_stitched.txt
+    for test_01.txt, test_02.txt, ... The path of a single file is returned unchanged.
+
+    Parameters:
+    files (list): The paths of the parts, in the order of the test.
+
+    Returns:
+    str: The path, which does not need to exist.
+    """
+    if len(files) == 1:
+        return files[0]
+    stem, ext = os.path.splitext(files[0])
+    folder, name = os.path.split(stem)
+    name = PART_NUMBER.sub('', name) or name
+    return os.path.join(folder, name + STITCHED_SUFFIX + ext)
+
+
+def part_time_offset(last_time, last_step, first_time):
+    """
+    Returns the shift of the time of a part of a test so that it continues the previous part.
+
+    Cyclers restart the time when a test is resumed in a new file. A part starting at or before
+    the end of the previous part is moved to start one sampling interval after it, while a part
+    whose time already continues the previous one is left as it is.
+
+    Parameters:
+    last_time (float): The (shifted) time of the last sample of the previous part.
+    last_step (float): The last sampling interval of the previous part.
+    first_time (float): The time of the first sample of the part.
+
+    Returns:
+    float: The offset to add to the time of the part.
+    """
+    if first_time <= last_time:
+        return last_time + last_step - first_time
+    return 0.0
 
 
+def stitch_parts(files, folder, load=None, rows=STITCH_BLOCK_ROWS):
+    """
+    Joins the parts of a test that was split over several files into one record.
+
+    The parts are loaded one at a time, in order, and appended block by block to column
+    files in folder, with the time of each part shifted so that it continues the previous
+    part (see part_time_offset). Only one part is held in memory at once, and the record is
+    memory-mapped from the column files, so the cycles are found across the boundaries of
+    the parts as in a single file.
+
+    Parameters:
+    files (list): The paths of the parts, in the order of the test.
+    folder (str): Directory for the column files of the record.
+    load (callable): Returns the potential, time and current of a part. Defaults to
+        load_parsed, without keeping the parts in the session cache.
+    rows (int): The number of samples copied at once.
+
+    Returns:
+    tuple: the potential, time and current of the record as pandas.Series over memory maps,
+        named by the headings of the first part.
+    """
+    if load is None:
+        load = lambda part: load_parsed(part, cache=False)
+    os.makedirs(folder, exist_ok=True)
+    order = ('potential', 'time', 'current')
+    spills = {name: ColumnSpill(os.path.join(folder, name + '.bin')) for name in order}
+    names = None
+    last_time, last_step = -np.inf, 0.0
+    for part in files:
+        columns = load(part)
+        if names is None:
+            names = tuple(getattr(column, 'name', name) for column, name in zip(columns, order))
+        potential, time, current = (np.asarray(column, dtype=np.float64) for column in columns)
+        columns = None
+        if len(time) == 0:
+            logging.warning(f"No data found in {os.path.basename(part)}, skipping it.")
+            continue
+        offset = part_time_offset(last_time, last_step, time[0])
+        if offset:
+            logging.warning(f"Shifted the time of {os.path.basename(part)} by {offset} s "
+                            "to continue the previous part.")
+        for s in range(0, len(time), rows):
+            spills['potential'].append(potential[s:s+rows])
+            spills['time'].append(time[s:s+rows] + offset)
+            spills['current'].append(current[s:s+rows])
+        if len(time) > 1:
+            last_step = max(time[-1] - time[-2], 0.0)
+        last_time = time[-1] + offset
+        potential = time = current = None
+    logging.warning(f"Stitched {len(files)} files into one record of {spills['time'].n} samples.")
+    return tuple(pd.Series(spills[name].open(), name=heading, copy=False)
+                 for name, heading in zip(order, names or order))
+
+
+def get_active_mass(active_mass_input=None):
+    """
+    Validates the active mass input, asking the user for a value if it is missing or invalid.
+
+    Parameters:
+    active_mass_input (str): the user input for active mass in mg. If None, a dialog will be shown to prompt the user for input.
+
+    Returns:
+    float: the active mass in grams
+    """
+    root = None
     if active_mass_input is None:
         mass_valid = False
     else:
         mass_valid = check_valid_number(active_mass_input)
+    if not(mass_valid) and not SHOW_DIALOGS:
+        raise Exception(f"Invalid active mass value: {active_mass_input}")
     while not(mass_valid):
-        if not 'root' in locals():
+        if root is None:
             root = tk.Tk()
             root.lift()
         active_mass_input = simpledialog.askstring(parent=root,
@@ -69,23 +664,19 @@ def data_from_file(file=None, active_mass_input=None):
                                                    prompt="Enter Active Loading (mg):",
                                                    initialvalue=8)
         if active_mass_input is None:
-            if 'root' in locals():
-                root.destroy()
+            root.destroy()
             msg = "You need an active mass value to proceed."
             raise Exception(msg)
 
         mass_valid = check_valid_number(active_mass_input)
 
         if not mass_valid:
-            tk.messagebox.showerror(title=None,
-                                    message="Enter a valid number!")
+            show_error("Enter a valid number!")
 
-    if 'root' in locals():
+    if root is not None:
         root.destroy()
 
-    active_mass = float(active_mass_input) / 1000
-
-    return file, data, active_mass
+    return float(active_mass_input) / 1000
 
 
 def check_valid_number(input_str):
@@ -110,6 +701,48 @@ def check_valid_number(input_str):
         return True
 
 
+def register_headings(potential=(), time=(), current=()):
+    """
+    Adds supported column headings, after the known ones (see POTENTIAL_HEADINGS,
+    TIME_HEADINGS and CURRENT_HEADINGS). Headings that are already known are ignored.
+
+    Parameters:
+    potential (iterable): headings of potential columns (V).
+    time (iterable): headings of time columns (s).
+    current (iterable): (heading, factor to convert to mA) of current columns.
+    """
+    global POTENTIAL_HEADINGS, TIME_HEADINGS, CURRENT_HEADINGS
+    POTENTIAL_HEADINGS += tuple(h for h in dict.fromkeys(potential) if h not in POTENTIAL_HEADINGS)
+    TIME_HEADINGS += tuple(h for h in dict.fromkeys(time) if h not in TIME_HEADINGS)
+    known = [h for h, _ in CURRENT_HEADINGS]
+    for heading, scale in current:
+        if heading not in known:
+            CURRENT_HEADINGS += ((heading, scale),)
+            known.append(heading)
+
+
+def find_headings(columns):
+    """
+    Finds the supported potential, time and current headings among the column headings of a file.
+
+    Parameters:
+    columns (iterable): the column headings of the loaded data.
+
+    Returns:
+    tuple: a tuple containing:
+        - str: the potential heading (None if not found)
+        - str: the time heading (None if not found)
+        - str: the current heading (None if not found)
+        - float: the factor converting the current column to mA
+    """
+    columns = list(columns)
+    potential_head = next((h for h in POTENTIAL_HEADINGS if h in columns), None)
+    time_head = next((h for h in TIME_HEADINGS if h in columns), None)
+    current_head, current_scale = next(((h, scale) for h, scale in CURRENT_HEADINGS
+                                        if h in columns), (None, 1))
+    return potential_head, time_head, current_head, current_scale
+
+
 def parse_data(data):
     """
     Parses the loaded data and returns the potential, time, and current.
@@ -123,57 +756,109 @@ def parse_data(data):
         - pandas.Series: the time data
         - pandas.Series: the current data
     """
-    potential_heading_good = True
-    if 'Ecell/V' in data:
-        potential = data.loc[:, 'Ecell/V']
-    elif 'E /V' in data:
-        potential = data.loc[:, 'E /V']
-    elif 'Ewe/V' in data:
-        potential = data.loc[:, 'Ewe/V']
-    elif 'E/V' in data:
-        potential = data.loc[:, 'E/V']
-    elif 'Voltage/V' in data:
-        potential = data.loc[:, 'Voltage/V']
-    elif 'Voltage(V)' in data:
-        potential = data.loc[:, 'Voltage(V)']
+    potential_head, time_head, current_head, current_scale = find_headings(data.columns)
+
+    potential_heading_good = potential_head is not None
+    if potential_heading_good:
+        potential = data.loc[:, potential_head]
     else:
         potential = 'NaN'
-        potential_heading_good = False
-    print(potential)
-    current_heading_good = True
-    if '<I>/mA' in data:
-        current = data.loc[:, '<I>/mA']
-    elif 'I /mA' in data:
-        current = data.loc[:, 'I /mA']
-    elif 'I/mA' in data:
-        current = data.loc[:, 'I/mA']
-    elif 'Current/mA' in data:
-        current = data.loc[:, 'Current/mA']
-    elif 'Current(A)' in data:
-        current = data.loc[:, 'Current(A)']*1000
+
+    current_heading_good = current_head is not None
+    if current_heading_good:
+        current = data.loc[:, current_head]
+        if current_scale != 1:
+            current = current*current_scale
     else:
         current = 'NaN'
-        current_heading_good = False
-    print(current)
-
-    time_heading_good = True
-    if 'time/s' in data:
-        time = data.loc[:, 'time/s']
-    elif 'time /s' in data:
-        time = data.loc[:, 'time /s']
+
+    time_heading_good = time_head is not None
+    if time_heading_good:
+        time = data.loc[:, time_head]
+        if not pd.api.types.is_numeric_dtype(time):
+            time = pd.Series(durations_to_seconds(time), name=time_head)
     else:
         time = 'NaN'
-        time_heading_good = False
-    print(time)
 
     if not any([time_heading_good, potential_heading_good, current_heading_good]):
         logging.warning("Non-valid column headings! Check if your data has headings and that they are supported.")
-        tk.messagebox.showerror(title=None,
-                                    message="Non-valid column headings found!")
+        show_error("Non-valid column headings found!")
         raise Exception("Non-valid column headings found!")
     return potential, time, current
 
 
+def parse_mpr(file):
+    """
+    Returns the potential, time and current of a BioLogic .mpr file as views of the
+    memory-mapped file (see biologic.read_mpr). The columns are found as in parse_data.
+
+    Parameters:
+    file (str): the file path to be read.
+
+    Returns:
+    tuple: a tuple containing:
+        - pandas.Series: the potential data
+        - pandas.Series: the time data
+        - pandas.Series: the current data
+    """
+    try:
+        records = read_mpr(file)
+    except pd.errors.EmptyDataError as e:
+        logging.error(e)
+        logging.error("No data found in the file.")
+        show_error("No data found in the file.")
+        raise(e)
+    except ValueError as e:
+        logging.error(e)
+        show_error(f"Could not read the file: {e}")
+        raise(e)
+    potential_head, time_head, current_head, current_scale = find_headings(records.dtype.names)
+    if None in (potential_head, time_head, current_head):
+        logging.warning("Non-valid column headings! Check if your data has headings and that they are supported.")
+        show_error("Non-valid column headings found!")
+        raise Exception("Non-valid column headings found!")
+    current = records[current_head]
+    if current_scale != 1:
+        current = current*current_scale
+    return (pd.Series(records[potential_head], name=potential_head, copy=False),
+            pd.Series(records[time_head], name=time_head, copy=False),
+            pd.Series(current, name=current_head, copy=False))
+
+
+def plot_thresh_diagnostic(current, posthresh, negthresh, is_pos, is_neg, thresh_labels):
+    """
+    Plots the current data against the sample number with positive and negative threshold lines
+    and shades the charge and discharge sections of the data. The current is decimated to the
+    resolution of the window (again after zooming) and each cycle is shaded as one rectangle,
+    so that long records stay responsive (see preview).
+
+    Parameters:
+    current (array-like): the current data to be plotted.
+    posthresh (float): the positive threshold value.
+    negthresh (float): the negative threshold value.
+    is_pos (array-like): logical array indicating points within the charge cycle
+    is_neg (array-like): logical array indicating points within the discharge cycle
+    thresh_labels (list): the legend labels of the positive and negative threshold lines
+    """
+    current = np.asarray(current, dtype=float)
+    x = np.arange(1, len(current)+1)
+    plt.figure(figsize=(9, 4))
+    ax = plt.subplot(111)
+    handles = [DecimatedLine(ax, x, current, 'k').line,
+               ax.axhline(posthresh, color='r'),
+               ax.axhline(negthresh, color='b')]
+    labels = ['Current'] + list(thresh_labels)
+    if is_pos is not None and is_neg is not None:
+        handles.append(shade_cycles(ax, x, *_find_runs(is_pos), 'C2'))
+        handles.append(shade_cycles(ax, x, *_find_runs(is_neg), 'C3'))
+        labels += ['Charge cycles', 'Discharge cycles']
+
+    plt.ylabel('Current I / mA')
+    plt.xlabel('Sample Number')
+    plt.legend(handles, labels, loc='center left', bbox_to_anchor=(1, 0.5))
+    plt.tight_layout()
+
+
 def variable_current_thresh_diagnostic(current, thresh, is_pos, is_neg):
     """
     Plots the current data with positive and negative threshold lines
@@ -189,25 +874,9 @@ def variable_current_thresh_diagnostic(current, thresh, is_pos, is_neg):
     """
     posthresh = thresh
     negthresh = -1*thresh
-    plt.figure(figsize=(9, 4))
-    ax = plt.subplot(111)
-    ax.plot(current, 'k')
-    x = np.arange(1, len(current)+1)
-    ax.plot(x,
-            posthresh * np.ones((len(current))), 'r')
-    ax.plot(x,
-            negthresh * np.ones((len(current))), 'b')
-    if is_pos is not None and is_neg is not None:
-        ax.fill_between(x, np.max(current)*is_pos, np.min(current)*is_pos,
-                        where=(is_pos), color='C2', alpha=0.3)
-        ax.fill_between(x, np.max(current)*is_neg, np.min(current)*is_neg,
-                        where=(is_neg), color='C3', alpha=0.3)
-        
-    plt.ylabel('Current I / mA')
-    plt.xlabel('Sample Number')
-    plt.legend(['Current',f'Chosen charge threshold\n({posthresh} mA)', f'Chosen discharge threshold\n({negthresh} mA)',
-                'Charge cycles', 'Discharge cycles'],loc='center left', bbox_to_anchor=(1, 0.5))
-    plt.tight_layout()
+    plot_thresh_diagnostic(current, posthresh, negthresh, is_pos, is_neg,
+                           [f'Chosen charge threshold\n({posthresh} mA)',
+                            f'Chosen discharge threshold\n({negthresh} mA)'])
     # plt.savefig('variable_current_thresh_diagnostic.png', dpi=600)
 
 def const_current_thresh_diagnostic(current, posthresh, negthresh, is_pos, is_neg):
@@ -222,26 +891,8 @@ def const_current_thresh_diagnostic(current, posthresh, negthresh, is_pos, is_ne
     is_pos (array-like): logical array indicating points within the charge cycle
     is_neg (array-like): logical array indicating points within the discharge cycle
     """
-    print(type(is_pos))
-    plt.figure(figsize=(9, 4))
-    ax = plt.subplot(111)
-    ax.plot(current, 'k')
-    x = np.arange(1, len(current)+1)
-    ax.plot(x,
-            posthresh * np.ones((len(current))), 'r')
-    ax.plot(x,
-            negthresh * np.ones((len(current))), 'b')
-    if is_pos is not None and is_neg is not None:
-        ax.fill_between(x, np.max(current)*is_pos, np.min(current)*is_pos,
-                        where=(is_pos), color='C2', alpha=0.3)
-        ax.fill_between(x, np.max(current)*is_neg, np.min(current)*is_neg,
-                        where=(is_neg), color='C3', alpha=0.3)
-        
-    plt.ylabel('Current I / mA')
-    plt.xlabel('Sample Number')
-    plt.legend(['Current','Charge threshold\n0.98 of max', 'Discharge threshold\n0.98 of min',
-                'Charge cycles', 'Discharge cycles'],loc='center left', bbox_to_anchor=(1, 0.5))
-    plt.tight_layout()
+    plot_thresh_diagnostic(current, posthresh, negthresh, is_pos, is_neg,
+                           ['Charge threshold\n0.98 of max', 'Discharge threshold\n0.98 of min'])
     # plt.savefig('const_current_thresh_diagnostic.png', dpi=600)
 
 def check_min_curr_correct(incycle_thresh):
@@ -273,8 +924,7 @@ def check_min_curr_correct(incycle_thresh):
         incycle_thresh_valid = check_valid_number(incycle_thresh_input)
 
         if not(incycle_thresh_valid):
-            tk.messagebox.showerror(title=None,
-                                    message="Enter a valid number!")
+            show_error("Enter a valid number!")
 
     if 'root' in locals():
         root.destroy()
@@ -282,7 +932,28 @@ def check_min_curr_correct(incycle_thresh):
 
     return incycle_thresh
 
-def current_thresholds(current, rel_cutoff=0.98, is_constant=True):
+def get_incycle_thresh(current, absgrad=None):
+    """
+    Suggests the current threshold for variable currents and asks the user to confirm it
+    (unless dialogs are switched off).
+
+    Parameters:
+    current (array-like): An array of current values.
+    absgrad (array-like): The absolute change in current between samples, if already known.
+
+    Returns:
+    incycle_thresh (float): The current threshold.
+    """
+    if absgrad is None:
+        absgrad = np.abs(find_edges(current))
+    incycle_thresh = np.min(np.unique(absgrad[absgrad > 0]))
+
+    if SHOW_DIALOGS:
+        incycle_thresh = call_in_gui(check_min_curr_correct, incycle_thresh)
+    return incycle_thresh
+
+
+def current_thresholds(current, rel_cutoff=0.98, is_constant=True, incycle_thresh=None):
     """
     Find positive and negative current thresholds based on input current data.
 
@@ -290,6 +961,8 @@ def current_thresholds(current, rel_cutoff=0.98, is_constant=True):
     current (array-like): An array of current values.
     rel_cutoff (float): A relative cutoff value for finding the current thresholds.
     is_constant (bool): A boolean value indicating whether the current is constant or not.
+    incycle_thresh (float): Threshold for variable currents (mA). If None, the user is asked
+        to confirm the suggested value (or it is used as is when dialogs are switched off).
 
     Returns:
     is_pos (array-like): Boolean array indicating whether a data point is in a positive cycle.
@@ -305,13 +978,12 @@ def current_thresholds(current, rel_cutoff=0.98, is_constant=True):
         is_pos = pos_cycles != 0
         is_neg = neg_cycles != 0
 
-        const_current_thresh_diagnostic(current,posthresh,negthresh, is_pos, is_neg)
+        call_in_gui(const_current_thresh_diagnostic, current, posthresh, negthresh, is_pos, is_neg)
     else:
         absgrad = np.abs(find_edges(current))
 
-        incycle_thresh = np.min(np.unique(absgrad[absgrad > 0]))
-
-        incycle_thresh = check_min_curr_correct(incycle_thresh)
+        if incycle_thresh is None:
+            incycle_thresh = get_incycle_thresh(current, absgrad)
         logging.warning(f"Assuming variable current.\n Using {incycle_thresh} as threshold.")
         in_cycle = absgrad < incycle_thresh
 
@@ -331,7 +1003,7 @@ def current_thresholds(current, rel_cutoff=0.98, is_constant=True):
         is_pos = signed_in_cycle == 1
         is_neg = signed_in_cycle == -1
 
-        variable_current_thresh_diagnostic(current, incycle_thresh, is_pos, is_neg)
+        call_in_gui(variable_current_thresh_diagnostic, current, incycle_thresh, is_pos, is_neg)
 
     return is_pos, is_neg
 
@@ -350,156 +1022,292 @@ def find_edges(is_incycle):
     return edge
 
 
-def get_cycle_counts(time, is_pos, is_neg):
+def _find_runs(is_incycle):
     """
-    Find the number of positive and negative cycles in the input data.
+    Find the runs of consecutive True values in a boolean array.
 
     Parameters:
-    time (array-like): An array of time values.
-    is_pos (array-like): Boolean array indicating whether a data point is in a positive cycle.
-    is_neg (array-like): Boolean array indicating whether a data point is in a negative cycle.
+    is_incycle (array-like): Boolean array indicating whether a data point is in a cycle.
 
     Returns:
-    pos_count (int): The number of positive cycles.
-    neg_count (int): The number of negative cycles.
-    pos_cycle_no (array-like): An array of positive cycle numbers.
-    neg_cycle_no (array-like): An array of negative cycle numbers.
+    starts (ndarray): Offset of the first sample of each run.
+    stops (ndarray): Offset one past the last sample of each run.
+    """
+    flags = np.asarray(is_incycle, dtype=bool)
+    padded = np.concatenate(([False], flags, [False]))
+    change = np.flatnonzero(padded[1:] != padded[:-1])
+    return change[0::2], change[1::2]
+
+
+def _runs_to_segments(starts, stops, n_samples):
+    """
+    Convert runs of in-cycle samples into the samples assigned to each cycle.
+
+    Every cycle is also given the sample two before its first in-cycle sample
+    (the "lead" sample), as the original per-sample loop did. When two runs are
+    separated by a single sample, this lead overwrites the last sample of the
+    previous run. For runs starting at sample 0 or 1 the lead wraps around to
+    the end of the record, and is only kept if that sample is not itself part
+    of a run.
+
+    Parameters:
+    starts (ndarray): Offset of the first sample of each run.
+    stops (ndarray): Offset one past the last sample of each run.
+    n_samples (int): Total number of samples in the record.
+
+    Returns:
+    leads (ndarray): Offset of the lead sample of each run (-1 if there is none).
+    stops (ndarray): Effective stop offset of each run.
     """
-    pos_edge, neg_edge = find_edges(is_pos), find_edges(is_neg)
+    starts = np.asarray(starts, dtype=np.int64)
+    orig_stops = np.asarray(stops, dtype=np.int64)
+    leads = starts - 2
+
+    stops = orig_stops.copy()
+    stolen = np.zeros(len(starts), dtype=bool)
+    stolen[:-1] = leads[1:] == orig_stops[:-1] - 1
+    stops[stolen] -= 1
+
+    wrapped = np.flatnonzero(leads < 0)
+    if wrapped.size:
+        wrapped_leads = leads[wrapped] + n_samples
+        run_idx = np.searchsorted(starts, wrapped_leads, side='right') - 1
+        in_run = (run_idx >= 0) & (wrapped_leads < orig_stops[np.maximum(run_idx, 0)])
+        wrapped_leads[in_run | (wrapped_leads < 0)] = -1
+        leads[wrapped] = wrapped_leads
+
+    return leads, stops
+
 
-    pos_cycle_no = np.zeros(time.shape)*np.nan
-    pos_count = 0
-    neg_cycle_no = np.zeros(time.shape)*np.nan
-    neg_count = 0
+def segments_from_runs(pos_starts, pos_stops, neg_starts, neg_stops, n_samples):
+    """
+    Pairs up charge and discharge runs and builds the segment table.
 
-    for i, _ in enumerate(time):
-        if is_pos[i]:
-            if pos_edge[i] == 1:
-                pos_count += 1
-                pos_cycle_no[i-2] = pos_count
-            pos_cycle_no[i] = pos_count
+    Parameters:
+    pos_starts, pos_stops (array-like): Start and stop offsets of the positive runs.
+    neg_starts, neg_stops (array-like): Start and stop offsets of the negative runs.
+    n_samples (int): Total number of samples in the record.
 
-        if is_neg[i]:
-            if neg_edge[i] == 1:
-                neg_count += 1
-                neg_cycle_no[i-2] = neg_count
-            neg_cycle_no[i] = neg_count
+    Returns:
+    pos_count (int): The number of positive cycles.
+    neg_count (int): The number of negative cycles.
+    segments (pandas.DataFrame): The segment table (see get_cycle_segments).
+    """
+    pos_count, neg_count = len(pos_starts), len(neg_starts)
 
-    print("Number of neg cycles = %d \nNumber of pos cycles = %d" %
-          (neg_count, pos_count))
     logging.warning(f"Found {pos_count} charge and {neg_count} discharge cycles.")
 
     if (pos_count == 0) or (neg_count == 0):
         logging.error("Insufficient number of cycles to ensure charge/discharge pairs for each cycle.")
-        tk.messagebox.showerror(title=None,
-                                    message=f"Insufficient number of cycles!\n({pos_count} positive and {neg_count} negative cycles found)")
+        show_error(f"Insufficient number of cycles!\n({pos_count} positive and {neg_count} negative cycles found)")
         raise Exception("Insufficient number of cycles to ensure charge/discharge pairs for each cycle.")
     if not pos_count == neg_count:
         logging.warning(f"Discarding cycles to ensure charge/discharge pairs for each cycle.")
 
-    if pos_count > neg_count:
-        pos_cycle_no[pos_cycle_no > neg_count] = np.nan
-        pos_count = neg_count
-    elif pos_count < neg_count:
-        neg_cycle_no[neg_cycle_no > pos_count] = np.nan
-        neg_count = pos_count
+    pos_leads, pos_stops = _runs_to_segments(pos_starts, pos_stops, n_samples)
+    neg_leads, neg_stops = _runs_to_segments(neg_starts, neg_stops, n_samples)
 
-    print("Number of neg cycles = %d \nNumber of pos cycles = %d" % (
-        np.nanmax(neg_cycle_no), np.nanmax(pos_cycle_no)))
+    n_pairs = min(pos_count, neg_count)
+    cycle = np.arange(1, n_pairs+1)
+    segments = pd.DataFrame({
+        'cycle': np.concatenate((cycle, cycle)),
+        'direction': np.repeat(['C', 'D'], n_pairs),
+        'lead': np.concatenate((pos_leads[:n_pairs], neg_leads[:n_pairs])),
+        'start': np.concatenate((pos_starts[:n_pairs], neg_starts[:n_pairs])),
+        'stop': np.concatenate((pos_stops[:n_pairs], neg_stops[:n_pairs]))})
 
-    return pos_count, neg_count, pos_cycle_no, neg_cycle_no
+    return n_pairs, n_pairs, segments
 
 
-def create_data_frame(file=None, active_mass=None, is_constant=True, do_parquet=False):
+def get_cycle_segments(is_pos, is_neg):
     """
-    Creates a Pandas DataFrame containing the cycling data from an input file.
+    Find the charge and discharge cycles in the input data as a segment table.
 
     Parameters:
-    file (str): The name of the input file containing the cycling data.
-    active_mass (float): The active mass of the electrode material in grams.
-    is_constant (bool): A boolean indicating whether or not the cycling current is constant.
-    do_parquet (bool): A boolean indicating whether or not to save the output in the Parquet format.
+    is_pos (array-like): Boolean array indicating whether a data point is in a positive cycle.
+    is_neg (array-like): Boolean array indicating whether a data point is in a negative cycle.
 
     Returns:
-    out_df (pandas.DataFrame): The cycling data as a Pandas DataFrame.
-    filename (str): The name of the input file.
-    save_dir (str): The path to the directory where the output file(s) will be saved.
-    pos_count (int): The number of positive cycles in the input data.
-    neg_count (int): The number of negative cycles in the input data.
+    pos_count (int): The number of positive cycles.
+    neg_count (int): The number of negative cycles.
+    segments (pandas.DataFrame): One row per cycle with columns 'cycle', 'direction'
+        ('C' for charge, 'D' for discharge), 'lead', 'start' and 'stop'. The samples
+        of a cycle are the lead sample (if 'lead' is not -1) and the samples in
+        [start, stop), in order of their position in the record.
+    """
+    pos_starts, pos_stops = _find_runs(is_pos)
+    neg_starts, neg_stops = _find_runs(is_neg)
+    return segments_from_runs(pos_starts, pos_stops, neg_starts, neg_stops, len(is_pos))
+
+
+def cycle_numbers_from_segments(segments, n_samples, direction):
     """
+    Label each sample with the number of the cycle it belongs to.
 
-    file, data, active_mass = data_from_file(file, active_mass)
+    Parameters:
+    segments (pandas.DataFrame): The segment table from get_cycle_segments.
+    n_samples (int): Total number of samples in the record.
+    direction (str): 'C' for charge or 'D' for discharge cycles.
 
-    (potential,
-     time, current) = parse_data(data)
+    Returns:
+    cycle_no (ndarray): Cycle number of each sample (NaN outside of cycles).
+    """
+    cycle_no = np.full(n_samples, np.nan)
+    segs = segments[segments['direction'] == direction]
+    for cycle, lead, start, stop in zip(segs['cycle'], segs['lead'],
+                                        segs['start'], segs['stop']):
+        cycle_no[start:stop] = cycle
+        if lead >= 0:
+            cycle_no[lead] = cycle
+    return cycle_no
 
-#    grav_capacity = capacity / active_mass
 
-    is_pos, is_neg = current_thresholds(current, 0.98, is_constant)
+def get_cycle_counts(time, is_pos, is_neg):
+    """
+    Find the number of positive and negative cycles in the input data.
+
+    Parameters:
+    time (array-like): An array of time values.
+    is_pos (array-like): Boolean array indicating whether a data point is in a positive cycle.
+    is_neg (array-like): Boolean array indicating whether a data point is in a negative cycle.
+
+    Returns:
+    pos_count (int): The number of positive cycles.
+    neg_count (int): The number of negative cycles.
+    pos_cycle_no (array-like): An array of positive cycle numbers.
+    neg_cycle_no (array-like): An array of negative cycle numbers.
+    """
+    pos_count, neg_count, segments = get_cycle_segments(is_pos, is_neg)
+
+    pos_cycle_no = cycle_numbers_from_segments(segments, len(time), 'C')
+    neg_cycle_no = cycle_numbers_from_segments(segments, len(time), 'D')
+
+    return pos_count, neg_count, pos_cycle_no, neg_cycle_no
 
-    # pos_edge,neg_edge = find_edges(is_pos),find_edges(is_neg)
 
-    (pos_count, neg_count,
-     pos_cycle_no, neg_cycle_no) = get_cycle_counts(time, is_pos, is_neg)
-    logging.warning(f"Assuming {pos_count} charge and {neg_count} discharge cycles.")
+def segment_sample_indices(segments):
+    """
+    Lists the record offsets of the samples of every cycle, one cycle after the other.
 
-    all_data = dict()
+    Parameters:
+    segments (pandas.DataFrame): The segment table from get_cycle_segments. The cycles
+        are listed in the order of its rows.
+
+    Returns:
+    idx (ndarray): The record offset of each sample, in the order of the cycles. The lead
+        sample of a cycle comes first, or last if it wrapped around to the end of the record.
+    first (ndarray): The position in idx of the first sample of each cycle.
+    lengths (ndarray): The number of samples of each cycle.
+    """
+    leads = segments['lead'].to_numpy()
+    starts = segments['start'].to_numpy()
+    stops = segments['stop'].to_numpy()
+    front = (leads >= 0) & (leads < starts)
+    back = leads >= stops
+    lengths = stops - starts + (leads >= 0)
+    first = np.cumsum(lengths) - lengths
+
+    idx = np.arange(int(lengths.sum()), dtype=np.int64)
+    idx += np.repeat(starts - front - first, lengths)
+    idx[first[front]] = leads[front]
+    idx[(first + lengths - 1)[back]] = leads[back]
+    return idx, first, lengths
+
+
+def wrapped_lead_positions(segments, first, lengths):
+    """
+    Finds the lead samples that wrapped around to the end of the record, for runs starting
+    at the first or second sample (see _runs_to_segments).
 
-    time_head = "Elapsed_time/s"
-    potential_head = "Ecell/V"
-    capacity_head = "Capacity/mA.h.g^-1"
-    for cn in range(pos_count):
-        exp_time = np.array(time[pos_cycle_no == cn+1].values, ndmin=1).T
-        cyc_time = exp_time - exp_time[0]
-        cyc_pot = np.array(potential[pos_cycle_no == cn+1].values, ndmin=1).T
-        cyc_current = np.array(current[pos_cycle_no == cn+1].values, ndmin=1).T
-        cyc_capacity = (cyc_time*cyc_current)/(3600*active_mass)
+    Parameters:
+    segments (pandas.DataFrame): The segment table, in the order given to segment_sample_indices.
+    first (ndarray): The position of the first sample of each cycle, from segment_sample_indices.
+    lengths (ndarray): The number of samples of each cycle, from segment_sample_indices.
 
-        ct_name = time_head + "(C" + str(cn+1) + ")"
-        all_data[ct_name] = cyc_time
+    Returns:
+    ndarray: The positions of the wrapped lead samples, the last sample of their cycles.
+    """
+    back = (segments['lead'] >= segments['stop']).to_numpy()
+    return (first + lengths - 1)[back]
 
-        cyc_cap_name = capacity_head + "(C" + str(cn+1) + ")"
-        all_data[cyc_cap_name] = cyc_capacity
 
-        cyc_pot_name = potential_head + "(C" + str(cn+1) + ")"
-        all_data[cyc_pot_name] = cyc_pot
+def integrate_capacity(cyc_time, cyc_current, first, capacity_method=None, wrapped=None):
+    """
+    Calculates the charge passed since the start of each cycle, for all cycles at once.
 
-    for cn in range(neg_count):
-        exp_time = np.array(time[neg_cycle_no == cn+1].values, ndmin=1).T
-        cyc_time = exp_time - exp_time[0]
-        cyc_pot = np.array(potential[neg_cycle_no == cn+1].values, ndmin=1).T
-        cyc_current = np.array(current[neg_cycle_no == cn+1].values, ndmin=1).T
-        cyc_capacity = -1*(cyc_time*cyc_current)/(3600*active_mass)
+    Parameters:
+    cyc_time (ndarray): The elapsed time of each sample, one cycle after the other.
+    cyc_current (ndarray): The current of each sample in mA, in the same order.
+    first (ndarray): The position of the first sample of each cycle.
+    capacity_method (str): "trapezoid" for the cumulative trapezoidal integral of the current
+        over time, restarting at zero at the first sample of each cycle, or "legacy" for the
+        current of each sample times its elapsed time, as in earlier versions (which is only
+        exact for a constant current). Defaults to CAPACITY_METHOD.
+    wrapped (array-like): The positions of lead samples that wrapped around from the end of
+        the record (see wrapped_lead_positions). Their time is not next to that of the previous
+        sample, so they add no charge in the trapezoid method.
 
-        ct_name = time_head + "(D" + str(cn+1) + ")"
-        all_data[ct_name] = cyc_time
+    Returns:
+    charge (ndarray): The charge passed in mA.s.
+    """
+    if capacity_method is None:
+        capacity_method = CAPACITY_METHOD
+    if capacity_method == "legacy":
+        return cyc_current * cyc_time
+    if capacity_method != "trapezoid":
+        raise ValueError(f"Unknown capacity method {capacity_method!r}, "
+                         f"expected one of {CAPACITY_METHODS}.")
+
+    steps = np.zeros(len(cyc_time))
+    steps[1:] = 0.5 * (cyc_current[1:] + cyc_current[:-1]) * np.diff(cyc_time)
+    # samples without a current or time add no charge
+    steps[np.isnan(steps)] = 0
+    steps[first] = 0
+    if wrapped is not None:
+        steps[wrapped] = 0
+    charge = np.cumsum(steps)
+    lengths = np.diff(np.append(first, len(steps)))
+    charge -= np.repeat(charge[first], lengths)
+    return charge
+
+
+def cycles_to_frame(time, potential, current, segments, active_mass, capacity_method=None):
+    """
+    Builds the cycling DataFrame with one time, capacity and potential column per cycle.
 
-        cyc_cap_name = capacity_head + "(D" + str(cn+1) + ")"
-        all_data[cyc_cap_name] = cyc_capacity
+    The samples of all cycles are gathered and their capacities integrated at once (see
+    cycles_to_result), and then scattered into a single NaN-padded output buffer, so the
+    cost is linear in the number of samples.
 
-        cyc_pot_name = potential_head + "(D" + str(cn+1) + ")"
-        all_data[cyc_pot_name] = cyc_pot
+    Parameters:
+    time (array-like): An array of time values.
+    potential (array-like): An array of potential values.
+    current (array-like): An array of current values.
+    segments (pandas.DataFrame): The segment table from get_cycle_segments.
+    active_mass (float): The active mass of the electrode material in grams.
+    capacity_method (str): How the capacity is calculated (see integrate_capacity).
 
-    length = np.array([])
+    Returns:
+    out_df (pandas.DataFrame): The cycling data as a Pandas DataFrame.
+    """
+    result = cycles_to_result(time, potential, current, segments, active_mass, capacity_method)
+    return result.to_wide_frame()
 
-    for col in all_data:
-        arr = all_data[col]
-        sh = np.shape(arr)
-        length = np.append(length, sh[0])
 
-    max_length = np.max(length)
+def make_save_dir(file):
+    """
+    Creates the output directory for an input file if it does not exist yet.
 
-    for i, col in enumerate(all_data):
-        buffer = np.zeros(int(round(max_length)))*np.nan
-        orig_len = np.max(np.shape(all_data[col]))
-        buffer[0:orig_len] = all_data[col]
-        all_data[col] = buffer
+    Parameters:
+    file (str): The name of the input file containing the cycling data.
 
-    save_dir = file[0:-4] + "_OUTPUTS"
+    Returns:
+    save_dir (str): The path to the directory where the output file(s) will be saved.
+    """
+    save_dir = os.path.splitext(file)[0] + "_OUTPUTS"
     # print(f"Path length is {len(save_dir)}")
     if len(save_dir) >= 200:
-        tk.messagebox.showerror(title=None,
-                                message="Your chosen file path is likely too long.\nChose a shorter filename or save your data on a USB drive to shorten the path.")
+        show_error("Your chosen file path is likely too long.\nChose a shorter filename or save your data on a USB drive to shorten the path.")
         raise ValueError('Path lenght is too long.')
     try:
 
@@ -507,33 +1315,548 @@ def create_data_frame(file=None, active_mass=None, is_constant=True, do_parquet=
 
     except FileExistsError:
         pass
+    return save_dir
+
+
+def offsets_from_segments(segments):
+    """
+    Builds the offsets index of the long layout from a segment table.
+
+    Parameters:
+    segments (pandas.DataFrame): The segment table from get_cycle_segments.
+
+    Returns:
+    offsets (pandas.DataFrame): One row per cycle, in the order of the long layout
+        (by cycle, charge before discharge), with columns 'cycle', 'direction',
+        'start' and 'stop' giving the rows [start, stop) of the cycle in the long table.
+    """
+    segments = segments.sort_values(['cycle', 'direction'], kind='stable')
+    lengths = (segments['stop'] - segments['start'] + (segments['lead'] >= 0)).to_numpy()
+    stops = np.cumsum(lengths)
+    return pd.DataFrame({'cycle': segments['cycle'].to_numpy(),
+                         'direction': segments['direction'].to_numpy(),
+                         'start': stops - lengths,
+                         'stop': stops})
+
+
+def cycles_to_result(time, potential, current, segments, active_mass, capacity_method=None):
+    """
+    Gathers the samples of all cycles into a CyclingResult, in the order of the long layout.
+
+    Parameters:
+    time (array-like): An array of time values.
+    potential (array-like): An array of potential values.
+    current (array-like): An array of current values.
+    segments (pandas.DataFrame): The segment table from get_cycle_segments.
+    active_mass (float): The active mass of the electrode material in grams.
+    capacity_method (str): How the capacity is calculated (see integrate_capacity).
+
+    Returns:
+    CyclingResult: The cycling data.
+    """
+    time = np.asarray(time)
+    potential = np.asarray(potential)
+    current = np.asarray(current)
+
+    segments = segments.sort_values(['cycle', 'direction'], kind='stable')
+    offsets = offsets_from_segments(segments)
+    idx, first, lengths = segment_sample_indices(segments)
+    wrapped = wrapped_lead_positions(segments, first, lengths)
+
+    cyc_time = time[idx]
+    if len(idx):
+        cyc_time -= np.repeat(cyc_time[first], lengths)
+    is_charge = (offsets['direction'] == 'C').to_numpy()
+    scale = np.where(is_charge, 3600*active_mass, -(3600*active_mass))
+    cyc_capacity = integrate_capacity(cyc_time, current[idx], first, capacity_method, wrapped)
+    cyc_capacity /= np.repeat(scale, lengths)
+
+    return CyclingResult(cyc_time, cyc_capacity, potential[idx], offsets,
+                         active_mass=active_mass,
+                         capacity_method=capacity_method or CAPACITY_METHOD, wrapped=wrapped)
+
+
+def cycles_to_long_frame(time, potential, current, segments, active_mass, capacity_method=None):
+    """
+    Builds the cycling DataFrame in the long layout, with one row per sample of each cycle.
+
+    Unlike cycles_to_frame, cycles are not padded to a common length, so the size of
+    the frame scales with the number of samples rather than cycles x longest cycle.
+
+    Parameters:
+    time (array-like): An array of time values.
+    potential (array-like): An array of potential values.
+    current (array-like): An array of current values.
+    segments (pandas.DataFrame): The segment table from get_cycle_segments.
+    active_mass (float): The active mass of the electrode material in grams.
+    capacity_method (str): How the capacity is calculated (see integrate_capacity).
+
+    Returns:
+    out_df (pandas.DataFrame): The cycling data with the columns in LONG_COLUMNS.
+    offsets (pandas.DataFrame): The offsets index of the cycles (see offsets_from_segments).
+    """
+    result = cycles_to_result(time, potential, current, segments, active_mass, capacity_method)
+    return result.to_long_frame(), result.offsets
+
+
+class CyclingResult:
+    """
+    The cycling data of a run as contiguous arrays, with the rows of each cycle and the
+    settings of the run.
+
+    The samples of all cycles are held one cycle after the other, in the order of the long
+    layout (by cycle, charge before discharge). The rows of a cycle are found in a dictionary,
+    so any cycle is fetched in constant time as views of the buffers:
+
+        time, capacity, potential = result.charge(1500)
+    """
+
+    __slots__ = ('time', 'capacity', 'potential', 'cycle', 'direction', 'start', 'stop',
+                 'wrapped', 'active_mass', 'capacity_method', 'file', '_rows')
+
+    def __init__(self, time, capacity, potential, offsets, active_mass=None,
+                 capacity_method=None, file=None, wrapped=None):
+        """Initialize the result from the sample buffers and the rows of each cycle.
+
+        Parameters:
+        time (array-like): The elapsed time of each sample.
+        capacity (array-like): The capacity of each sample (mA.h.g^-1).
+        potential (array-like): The potential of each sample (V).
+        offsets (pandas.DataFrame): One row per cycle with the columns 'cycle',
+            'direction', 'start' and 'stop' giving the samples [start, stop) of the cycle.
+        active_mass (float, optional): The active mass in grams.
+        capacity_method (str, optional): How the capacity was calculated.
+        file (str, optional): The data file.
+        wrapped (array-like, optional): The positions of lead samples that wrapped around
+            from the end of the record, the last sample of their cycles (see
+            wrapped_lead_positions).
+        """
+        self.time = np.ascontiguousarray(time, dtype=np.float64)
+        self.capacity = np.ascontiguousarray(capacity, dtype=np.float64)
+        self.potential = np.ascontiguousarray(potential, dtype=np.float64)
+        self.cycle = offsets['cycle'].to_numpy(dtype=np.int64)
+        self.direction = np.asarray(offsets['direction']).astype('U1')
+        self.start = offsets['start'].to_numpy(dtype=np.int64)
+        self.stop = offsets['stop'].to_numpy(dtype=np.int64)
+        self.wrapped = np.asarray([] if wrapped is None else wrapped, dtype=np.int64)
+        self.active_mass = active_mass
+        self.capacity_method = capacity_method
+        self.file = file
+        self._rows = {(cycle, direction): i for i, (cycle, direction)
+                      in enumerate(zip(self.cycle.tolist(), self.direction.tolist()))}
+
+    @classmethod
+    def from_frame(cls, out_df, **metadata):
+        """
+        Creates the result of a cycling DataFrame.
+
+        Parameters:
+        out_df (pandas.DataFrame): The cycling data (wide or long layout).
+        **metadata: active_mass, capacity_method and file (see __init__).
+
+        Returns:
+        CyclingResult: The cycling data.
+        """
+        if is_long_frame(out_df):
+            time_head, capacity_head, potential_head = LONG_COLUMNS[2:]
+            return cls(out_df[time_head].to_numpy(dtype=float),
+                       out_df[capacity_head].to_numpy(dtype=float),
+                       out_df[potential_head].to_numpy(dtype=float),
+                       long_offsets(out_df), **metadata)
+        index, time, capacity, potential = wide_cycle_arrays(out_df)
+        return cls(time, capacity, potential, index, **metadata)
+
+    @property
+    def pos_count(self):
+        """The number of charge cycles."""
+        return int(np.count_nonzero(self.direction == 'C'))
+
+    @property
+    def neg_count(self):
+        """The number of discharge cycles."""
+        return int(np.count_nonzero(self.direction == 'D'))
+
+    @property
+    def offsets(self):
+        """The rows of each cycle, as a DataFrame with the columns 'cycle', 'direction', 'start' and 'stop'."""
+        return pd.DataFrame({'cycle': self.cycle, 'direction': self.direction,
+                             'start': self.start, 'stop': self.stop})
+
+    def __contains__(self, cycle):
+        """Return whether the charge or discharge of a cycle is in the result."""
+        return (cycle, 'C') in self._rows or (cycle, 'D') in self._rows
+
+    def rows(self, cycle, direction):
+        """
+        Returns the rows of the charge ('C') or discharge ('D') of a cycle.
+
+        Raises:
+        KeyError: If the cycle is not in the result.
+        """
+        i = self._rows[(int(cycle), direction)]
+        return slice(self.start[i], self.stop[i])
+
+    def charge(self, cycle):
+        """Return the time, capacity and potential of the charge of a cycle (views of the buffers)."""
+        rows = self.rows(cycle, 'C')
+        return self.time[rows], self.capacity[rows], self.potential[rows]
+
+    def discharge(self, cycle):
+        """Return the time, capacity and potential of the discharge of a cycle (views of the buffers)."""
+        rows = self.rows(cycle, 'D')
+        return self.time[rows], self.capacity[rows], self.potential[rows]
+
+    def max_capacity(self, direction):
+        """Return the maximum capacity of each cycle in one direction, by cycle number."""
+        select = np.flatnonzero(self.direction == direction)
+        select = select[np.argsort(self.cycle[select], kind='stable')]
+        if len(select) == 0:
+            return np.zeros(0)
+        return np.fmax.reduceat(self.capacity, self.start)[select]
+
+    def to_long_frame(self):
+        """Return the cycling data in the long layout (see LONG_COLUMNS), sharing the buffers."""
+        lengths = self.stop - self.start
+        time_head, capacity_head, potential_head = LONG_COLUMNS[2:]
+        return pd.DataFrame({
+            'cycle': np.repeat(self.cycle, lengths),
+            'direction': pd.Categorical.from_codes(
+                np.repeat(np.where(self.direction == 'C', 0, 1), lengths), categories=['C', 'D']),
+            time_head: self.time,
+            capacity_head: self.capacity,
+            potential_head: self.potential}, copy=False)
+
+    def to_wide_frame(self):
+        """
+        Return the cycling data in the wide layout, with one NaN-padded time, capacity and
+        potential column per cycle: the charges first and then the discharges, by cycle number.
+        """
+        time_head, capacity_head, potential_head = LONG_COLUMNS[2:]
+        order = np.lexsort((self.cycle, self.direction))
+        lengths = (self.stop - self.start)[order]
+        max_length = int(np.max(lengths)) if len(lengths) else 0
+
+        # position of each sample in the time column of its cycle, in the Fortran-ordered buffer
+        idx = np.arange(int(lengths.sum()), dtype=np.int64)
+        first = np.cumsum(lengths) - lengths
+        idx += np.repeat(self.start[order] - first, lengths)
+        buffer = np.full((max_length, 3*len(order)), np.nan, order='F')
+        flat = buffer.reshape(-1, order='F')
+        pos = (np.arange(len(idx)) - np.repeat(first, lengths) +
+               np.repeat(3*max_length*np.arange(len(order)), lengths))
+        flat[pos] = self.time[idx]
+        flat[pos + max_length] = self.capacity[idx]
+        flat[pos + 2*max_length] = self.potential[idx]
+
+        columns = []
+        for cycle, direction in zip(self.cycle[order], self.direction[order]):
+            suffix = "(" + direction + str(cycle) + ")"
+            columns += [time_head + suffix, capacity_head + suffix, potential_head + suffix]
+        return pd.DataFrame(buffer, columns=columns, copy=False)
+
+
+def is_long_frame(out_df):
+    """
+    Checks whether a cycling DataFrame is in the long layout.
+
+    Parameters:
+    out_df (pandas.DataFrame): The cycling data.
+
+    Returns:
+    bool: True for the long layout, False for the wide (one column per cycle) layout.
+    """
+    return 'cycle' in out_df.columns and 'direction' in out_df.columns
+
+
+def long_offsets(out_df):
+    """
+    Finds the rows of each cycle in a cycling DataFrame in the long layout.
+
+    Parameters:
+    out_df (pandas.DataFrame): The cycling data in the long layout.
+
+    Returns:
+    offsets (pandas.DataFrame): One row per cycle with columns 'cycle', 'direction',
+        'start' and 'stop' giving the rows [start, stop) of the cycle.
+    """
+    cycle = out_df['cycle'].to_numpy()
+    direction = out_df['direction']
+    if isinstance(direction.dtype, pd.CategoricalDtype):
+        direction_key = direction.cat.codes.to_numpy()
+    else:
+        direction_key = direction.to_numpy() == 'C'
+    change = (cycle[1:] != cycle[:-1]) | (direction_key[1:] != direction_key[:-1])
+    starts = np.flatnonzero(np.concatenate(([len(cycle) > 0], change)))
+    stops = np.append(starts[1:], len(cycle))
+    return pd.DataFrame({'cycle': cycle[starts],
+                         'direction': np.asarray(direction)[starts],
+                         'start': starts,
+                         'stop': stops})
+
+
+def create_data_frame(file=None, active_mass=None, is_constant=True, do_parquet=False, layout="wide",
+                      incycle_thresh=None, capacity_method=None, return_result=False):
+    """
+    Creates a Pandas DataFrame containing the cycling data from an input file.
+
+    A test split over several files is analysed as one, with one continuous cycle numbering,
+    by passing the list of its files in order (see stitch_parts). The outputs are then named
+    after stitched_file. Only one part is held in memory while the data is read, but the
+    returned frame holds all cycles; use streaming.stream_data_frame to also write the
+    output in blocks.
+
+    Parameters:
+    file (str or list): The name of the input file containing the cycling data, or the names
+        of the parts of a test in order.
+    active_mass (float): The active mass of the electrode material in grams.
+    is_constant (bool): A boolean indicating whether or not the cycling current is constant.
+    do_parquet (bool): A boolean indicating whether or not to save the output in the Parquet format.
+    layout (str): "wide" for one NaN-padded time, capacity and potential column per cycle,
+        or "long" for one row per sample (see LONG_COLUMNS). The long layout is saved as
+        <name>_long.csv/.parquet together with its offsets index <name>_long_offsets.csv.
+    incycle_thresh (float): Current threshold (mA) for variable currents. If None, it is
+        suggested from the data (see current_thresholds).
+    capacity_method (str): How the capacity is calculated, "trapezoid" or "legacy" (see
+        integrate_capacity). Defaults to CAPACITY_METHOD.
+    return_result (bool): Also return the data as a CyclingResult, for fetching single cycles
+        without looking up columns by name.
+
+    Returns:
+    out_df (pandas.DataFrame): The cycling data as a Pandas DataFrame.
+    filename (str): The name of the input file (see stitched_file for several files).
+    save_dir (str): The path to the directory where the output file(s) will be saved.
+    pos_count (int): The number of positive cycles in the input data.
+    neg_count (int): The number of negative cycles in the input data.
+    result (CyclingResult): The cycling data as contiguous arrays, only if return_result is set.
+        For the long layout, the columns of out_df share its buffers.
+    """
+
+    if file is None:
+        file = select_file()
+    parts = None
+    if isinstance(file, (list, tuple)):
+        parts, file = (list(file) if len(file) > 1 else None), stitched_file(file)
+
+    workdir = None
+    try:
+        report_progress('Parsing the data file')
+        with run_report.stage('load_parsed'):
+            if parts is None:
+                (potential,
+                 time, current) = load_parsed(file)
+            else:
+                workdir = tempfile.mkdtemp(prefix='.stitch_', dir=make_save_dir(file))
+                potential, time, current = stitch_parts(parts, workdir)
+            run_report.record(rows=len(time))
+
+        active_mass = get_active_mass(active_mass)
+
+#    grav_capacity = capacity / active_mass
+
+        if not is_constant and incycle_thresh is None:
+            incycle_thresh = get_incycle_thresh(current)
+
+        # segments are cached per file and threshold settings
+        report_progress('Finding the cycles')
+        segments_tag = ('segments', is_constant, 0.98, incycle_thresh)
+        cached_segments = SESSION_CACHE.get(file, segments_tag) if parts is None else None
+        if cached_segments is None:
+            with run_report.stage('current_thresholds'):
+                is_pos, is_neg = current_thresholds(current, 0.98, is_constant, incycle_thresh)
+                run_report.record(rows=len(current))
+
+            # pos_edge,neg_edge = find_edges(is_pos),find_edges(is_neg)
+
+            with run_report.stage('get_cycle_segments'):
+                pos_count, neg_count, segments = get_cycle_segments(is_pos, is_neg)
+                run_report.record(cycles=pos_count)
+            if parts is None:
+                SESSION_CACHE.put(file, segments_tag, (pos_count, neg_count, segments))
+        else:
+            logging.warning("Using the cycles found in a previous run.")
+            pos_count, neg_count, segments = cached_segments
+        logging.warning(f"Assuming {pos_count} charge and {neg_count} discharge cycles.")
+
+        report_progress('Calculating the capacities')
+        with run_report.stage('cycles_to_result'):
+            result = cycles_to_result(time, potential, current, segments, active_mass,
+                                      capacity_method)
+            result.file = file
+            run_report.record(rows=len(result.time), cycles=pos_count)
+    finally:
+        if workdir is not None:
+            potential = time = current = is_pos = is_neg = None
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    save_dir = make_save_dir(file)
 
     filename = os.path.basename(file)
-    out_df = pd.DataFrame.from_dict(all_data, orient="columns")
 
-    if do_parquet:
-        out_df.to_parquet(os.path.join(save_dir, "%s%s" % (filename[0:-3], 'parquet')),
-                          index=True,
-                          engine=PARQUET_ENGINE,
-                          compression=PARQUET_COMPRESSION)
+    # the frame shares the buffers of the result in the long layout
+    if layout == "long":
+        out_df, offsets = result.to_long_frame(), result.offsets
     else:
-        out_df.to_csv(os.path.join(save_dir, "%s%s" % (filename[0:-3], 'csv')),
-                      index=True)
+        with run_report.stage('to_wide_frame'):
+            out_df = result.to_wide_frame()
+            run_report.record(rows=len(out_df), cycles=pos_count)
+
+    report_progress('Writing the output')
+    with run_report.stage('to_parquet' if do_parquet else 'to_csv'):
+        if layout == "long":
+            ext = 'parquet' if do_parquet else 'csv'
+            out_file = os.path.join(save_dir, "%s_long.%s" % (os.path.splitext(filename)[0], ext))
+            if do_parquet:
+                out_df.to_parquet(out_file, index=False, **parquet_kwargs(frame=out_df))
+            else:
+                out_df.to_csv(out_file, index=False)
+            offsets_file = os.path.join(save_dir, "%s_long_offsets.csv" % os.path.splitext(filename)[0])
+            offsets.to_csv(offsets_file, index=False)
+            run_report.add_file(offsets_file)
+        elif do_parquet:
+            out_file = os.path.join(save_dir, "%s.%s" % (os.path.splitext(filename)[0], 'parquet'))
+            out_df.to_parquet(out_file, index=True, **parquet_kwargs(frame=out_df))
+        else:
+            out_file = os.path.join(save_dir, "%s.%s" % (os.path.splitext(filename)[0], 'csv'))
+            out_df.to_csv(out_file, index=True)
+        run_report.add_file(out_file)
+        run_report.record(rows=len(out_df))
+    if return_result:
+        return out_df, filename, save_dir, pos_count, neg_count, result
     return out_df, filename, save_dir, pos_count, neg_count
 
 
-def create_cycles_separate(out_df, save_dir, do_parquet=False):
+def wide_cycle_arrays(out_df):
+    """
+    Returns the samples of all cycles of a wide-layout DataFrame as flat arrays, one cycle after the other.
+
+    Parameters:
+    out_df (pandas.DataFrame): The cycling data in the wide layout.
+
+    Returns:
+    index (pandas.DataFrame): One row per cycle, in the order of the columns, with the columns
+        'cycle', 'direction', 'start' and 'stop' giving the samples [start, stop) of the cycle.
+    time (ndarray): The elapsed time of each sample.
+    capacity (ndarray): The capacity of each sample.
+    potential (ndarray): The potential of each sample.
+    """
+    time_head, capacity_head, potential_head = LONG_COLUMNS[2:]
+    # cycles are NaN-padded columns with labels such as "Ecell/V(C1)"
+    labels = [col[len(time_head)+1:-1] for col in out_df.columns
+              if col.startswith(time_head + '(')]
+    columns = [out_df[[f"{head}({label})" for label in labels]].to_numpy(dtype=float).T
+               for head in (time_head, capacity_head, potential_head)]
+    lengths = np.count_nonzero(~np.isnan(columns[0]), axis=1)
+    in_cycle = np.arange(columns[0].shape[1]) < lengths[:, None]
+    stops = np.cumsum(lengths)
+    index = pd.DataFrame({'cycle': [int(label[1:]) for label in labels],
+                          'direction': [label[0] for label in labels],
+                          'start': stops - lengths,
+                          'stop': stops})
+    return (index, *(column[in_cycle] for column in columns))
+
+
+def to_long_frame(out_df):
+    """
+    Converts a cycling DataFrame to the long layout (see cycles_to_long_frame).
+
+    Parameters:
+    out_df (pandas.DataFrame): The cycling data (wide or long layout).
+
+    Returns:
+    pandas.DataFrame: The cycling data in the long layout. Long frames are returned unchanged.
+    """
+    if is_long_frame(out_df):
+        return out_df
+    index, time, capacity, potential = wide_cycle_arrays(out_df)
+    index = index.sort_values(['cycle', 'direction'], kind='stable')
+    lengths = (index['stop'] - index['start']).to_numpy()
+    first = np.cumsum(lengths) - lengths
+    idx = np.arange(int(lengths.sum())) + np.repeat(index['start'].to_numpy() - first, lengths)
+    is_charge = (index['direction'] == 'C').to_numpy()
+
+    time_head, capacity_head, potential_head = LONG_COLUMNS[2:]
+    return pd.DataFrame({
+        'cycle': np.repeat(index['cycle'].to_numpy(), lengths),
+        'direction': pd.Categorical.from_codes(np.repeat(np.where(is_charge, 0, 1), lengths),
+                                               categories=['C', 'D']),
+        time_head: time[idx],
+        capacity_head: capacity[idx],
+        potential_head: potential[idx]})
+
+
+def save_cycles_dataset(out_df, save_dir):
+    """
+    Saves all cycles to a single Parquet file in the long layout, with one row group per cycle.
+
+    The row groups carry the minimum and maximum cycle number in their statistics, so that
+    readers can load a single cycle without reading the others (see read_cycle). The row
+    group size setting does not apply to this file.
+
+    Parameters:
+    out_df (pandas.DataFrame): The cycling data (wide or long layout).
+    save_dir (str): The path to the directory where the file will be saved.
+
+    Returns:
+    path (str): The path of the saved file.
+    """
+    long_df = to_long_frame(out_df)
+    offsets = long_offsets(long_df)
+    cycle_rows = offsets.groupby('cycle', sort=True).agg(start=('start', 'min'),
+                                                         stop=('stop', 'max'))
+    path = os.path.join(save_dir, CYCLES_DATASET)
+    if PARQUET_ENGINE == 'pyarrow':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(long_df, preserve_index=False)
+        with pq.ParquetWriter(path, table.schema, **pyarrow_writer_kwargs()) as writer:
+            for k, (start, stop) in enumerate(zip(cycle_rows['start'], cycle_rows['stop'])):
+                report_progress('Writing the cycles', k, len(cycle_rows))
+                writer.write_table(table.slice(start, stop - start))
+    else:
+        report_progress('Writing the cycles', 0, len(cycle_rows))
+        long_df.to_parquet(path, index=False,
+                           **parquet_kwargs(row_groups=False, frame=long_df),
+                           row_group_offsets=cycle_rows['start'].tolist() or [0],
+                           stats=True)
+    run_report.add_file(path)
+    run_report.record(cycles=len(cycle_rows))
+    logging.warning(f"{len(cycle_rows)} cycles saved to {path}.")
+    return path
+
+
+def read_cycle(path, cycle):
+    """
+    Loads one cycle from a file saved by save_cycles_dataset, reading only its row group.
+
+    Parameters:
+    path (str): The path of the file.
+    cycle (int): The cycle number.
+
+    Returns:
+    pandas.DataFrame: The charge and discharge of the cycle in the long layout.
+    """
+    cycle_df = pd.read_parquet(path, engine=PARQUET_ENGINE, filters=[('cycle', '==', int(cycle))])
+    return cycle_df[cycle_df['cycle'] == int(cycle)].reset_index(drop=True)
+
+
+def create_cycles_separate(out_df, save_dir, do_parquet=False, single_file=False):
     """
     Splits the input DataFrame into separate DataFrames, one for each cycle, and saves each cycle as a separate file.
 
     Parameters:
-    out_df (pandas.DataFrame): The input DataFrame containing the cycling data.
+    out_df (pandas.DataFrame): The input DataFrame containing the cycling data (wide or long layout).
     save_dir (str): The path to the directory where the output file(s) will be saved.
     do_parquet (bool): A boolean indicating whether or not to save the output in the Parquet format.
+    single_file (bool): Save all cycles to one Parquet file with a row group per cycle instead
+        (see save_cycles_dataset).
 
     Returns:
     None
     """
+    if single_file:
+        save_cycles_dataset(out_df, save_dir)
+        return
+
     print('Saving individual cycles...')
     cycle_dir = save_dir + "/Individual Cycles"
     try:
@@ -541,27 +1864,53 @@ def create_cycles_separate(out_df, save_dir, do_parquet=False):
     except FileExistsError:
         pass
 
+    if is_long_frame(out_df):
+        offsets = long_offsets(out_df)
+        n_cycles = offsets['cycle'].nunique()
+        run_report.record(cycles=n_cycles)
+        for k, (cycle, group) in enumerate(offsets.groupby('cycle', sort=True)):
+            report_progress('Writing the cycles', k, n_cycles)
+            Cycle_x = pd.concat([out_df.iloc[start:stop] for start, stop
+                                 in zip(group['start'], group['stop'])])
+            if do_parquet:
+                cycle_file = os.path.join(cycle_dir, "Cycle_%d.parquet" % cycle)
+                Cycle_x.to_parquet(cycle_file, index=False, **parquet_kwargs(frame=Cycle_x))
+                run_report.add_file(cycle_file)
+                print(f"Cycle {cycle} saved as .parquet!")
+            else:
+                cycle_file = os.path.join(cycle_dir, "Cycle_%d.csv" % cycle)
+                Cycle_x.to_csv(cycle_file, index=False)
+                run_report.add_file(cycle_file)
+                print(f"Cycle {cycle} saved as .csv!")
+        return
+
+    run_report.record(cycles=len(out_df.columns)//6)
+
+    # group the columns by cycle in one pass over the column names
+    cycle_cols = {}
+    for col in out_df.columns:
+        label = col[col.rfind('(')+1:-1]
+        cycle_cols.setdefault(label[1:], {'C': [], 'D': []})[label[0]].append(col)
+
     for i in range(len(out_df.columns)//6):
+        report_progress('Writing the cycles', i, len(out_df.columns)//6)
 
-        match_C = '(C' + str(i+1) + ')'
-        current_charge_cols = [col for col in out_df.columns if match_C in col]
-        match_D = '(D' + str(i+1) + ')'
-        current_discharge_cols = [
-            col for col in out_df.columns if match_D in col]
-        usecols = current_charge_cols + current_discharge_cols
+        cols = cycle_cols.get(str(i+1), {'C': [], 'D': []})
+        usecols = cols['C'] + cols['D']
         Cycle_x = out_df[usecols]
 
         if do_parquet:
-            Cycle_x.to_parquet(os.path.join(cycle_dir, "Cycle_%d.parquet" % (i+1)),
-                               index=True,
-                               engine=PARQUET_ENGINE,
-                               compression=PARQUET_COMPRESSION)
+            cycle_file = os.path.join(cycle_dir, "Cycle_%d.parquet" % (i+1))
+            Cycle_x.to_parquet(cycle_file, index=True, **parquet_kwargs(frame=Cycle_x))
+            run_report.add_file(cycle_file)
             print(f"Cycle {i+1} saved as .parquet!")
         else:
-            Cycle_x.to_csv(os.path.join(cycle_dir, "Cycle_%d.csv" % (i+1)),
-                           index=True)
+            cycle_file = os.path.join(cycle_dir, "Cycle_%d.csv" % (i+1))
+            Cycle_x.to_csv(cycle_file, index=True)
+            run_report.add_file(cycle_file)
             print(f"Cycle {i+1} saved as .csv!")
 
 
 if __name__ == "__main__":
+    load_config()
     out_df, file, save_dir, _, _ = create_data_frame()
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface of GalvAnalyze for headless processing.
+
+Usage:
+    python GalvAnalyze.py batch <folder or glob> [--manifest manifest.csv] [options]
+    python GalvAnalyze.py follow <file> --mass <mg> [options]
+    python GalvAnalyze.py stitch <file> <file> ... --mass <mg> [options]
+
+The manifest is a CSV file with one row per file (or filename pattern) and the columns
+    file           file name or glob pattern, relative to the data folder
+    active_mass    active mass in mg
+    current        'constant' or 'variable' (optional)
+    threshold      current threshold in mA for variable currents (optional)
+    charge_first   whether the first cycle is a charge, true/false (optional)
+Settings missing from the manifest fall back to the command line options.
+"""
+import os
+import sys
+import glob
+import fnmatch
+import argparse
+import logging
+import time as timer
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+TRUE_STRINGS = ('1', 'true', 'yes', 'y', 't')
+
+
+def find_data_files(source):
+    """
+    Lists the data files to process.
+
+    Parameters:
+    source (str): A folder (all *.txt, *.mpr and *.xlsx files in it are used) or a glob pattern.
+
+    Returns:
+    list: The sorted absolute paths of the data files.
+    """
+    if os.path.isdir(source):
+        files = [f for pattern in ('*.txt', '*.mpr', '*.xlsx')
+                 for f in glob.glob(os.path.join(source, pattern))]
+    else:
+        files = glob.glob(source)
+    return sorted(os.path.abspath(f) for f in files if os.path.isfile(f))
+
+
+def read_manifest(manifest_file):
+    """
+    Reads a batch manifest.
+
+    Parameters:
+    manifest_file (str): Path of the manifest CSV file, or None.
+
+    Returns:
+    list: One dictionary of settings per manifest row.
+    """
+    if manifest_file is None:
+        return []
+    manifest = pd.read_csv(manifest_file, dtype=str, skipinitialspace=True)
+    manifest.columns = [col.strip().lower() for col in manifest.columns]
+    if 'file' not in manifest.columns:
+        raise ValueError(f"The manifest {manifest_file} needs a 'file' column.")
+    return [{k: v.strip() for k, v in row.items() if isinstance(v, str) and v.strip()}
+            for row in manifest.to_dict('records')]
+
+
+def job_for_file(file, manifest, args):
+    """
+    Combines the manifest entry of a file with the command line defaults.
+
+    Parameters:
+    file (str): Path of the data file.
+    manifest (list): The manifest entries (see read_manifest).
+    args (argparse.Namespace): The parsed command line options.
+
+    Returns:
+    dict: The settings used to process the file.
+    """
+    name = os.path.basename(file)
+    entry = next((row for row in manifest
+                  if fnmatch.fnmatch(name, row['file']) or
+                  os.path.abspath(row['file']) == file), {})
+
+    current = entry.get('current', 'variable' if args.variable_current else 'constant')
+    charge_first = entry.get('charge_first')
+    threshold = entry.get('threshold', args.threshold)
+    return {'file': file,
+            'active_mass': entry.get('active_mass', args.mass),
+            'is_constant': current.lower().startswith('c'),
+            'incycle_thresh': None if threshold is None else float(threshold),
+            'charge_first': (not args.discharge_first if charge_first is None
+                             else charge_first.lower() in TRUE_STRINGS),
+            'do_parquet': args.parquet,
+            'separate_cycles': args.separate_cycles,
+            'layout': args.layout,
+            'max_memory_mb': args.max_memory,
+            'capacity_method': 'legacy' if args.legacy_capacity else 'trapezoid',
+            'cycles_single_file': args.cycles_file,
+            'config': args.config,
+            'dpi': args.dpi,
+            'plot_format': args.plot_format,
+            'heatmaps': args.heatmaps,
+            'run_report': not args.no_run_report,
+            'trace_memory': args.trace_memory,
+            'csv_backend': args.csv_backend,
+            'sheet': args.sheet}
+
+
+def process_file(job):
+    """
+    Processes one data file in a worker process, without any dialogs or interactive plots.
+
+    Parameters:
+    job (dict): The settings from job_for_file.
+
+    Returns:
+    dict: The status of the run.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import clean_data as cld
+    import cycling_plots as cyc
+    import streaming
+    import run_report
+
+    cld.SHOW_DIALOGS = False
+    file = job['file']
+
+    # one log file per data file, as for the GUI. Workers run many jobs, so the log file of
+    # the previous job is closed rather than left open
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    logging.basicConfig(filename=os.path.splitext(file)[0] + '_LOG.log', level=logging.WARNING,
+                        filemode='w', format='%(asctime)s %(message)s')
+    logging.warning(f"Batch run: {job}")
+    cld.load_config(job['config'])
+    cyc.PLOT_DPI, cyc.PLOT_FORMAT = job['dpi'], job['plot_format']
+    if job['csv_backend'] is not None:
+        cld.set_csv_backend(job['csv_backend'])
+    if job['sheet'] is not None:
+        cld.XLSX_SHEET = job['sheet']
+    if not job['run_report']:
+        run_report.ENABLED = False
+    if job['trace_memory']:
+        run_report.TRACE_MEMORY = True
+
+    status = {'file': file, 'status': 'failed', 'cycles': None, 'seconds': None,
+              'save_dir': None, 'error': ''}
+    t0 = timer.perf_counter()
+    try:
+        if job['max_memory_mb'] is not None:
+            (_, _, save_dir,
+             pos_count, _) = streaming.stream_data_frame(file, job['active_mass'],
+                                                         job['is_constant'], job['do_parquet'],
+                                                         job['max_memory_mb'],
+                                                         job['incycle_thresh'],
+                                                         job['capacity_method'])
+        else:
+            (_, save_dir,
+             pos_count, _) = cyc.run_cycling(file, job['active_mass'], job['is_constant'],
+                                             job['do_parquet'], job['separate_cycles'],
+                                             job['charge_first'], job['layout'],
+                                             job['incycle_thresh'], job['capacity_method'],
+                                             job['cycles_single_file'], job['heatmaps'])
+        status.update(status='ok', cycles=pos_count, save_dir=save_dir)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        status['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        plt.close('all')
+        status['seconds'] = round(timer.perf_counter() - t0, 3)
+    return status
+
+
+def run_batch(args):
+    """
+    Processes all files of a batch in parallel worker processes and writes a status report.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line options.
+
+    Returns:
+    int: The exit code (0 if all files were processed successfully).
+    """
+    files = find_data_files(args.source)
+    if not files:
+        print(f"No data files found for {args.source}")
+        return 1
+    manifest = read_manifest(args.manifest)
+    jobs = [job_for_file(file, manifest, args) for file in files]
+
+    statuses = []
+    print(f"Processing {len(jobs)} files with {args.workers or os.cpu_count()} workers...")
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(process_file, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                status = future.result()
+            except Exception as e:
+                status = {'file': futures[future]['file'], 'status': 'failed',
+                          'error': f"{type(e).__name__}: {e}"}
+            statuses.append(status)
+            print(f"[{len(statuses)}/{len(jobs)}] {status['status']:>6} "
+                  f"{os.path.basename(status['file'])} {status.get('error', '')}")
+
+    report = pd.DataFrame(statuses, columns=['file', 'status', 'cycles', 'seconds',
+                                             'save_dir', 'error'])
+    report = report.sort_values('file')
+    report_file = args.report or os.path.join(os.path.dirname(files[0]), 'batch_report.csv')
+    report.to_csv(report_file, index=False)
+    n_failed = int((report['status'] != 'ok').sum())
+    print(f"{len(report) - n_failed} succeeded, {n_failed} failed. Report saved to {report_file}")
+    return 0 if n_failed == 0 else 2
+
+
+def run_follow(args):
+    """
+    Processes the cycles added to a growing cycler export since the previous run.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line options.
+
+    Returns:
+    int: The exit code (0 if the file was processed successfully).
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import clean_data as cld
+    import follow
+
+    cld.SHOW_DIALOGS = False
+    file = os.path.abspath(args.file)
+    logging.basicConfig(filename=os.path.splitext(file)[0] + '_LOG.log', level=logging.WARNING,
+                        filemode='a', format='%(asctime)s %(message)s')
+    cld.load_config(args.config)
+    if args.restart:
+        state_file = follow.checkpoint_path(cld.make_save_dir(file), os.path.basename(file))
+        if os.path.exists(state_file):
+            os.remove(state_file)
+    try:
+        (out_file, _, _,
+         pos_count, _) = follow.follow_data_frame(file, args.mass, not args.variable_current,
+                                                  args.parquet, args.max_memory,
+                                                  args.threshold, args.final,
+                                                  'legacy' if args.legacy_capacity else 'trapezoid')
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        print(f"failed {os.path.basename(file)} {type(e).__name__}: {e}")
+        return 2
+    print(f"{pos_count} complete cycles written to {out_file}")
+    return 0
+
+
+def run_stitch(args):
+    """
+    Processes the parts of a test that was split over several files as one test.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line options.
+
+    Returns:
+    int: The exit code (0 if the files were processed successfully).
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import clean_data as cld
+    import cycling_plots as cyc
+    import streaming
+
+    cld.SHOW_DIALOGS = False
+    files = [os.path.abspath(file) for file in args.files]
+    name = cld.stitched_file(files)
+    logging.basicConfig(filename=os.path.splitext(name)[0] + '_LOG.log', level=logging.WARNING,
+                        filemode='w', format='%(asctime)s %(message)s')
+    cld.load_config(args.config)
+    capacity_method = 'legacy' if args.legacy_capacity else 'trapezoid'
+    try:
+        if args.max_memory is not None:
+            (_, _, save_dir,
+             pos_count, _) = streaming.stream_data_frame(files, args.mass,
+                                                         not args.variable_current, args.parquet,
+                                                         args.max_memory, args.threshold,
+                                                         capacity_method)
+        else:
+            (_, save_dir,
+             pos_count, _) = cyc.run_cycling(files, args.mass, not args.variable_current,
+                                             args.parquet, charge_first=not args.discharge_first,
+                                             layout=args.layout, incycle_thresh=args.threshold,
+                                             capacity_method=capacity_method)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        print(f"failed {os.path.basename(name)} {type(e).__name__}: {e}")
+        return 2
+    print(f"{len(files)} files stitched, {pos_count} cycles saved to {save_dir}")
+    return 0
+
+
+def build_parser():
+    """
+    Builds the command line parser.
+
+    Returns:
+    argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(prog='GalvAnalyze',
+                                     description='Galvanostatic cycling analysis.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    batch = commands.add_parser('batch', help='process a folder of cycler files without the GUI')
+    batch.add_argument('source', help='folder of *.txt, *.mpr and *.xlsx files or a glob pattern')
+    batch.add_argument('--manifest', help='CSV file with the settings of each file')
+    batch.add_argument('--mass', help='default active mass (mg)')
+    batch.add_argument('--variable-current', action='store_true',
+                       help='default to a varying applied current')
+    batch.add_argument('--threshold', type=float,
+                       help='default current threshold (mA) for variable currents')
+    batch.add_argument('--discharge-first', action='store_true',
+                       help='default to a discharge as the first cycle')
+    batch.add_argument('--parquet', action='store_true', help='save outputs as Parquet files')
+    batch.add_argument('--separate-cycles', action='store_true',
+                       help='save each cycle to a separate file')
+    batch.add_argument('--cycles-file', action='store_true',
+                       help='save the separate cycles to one Parquet file with a row group per cycle')
+    batch.add_argument('--layout', choices=['wide', 'long'], default='wide',
+                       help='layout of the cycling output (default: wide)')
+    batch.add_argument('--max-memory', type=float, metavar='MB',
+                       help='stream files with this memory ceiling (long output only, no plots)')
+    batch.add_argument('--legacy-capacity', action='store_true',
+                       help='calculate capacities as current x elapsed time, as in earlier versions')
+    batch.add_argument('--dpi', type=int, default=600,
+                       help='resolution of the saved plots (default: 600)')
+    batch.add_argument('--plot-format', choices=['png', 'jpg', 'tif', 'svg', 'pdf'], default='png',
+                       help='file format of the saved plots (default: png)')
+    batch.add_argument('--heatmaps', action='store_true',
+                       help='save heatmaps of all cycles resampled onto common capacity and '
+                            'potential grids')
+    batch.add_argument('--no-run-report', action='store_true',
+                       help='do not save the timings of the pipeline stages (<file name>_RUN_REPORT.json)')
+    batch.add_argument('--trace-memory', action='store_true',
+                       help='also measure the peak memory of each stage in the run report (much slower)')
+    batch.add_argument('--csv-backend', choices=['pandas', 'pyarrow'],
+                       help='parser of the data files (default: pandas, or the csv_backend of the '
+                            'settings file)')
+    batch.add_argument('--sheet', help='sheet of .xlsx files to read (default: the first sheet '
+                                       'with supported column headings)')
+    batch.add_argument('--config', help='settings file (default: GalvAnalyze.ini next to the '
+                                        'program, see clean_data.load_config)')
+    batch.add_argument('--workers', type=int, help='number of worker processes')
+    batch.add_argument('--report', help='path of the status report (default: batch_report.csv '
+                                        'in the data folder)')
+    batch.set_defaults(func=run_batch)
+
+    live = commands.add_parser('follow', help='process the cycles added to a file that is '
+                                              'still being written since the previous run')
+    live.add_argument('file', help='cycler export (*.txt)')
+    live.add_argument('--mass', required=True, help='active mass (mg)')
+    live.add_argument('--variable-current', action='store_true',
+                      help='the applied current varies')
+    live.add_argument('--threshold', type=float,
+                      help='current threshold (mA) for variable currents')
+    live.add_argument('--parquet', action='store_true', help='save the output as a Parquet file')
+    live.add_argument('--max-memory', type=float, default=256, metavar='MB',
+                      help='memory ceiling for processing (default: 256)')
+    live.add_argument('--legacy-capacity', action='store_true',
+                      help='calculate capacities as current x elapsed time, as in earlier versions')
+    live.add_argument('--final', action='store_true',
+                      help='the test has finished: also write the last cycle')
+    live.add_argument('--restart', action='store_true',
+                      help='ignore the checkpoint and process the whole file again')
+    live.add_argument('--config', help='settings file (default: GalvAnalyze.ini next to the '
+                                       'program, see clean_data.load_config)')
+    live.set_defaults(func=run_follow)
+
+    stitch = commands.add_parser('stitch', help='process a test that was split over several '
+                                                'files as one test')
+    stitch.add_argument('files', nargs='+', help='the files of the test (*.txt, *.mpr or *.xlsx), '
+                                                 'in order')
+    stitch.add_argument('--mass', required=True, help='active mass (mg)')
+    stitch.add_argument('--variable-current', action='store_true',
+                        help='the applied current varies')
+    stitch.add_argument('--threshold', type=float,
+                        help='current threshold (mA) for variable currents')
+    stitch.add_argument('--discharge-first', action='store_true',
+                        help='the first cycle is a discharge')
+    stitch.add_argument('--parquet', action='store_true', help='save outputs as Parquet files')
+    stitch.add_argument('--layout', choices=['wide', 'long'], default='wide',
+                        help='layout of the cycling output (default: wide)')
+    stitch.add_argument('--max-memory', type=float, metavar='MB',
+                        help='stream the files with this memory ceiling (long output only, no plots)')
+    stitch.add_argument('--legacy-capacity', action='store_true',
+                        help='calculate capacities as current x elapsed time, as in earlier versions')
+    stitch.add_argument('--config', help='settings file (default: GalvAnalyze.ini next to the '
+                                          'program, see clean_data.load_config)')
+    stitch.set_defaults(func=run_stitch)
+    return parser
+
+
+def main(argv=None):
+    """
+    Runs the command line interface.
+
+    Parameters:
+    argv (list, optional): The command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+    int: The exit code.
+    """
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
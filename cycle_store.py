@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Random access to single cycles of processed cycling data.
+
+A CycleStore opens a cycling output (the long or wide CSV/Parquet file saved by
+clean_data.create_data_frame, or the single cycles file of save_cycles_dataset), or a
+data file through its binary cache, and builds an index of the cycles once. Each cycle
+is then loaded on its own, in the long layout (see clean_data.LONG_COLUMNS):
+
+    store = CycleStore("Cell_OUTPUTS/Cell_long.csv")
+    cycle = store[1500]
+    charge = store.charge(1500)
+    for number, cycle in store.iter_cycles():
+        ...
+
+What is read for a cycle depends on the file:
+    long CSV       the bytes of the rows of the cycle (located with a newline index)
+    long Parquet   the row groups holding the cycle (one per cycle in All_cycles.parquet)
+    wide Parquet   the column chunks of the cycle
+    wide CSV       the columns of the cycle, which still needs a pass over all lines
+    data file      the samples of the cycle, from the memory-mapped binary cache
+"""
+import io
+import os
+import numpy as np
+import pandas as pd
+import clean_data as cld
+
+# size of the blocks read while indexing the lines of a CSV file (bytes)
+INDEX_BLOCK_BYTES: int = 16 * 2**20
+
+
+def line_offsets(path, rows):
+    """
+    Finds the byte offsets at which data rows of a text file with a single header line start.
+
+    Parameters:
+    path (str): Path of the file.
+    rows (array-like): Numbers of the data rows (0 for the line after the header).
+
+    Returns:
+    ndarray: The byte offset of each row. Rows past the last line give the size of the file.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    sorted_rows = rows[order]
+    offsets = np.empty(len(rows), dtype=np.int64)
+    found, n_lines, pos = 0, 0, 0
+    with open(path, 'rb') as fh:
+        while found < len(rows):
+            block = fh.read(INDEX_BLOCK_BYTES)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            # data row r starts after newline r (newline 0 ends the header)
+            last = np.searchsorted(sorted_rows, n_lines + len(newlines), 'left')
+            offsets[order[found:last]] = pos + newlines[sorted_rows[found:last] - n_lines] + 1
+            found, n_lines, pos = last, n_lines + len(newlines), pos + len(block)
+    offsets[order[found:]] = pos
+    return offsets
+
+
+class CycleStore:
+    """Loads single cycles of a cycling output or data file, reading only what each cycle needs."""
+
+    def __init__(self, path, engine=None):
+        """Open a cycling output and index its cycles.
+
+        Parameters:
+        path (str): Path of a long or wide CSV or Parquet output.
+        engine (str, optional): Parquet engine, 'fastparquet' or 'pyarrow'. Defaults to
+            clean_data.PARQUET_ENGINE.
+
+        Raises:
+        ValueError: If the file is not a cycling output.
+        """
+        self.path = os.path.abspath(path)
+        self.engine = cld.PARQUET_ENGINE if engine is None else engine
+        self.is_parquet = path.lower().endswith('.parquet')
+        self._group = (None, None)
+        columns = self._columns()
+        if 'cycle' in columns and 'direction' in columns:
+            self.layout = 'long'
+            self.index = self._long_index()
+        else:
+            self.layout = 'wide'
+            self.index = self._wide_index(columns)
+        self._read = getattr(self, f"_read_{self.layout}_{'parquet' if self.is_parquet else 'csv'}")
+
+    @classmethod
+    def from_data_file(cls, file, active_mass, is_constant=True, incycle_thresh=None,
+                       capacity_method=None):
+        """
+        Opens a data file, finding its cycles as create_data_frame does. The columns are
+        memory-mapped from the binary cache of the file (see data_cache.read_sidecar), so
+        each cycle only reads its own samples once the cycles have been found.
+
+        Parameters:
+        file (str): Path of the data file.
+        active_mass (float): The active mass in mg.
+        is_constant (bool): Whether the applied current is constant.
+        incycle_thresh (float): Current threshold (mA) for variable currents. If None, it
+            is suggested from the data.
+        capacity_method (str): How the capacity is calculated (see clean_data.integrate_capacity).
+
+        Returns:
+        CycleStore: The store of the cycles of the file.
+        """
+        store = cls.__new__(cls)
+        store.path = os.path.abspath(file)
+        store.engine = cld.PARQUET_ENGINE
+        store.is_parquet = False
+        store._group = (None, None)
+        store.layout = 'data'
+        potential, time, current = cld.load_parsed(file)
+        if not is_constant and incycle_thresh is None:
+            incycle_thresh = cld.get_incycle_thresh(current)
+        segments_tag = ('segments', is_constant, 0.98, incycle_thresh)
+        cached_segments = cld.SESSION_CACHE.get(file, segments_tag)
+        if cached_segments is None:
+            is_pos, is_neg = cld.current_thresholds(current, 0.98, is_constant, incycle_thresh)
+            cached_segments = cld.get_cycle_segments(is_pos, is_neg)
+            cld.SESSION_CACHE.put(file, segments_tag, cached_segments)
+        store.index = cached_segments[2].sort_values(['cycle', 'direction'],
+                                                     kind='stable').reset_index(drop=True)
+        store._data = (np.asarray(time), np.asarray(potential), np.asarray(current),
+                       cld.get_active_mass(active_mass), capacity_method)
+        store._read = store._read_data
+        return store
+
+    @property
+    def cycles(self):
+        """The cycle numbers in the store, in ascending order."""
+        return np.unique(self.index['cycle'].to_numpy())
+
+    def __len__(self):
+        """Return the number of cycles."""
+        return len(self.cycles)
+
+    def __contains__(self, cycle):
+        """Return whether the store holds a cycle."""
+        return bool(np.any(self.index['cycle'].to_numpy() == cycle))
+
+    def __getitem__(self, cycle):
+        """Return the charge and discharge of a cycle in the long layout."""
+        return self._load(cycle, ('C', 'D'))
+
+    def charge(self, cycle):
+        """Return the charge of a cycle in the long layout."""
+        return self._load(cycle, ('C',))
+
+    def discharge(self, cycle):
+        """Return the discharge of a cycle in the long layout."""
+        return self._load(cycle, ('D',))
+
+    def iter_cycles(self):
+        """Yield the number and the charge and discharge of each cycle, in ascending order."""
+        for cycle in self.cycles:
+            yield int(cycle), self[cycle]
+
+    def _load(self, cycle, directions):
+        """Read the given directions of a cycle."""
+        rows = self.index[(self.index['cycle'] == cycle) &
+                          self.index['direction'].isin(directions)]
+        if len(rows) == 0:
+            raise KeyError(f"Cycle {cycle} is not in {self.path}.")
+        frame = self._read(rows)
+        frame['direction'] = pd.Categorical(frame['direction'], categories=['C', 'D'])
+        return frame.reset_index(drop=True)
+
+    def _columns(self):
+        """Return the column names of the output without reading its data."""
+        if not self.is_parquet:
+            return list(pd.read_csv(self.path, nrows=0).columns)
+        if self.engine == 'pyarrow':
+            import pyarrow.parquet as pq
+            return pq.read_schema(self.path).names
+        import fastparquet
+        return fastparquet.ParquetFile(self.path).columns
+
+    def _long_index(self):
+        """Find the rows of each cycle of a long output, and the bytes or row groups holding them."""
+        stem = self.path[:self.path.rfind('.')]
+        offsets_file = stem + "_offsets.csv"
+        if not self.is_parquet and os.path.exists(offsets_file):
+            index = pd.read_csv(offsets_file)
+        elif self.is_parquet:
+            index = cld.long_offsets(pd.read_parquet(self.path, engine=self.engine,
+                                                     columns=['cycle', 'direction']))
+        else:
+            index = cld.long_offsets(pd.read_csv(self.path, usecols=['cycle', 'direction']))
+        index['direction'] = index['direction'].astype(str)
+
+        if self.is_parquet:
+            if self.engine == 'pyarrow':
+                import pyarrow.parquet as pq
+                metadata = pq.ParquetFile(self.path).metadata
+                group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+            else:
+                import fastparquet
+                group_rows = [group.num_rows for group in fastparquet.ParquetFile(self.path).row_groups]
+            self._group_starts = np.cumsum([0] + group_rows)
+        else:
+            self.header = list(pd.read_csv(self.path, nrows=0).columns)
+            bounds = line_offsets(self.path, np.concatenate((index['start'], index['stop'])))
+            index['first_byte'] = bounds[:len(index)]
+            index['last_byte'] = bounds[len(index):]
+        return index
+
+    def _wide_index(self, columns):
+        """List the cycles of a wide output from its column names."""
+        time_head = cld.LONG_COLUMNS[2]
+        labels = [col[len(time_head)+1:-1] for col in columns if col.startswith(time_head + '(')]
+        if not labels:
+            raise ValueError(f"{self.path} is not a cycling output of GalvAnalyze.")
+        return pd.DataFrame({'cycle': [int(label[1:]) for label in labels],
+                             'direction': [label[0] for label in labels]})
+
+    def _read_long_csv(self, rows):
+        """Read the lines of the given cycles of a long CSV output."""
+        frames = []
+        with open(self.path, 'rb') as fh:
+            for first_byte, last_byte in zip(rows['first_byte'], rows['last_byte']):
+                fh.seek(first_byte)
+                frames.append(pd.read_csv(io.BytesIO(fh.read(last_byte - first_byte)),
+                                          header=None, names=self.header))
+        return pd.concat(frames, ignore_index=True)
+
+    def _read_long_parquet(self, rows):
+        """Read the row groups holding the given cycles of a long Parquet output."""
+        frames = []
+        for start, stop in zip(rows['start'], rows['stop']):
+            first = np.searchsorted(self._group_starts, start, 'right') - 1
+            last = np.searchsorted(self._group_starts, stop, 'left')
+            groups = pd.concat([self._read_group(i) for i in range(first, last)],
+                               ignore_index=True)
+            offset = self._group_starts[first]
+            frames.append(groups.iloc[start - offset:stop - offset])
+        return pd.concat(frames, ignore_index=True)
+
+    def _read_group(self, i):
+        """Read one row group of a Parquet output, keeping the last one read for the next cycle."""
+        if self._group[0] == i:
+            return self._group[1]
+        if self.engine == 'pyarrow':
+            import pyarrow.parquet as pq
+            group = pq.ParquetFile(self.path).read_row_group(i).to_pandas()
+        else:
+            import fastparquet
+            group = fastparquet.ParquetFile(self.path)[i].to_pandas()
+        self._group = (i, group)
+        return group
+
+    def _read_wide(self, rows, read_columns):
+        """Convert the columns of the given cycles of a wide output to the long layout."""
+        heads = cld.LONG_COLUMNS[2:]
+        labels = [f"{direction}{cycle}" for cycle, direction in zip(rows['cycle'], rows['direction'])]
+        columns = read_columns([f"{head}({label})" for label in labels for head in heads])
+        frames = []
+        for cycle, direction, label in zip(rows['cycle'], rows['direction'], labels):
+            values = columns[[f"{head}({label})" for head in heads]].set_axis(list(heads), axis=1)
+            values = values[values[heads[0]].notna()]
+            frames.append(values.assign(cycle=cycle, direction=direction))
+        return pd.concat(frames, ignore_index=True)[list(cld.LONG_COLUMNS)]
+
+    def _read_wide_csv(self, rows):
+        """Read the columns of the given cycles of a wide CSV output."""
+        return self._read_wide(rows, lambda columns: pd.read_csv(self.path, usecols=columns))
+
+    def _read_wide_parquet(self, rows):
+        """Read the columns of the given cycles of a wide Parquet output."""
+        return self._read_wide(rows, lambda columns: pd.read_parquet(self.path, engine=self.engine,
+                                                                     columns=columns))
+
+    def _read_data(self, rows):
+        """Gather and integrate the samples of the given cycles of a data file."""
+        time, potential, current, active_mass, capacity_method = self._data
+        frame, _ = cld.cycles_to_long_frame(time, potential, current, rows, active_mass,
+                                            capacity_method)
+        return frame
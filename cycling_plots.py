@@ -6,21 +6,166 @@ Created on Fri Oct 16 21:53:53 2020
 lukasrier@outlook.com
 """
 import os
+import logging
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+from matplotlib.path import Path
+from matplotlib.transforms import Affine2D
 import pandas as pd
 import clean_data as cld
+import run_report
 
 colors = ['#a6cee3', '#1f78b4', '#b2df8a', '#33a02c', '#fb9a99',
           '#e31a1c', '#fdbf6f', '#ff7f00', '#cab2d6', '#6a3d9a']
 
+# resolution (dots per inch) and file format of the saved plots
+PLOT_DPI: int = 600
+PLOT_FORMAT: str = "png"
+PLOT_FORMATS = ('png', 'jpg', 'tif', 'svg', 'pdf')
+
+# number of points of the capacity and potential grids of the cycle heatmaps
+HEATMAP_GRID_POINTS: int = 200
+
+
+def _long_cycle_rows(out_df, direction, count):
+    """
+    Returns the rows of the first `count` cycles in one direction of a long-layout DataFrame.
+
+    Args:
+    - out_df: a pandas DataFrame in the long layout (see clean_data.LONG_COLUMNS)
+    - direction: 'C' for charge or 'D' for discharge
+    - count: the number of cycles to return
+
+    Returns:
+    - starts: a numpy array containing the first row of each cycle
+    - stops: a numpy array containing the row after the last row of each cycle
+    """
+    offsets = cld.long_offsets(out_df)
+    offsets = offsets[offsets['direction'] == direction].sort_values('cycle', kind='stable')
+    offsets = offsets.iloc[:count]
+    return offsets['start'].to_numpy(), offsets['stop'].to_numpy()
+
+
+def cycle_arrays(out_df):
+    """
+    Returns the samples of all cycles of a cycling DataFrame as flat arrays, one cycle after the other.
+
+    Args:
+    - out_df: a pandas DataFrame containing the data from the battery cycling experiment (wide or long layout),
+      or a clean_data.CyclingResult
+
+    Returns:
+    - index: a pandas DataFrame with one row per cycle, in the order of the arrays, and the columns
+      'cycle', 'direction', 'start' and 'stop' giving the samples [start, stop) of the cycle
+    - time: a numpy array containing the elapsed time of each sample
+    - capacity: a numpy array containing the capacity of each sample
+    - potential: a numpy array containing the potential of each sample
+    """
+    if isinstance(out_df, cld.CyclingResult):
+        return out_df.offsets, out_df.time, out_df.capacity, out_df.potential
+    time_head, capacity_head, potential_head = cld.LONG_COLUMNS[2:]
+    if cld.is_long_frame(out_df):
+        return (cld.long_offsets(out_df).reset_index(drop=True),
+                out_df[time_head].to_numpy(dtype=float),
+                out_df[capacity_head].to_numpy(dtype=float),
+                out_df[potential_head].to_numpy(dtype=float))
+    return cld.wide_cycle_arrays(out_df)
+
+
+def cycle_summary(out_df):
+    """
+    Calculates the summary statistics of every cycle in one pass over the samples.
+
+    The statistics are reductions over the samples of each cycle (numpy reduceat), so the
+    cost is linear in the number of samples whatever the number of cycles.
+
+    Args:
+    - out_df: a pandas DataFrame containing the data from the battery cycling experiment (wide or long layout),
+      or a clean_data.CyclingResult
+
+    Returns:
+    - summary: a pandas DataFrame with one row per cycle, sorted by cycle with the charge first, and
+      the maximum capacity, the specific energy (integral of the potential over the capacity), the mean
+      and median potential, the duration, the start and end potentials and the IR drop, i.e. the potential
+      step between the first two samples of the cycle, across the switch of the current.
+      The lead sample of a run at the start of the record wraps around to the end of its cycle
+      (see clean_data.wrapped_lead_positions); it is left out of the potential statistics and the
+      cycle ends at the sample before it
+    """
+    index, time, capacity, potential = cycle_arrays(out_df)
+    starts = index['start'].to_numpy()
+    stops = index['stop'].to_numpy()
+    lengths = stops - starts
+    last = stops - 1
+    values = potential
+    if isinstance(out_df, cld.CyclingResult) and len(out_df.wrapped):
+        last -= np.isin(last, out_df.wrapped)
+        values = potential.copy()
+        values[out_df.wrapped] = np.nan
+    summary = pd.DataFrame({'Cycle Number': index['cycle'].to_numpy(),
+                            'Direction': index['direction'].to_numpy()})
+    if len(index) == 0:
+        return summary
+
+    # trapezoidal V dQ, without the steps between the end of one cycle and the start of the next
+    energy = np.zeros(len(capacity))
+    energy[1:] = 0.5 * (potential[1:] + potential[:-1]) * np.diff(capacity)
+    energy[starts] = 0
+
+    # median: sort the potentials within each cycle and average the middle finite samples.
+    # NaN sorts last, so the finite samples of each cycle come first, as in np.nanmedian
+    finite = np.isfinite(values)
+    n_finite = np.add.reduceat(finite.astype(np.int64), starts)
+    cycle_id = np.repeat(np.arange(len(index)), lengths)
+    order = np.argsort(values)
+    order = order[np.argsort(cycle_id[order], kind='stable')]
+    sorted_potential = values[order]
+    median = 0.5 * (sorted_potential[starts + np.maximum(n_finite - 1, 0) // 2] +
+                    sorted_potential[starts + n_finite // 2])
+    median[n_finite == 0] = np.nan
+
+    # mean: segmented sum and count of the finite samples
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(finite, values, 0), starts) / n_finite
+
+    second = np.minimum(starts + 1, last)
+    summary['Max Capacity mA.h.g^-1'] = np.fmax.reduceat(capacity, starts)
+    summary['Specific Energy mW.h.g^-1'] = np.add.reduceat(energy, starts)
+    summary['Mean Potential V'] = mean
+    summary['Median Potential V'] = median
+    summary['Duration s'] = time[last] - time[starts]
+    summary['Start Potential V'] = potential[starts]
+    summary['End Potential V'] = potential[last]
+    summary['IR Drop V'] = np.abs(potential[second] - potential[starts])
+    return summary.sort_values(['Cycle Number', 'Direction'], kind='stable',
+                               ignore_index=True)
+
+
+def save_cycle_summary(save_dir, summary):
+    """
+    Save the summary statistics of each cycle (see cycle_summary) in a csv file.
+
+    Parameters:
+    save_dir (str): Directory to save the csv file.
+    summary (pandas.DataFrame): The summary statistics.
+
+    Returns:
+    None
+    """
+    summary_path = os.path.join(save_dir, "Cycle_summary.csv")
+    summary.to_csv(summary_path, index=False)
+    run_report.add_file(summary_path)
+
 
 def calculate_max_cap_and_coulombic_eff(out_df, pos_count, neg_count):
     """
     This function calculates the maximum charge and discharge capacities, as well as the coulombic efficiency, from a DataFrame.
 
     Args:
-    - out_df: a pandas DataFrame containing the data from the battery cycling experiment
+    - out_df: a pandas DataFrame containing the data from the battery cycling experiment (wide or long layout),
+      or a clean_data.CyclingResult
     - pos_count: an integer representing the number of cycles in the charge direction
     - neg_count: an integer representing the number of cycles in the discharge direction
 
@@ -29,17 +174,15 @@ def calculate_max_cap_and_coulombic_eff(out_df, pos_count, neg_count):
     - max_charge_cap: a numpy array containing the maximum charge capacity for each cycle
     - max_discharge_cap: a numpy array containing the maximum discharge capacity for each cycle
     """
-    charge_cols = [
-        col for col in out_df.columns if 'Capacity/mA.h.g^-1(C' in col]
+    index, _, capacity, _ = cycle_arrays(out_df)
+    index['max_cap'] = (np.fmax.reduceat(capacity, index['start'].to_numpy())
+                        if len(index) else [])
     max_charge_cap = np.zeros(pos_count)
-    for i, col in enumerate(charge_cols):
-        max_charge_cap[i] = np.max(out_df[col])
-
-    discharge_cols = [
-        col for col in out_df.columns if 'Capacity/mA.h.g^-1(D' in col]
     max_discharge_cap = np.zeros(neg_count)
-    for i, col in enumerate(discharge_cols):
-        max_discharge_cap[i] = np.max(out_df[col])
+    for direction, max_cap in (('C', max_charge_cap), ('D', max_discharge_cap)):
+        cycles = index[index['direction'] == direction].sort_values('cycle', kind='stable')
+        values = cycles['max_cap'].to_numpy()[:len(max_cap)]
+        max_cap[:len(values)] = values
 
     if max_discharge_cap[0] > max_charge_cap[0]:
         coulombic_efficiency = 100*max_charge_cap/max_discharge_cap
@@ -50,6 +193,49 @@ def calculate_max_cap_and_coulombic_eff(out_df, pos_count, neg_count):
     return coulombic_efficiency, max_charge_cap, max_discharge_cap
 
 
+def save_plot(save_dir, name, dpi=None, fmt=None):
+    """
+    Saves the current figure.
+
+    Args:
+    - save_dir: the directory to save the figure in
+    - name: the file name of the figure, without the extension
+    - dpi: the resolution in dots per inch (defaults to PLOT_DPI)
+    - fmt: the file format, e.g. 'png' or 'svg' (defaults to PLOT_FORMAT)
+    """
+    fmt = PLOT_FORMAT if fmt is None else fmt
+    path = os.path.join(save_dir, f"{name}.{fmt}")
+    with run_report.stage('savefig'):
+        plt.savefig(path, dpi=PLOT_DPI if dpi is None else dpi)
+        run_report.add_file(path)
+
+
+def simplify_curves(segments, transform):
+    """
+    Reduces each curve to the points that can be seen at the resolution of a transform.
+
+    This is the path simplification matplotlib applies when it draws a single line, which it
+    does not apply to the lines of a LineCollection: points that deviate from the simplified
+    line by less than a fraction of a pixel are dropped.
+
+    Args:
+    - segments: a list of (N, 2) arrays with the points of each curve in data coordinates
+    - transform: a matplotlib transform from data coordinates to the pixels of the saved figure
+
+    Returns:
+    - simplified: a list of (M, 2) arrays with the kept points of each curve in data coordinates
+    """
+    inverse = transform.inverted()
+    simplified = []
+    for segment in segments:
+        if len(segment) < 3:
+            simplified.append(segment)
+            continue
+        path = Path(segment).cleaned(transform=transform, simplify=True)
+        simplified.append(inverse.transform(path.vertices[path.codes != Path.STOP]))
+    return simplified
+
+
 def get_cycle_no(pos_count):
     """
     This function returns an array of cycle numbers.
@@ -100,11 +286,11 @@ def plot_max_cap_and_efficiency(cycle_no, max_charge_cap, max_discharge_cap, cou
     plt.ylim([0, 110])
     plt.yticks(fontsize=14)
     plt.tight_layout()
-    plt.savefig(os.path.join(
-        save_dir, "Cycle no vs. Capacity and Coulombic efficiency.png"), dpi=600)
+    save_plot(save_dir, "Cycle no vs. Capacity and Coulombic efficiency")
 
 
-def save_max_cap_csv(save_dir, cycle_no, max_charge_cap, max_discharge_cap, coulombic_efficiency):
+def save_max_cap_csv(save_dir, cycle_no, max_charge_cap, max_discharge_cap, coulombic_efficiency,
+                     append=False):
     """
     Save the maximum charge and discharge capacities, and coulombic efficiency for each cycle in a csv file.
 
@@ -114,6 +300,7 @@ def save_max_cap_csv(save_dir, cycle_no, max_charge_cap, max_discharge_cap, coul
     max_charge_cap (list): List of maximum charge capacities for each cycle.
     max_discharge_cap (list): List of maximum discharge capacities for each cycle.
     coulombic_efficiency (list): List of coulombic efficiencies for each cycle.
+    append (bool): Whether to add the cycles to the end of an existing file.
 
     Returns:
     None
@@ -124,87 +311,285 @@ def save_max_cap_csv(save_dir, cycle_no, max_charge_cap, max_discharge_cap, coul
                'Coulombic Efficiency': coulombic_efficiency}
     max_cap_df = pd.DataFrame.from_dict(data=max_cap, orient="columns")
     max_cap_path = os.path.join(save_dir, "Max_capacities_per_cycle.csv")
-    max_cap_df.to_csv(max_cap_path, index=False)
+    append = append and os.path.exists(max_cap_path)
+    max_cap_df.to_csv(max_cap_path, index=False, mode='a' if append else 'w', header=not append)
+    run_report.add_file(max_cap_path)
 
 
-def plot_caps_vs_potentials(out_df, pos_count, neg_count, save_dir=None):
+def plot_caps_vs_potentials(out_df, pos_count, neg_count, save_dir=None, dpi=None, fmt=None):
     """
-    Plot the capacity vs potential for each cycle and save the plot as a png file.
+    Plot the capacity vs potential for each cycle and save the plot.
+
+    All cycles are drawn as a single LineCollection, without the NaN padding of the wide layout and
+    with each cycle reduced to the points the resolution of the saved figure can show (see
+    simplify_curves), so that thousands of cycles render quickly.
 
     Parameters:
-    out_df (DataFrame): Dataframe containing the electrochemical cycling data.
+    out_df (DataFrame): Dataframe containing the electrochemical cycling data (wide or long layout),
+        or a clean_data.CyclingResult.
     pos_count (int): Number of positive cycles.
     neg_count (int): Number of negative cycles.
-    save_dir (str): Directory to save the plot as a png file.
+    save_dir (str): Directory to save the plot in.
+    dpi (int): Resolution of the saved plot in dots per inch. Defaults to PLOT_DPI.
+    fmt (str): File format of the saved plot, e.g. 'png' or 'svg'. Defaults to PLOT_FORMAT.
 
     Returns:
     charge_cyc_potentials (ndarray): 2D numpy array containing the potential values for each positive cycle.
     charge_cyc_capacities (ndarray): 2D numpy array containing the capacity values for each positive cycle.
     discharge_cyc_potentials (ndarray): 2D numpy array containing the potential values for each negative cycle.
     discharge_cyc_capacities (ndarray): 2D numpy array containing the capacity values for each negative cycle.
+    For data in the long layout or a CyclingResult, each of these is a list with one (unpadded) array
+    per cycle instead.
     """
-    charge_cyc_potentials = np.zeros((out_df.shape[0], pos_count))
-    charge_cyc_capacities = np.zeros((out_df.shape[0], pos_count))
-
-    for coln in range(pos_count):
-        charge_cyc_potentials[:, coln] = out_df["Ecell/V(C%d)" % (coln+1)]
-        charge_cyc_capacities[:,
-                              coln] = out_df["Capacity/mA.h.g^-1(C%d)" % (coln+1)]
-
-    # plt.figure()
-    # plt.plot(charge_cyc_capacities,charge_cyc_potentials, linewidth=0.5)
-    # plt.xlabel("Capacity $mAh g^{-1}$", fontsize=14)
-    # plt.xticks(fontsize=14)
-    # plt.ylabel("Potential / $V$", fontsize=14)
-    # plt.yticks(fontsize=14)
-    # plt.tight_layout()
-    # plt.legend(["Cyc1","Cyc2","Cyc3","Cyc4","Cyc5","Cyc6","Cyc7","Cyc8","Cyc9","Cyc10"])
-    # if save_dir != None:
-    #    plt.savefig(os.path.join(save_dir,"Charge capacity vs. Potential.png"))
-
-    discharge_cyc_potentials = np.zeros((out_df.shape[0], neg_count))
-    discharge_cyc_capacities = np.zeros((out_df.shape[0], neg_count))
-
+    if isinstance(out_df, cld.CyclingResult):
+        charge = [out_df.charge(k) for k in range(1, pos_count+1)]
+        discharge = [out_df.discharge(k) for k in range(1, neg_count+1)]
+        charge_cyc_potentials = [potential for _, _, potential in charge]
+        charge_cyc_capacities = [capacity for _, capacity, _ in charge]
+        discharge_cyc_potentials = [potential for _, _, potential in discharge]
+        discharge_cyc_capacities = [capacity for _, capacity, _ in discharge]
+        charge_curves = list(zip(charge_cyc_capacities, charge_cyc_potentials))
+        discharge_curves = list(zip(discharge_cyc_capacities, discharge_cyc_potentials))
+    elif cld.is_long_frame(out_df):
+        potential = out_df['Ecell/V'].to_numpy()
+        capacity = out_df['Capacity/mA.h.g^-1'].to_numpy()
+        starts, stops = _long_cycle_rows(out_df, 'C', pos_count)
+        charge_cyc_potentials = [potential[s:e] for s, e in zip(starts, stops)]
+        charge_cyc_capacities = [capacity[s:e] for s, e in zip(starts, stops)]
+        starts, stops = _long_cycle_rows(out_df, 'D', neg_count)
+        discharge_cyc_potentials = [potential[s:e] for s, e in zip(starts, stops)]
+        discharge_cyc_capacities = [capacity[s:e] for s, e in zip(starts, stops)]
+        charge_curves = list(zip(charge_cyc_capacities, charge_cyc_potentials))
+        discharge_curves = list(zip(discharge_cyc_capacities, discharge_cyc_potentials))
+    else:
+        charge_cyc_potentials = np.zeros((out_df.shape[0], pos_count))
+        charge_cyc_capacities = np.zeros((out_df.shape[0], pos_count))
+
+        for coln in range(pos_count):
+            charge_cyc_potentials[:, coln] = out_df["Ecell/V(C%d)" % (coln+1)]
+            charge_cyc_capacities[:,
+                                  coln] = out_df["Capacity/mA.h.g^-1(C%d)" % (coln+1)]
+
+        # plt.figure()
+        # plt.plot(charge_cyc_capacities,charge_cyc_potentials, linewidth=0.5)
+        # plt.xlabel("Capacity $mAh g^{-1}$", fontsize=14)
+        # plt.xticks(fontsize=14)
+        # plt.ylabel("Potential / $V$", fontsize=14)
+        # plt.yticks(fontsize=14)
+        # plt.tight_layout()
+        # plt.legend(["Cyc1","Cyc2","Cyc3","Cyc4","Cyc5","Cyc6","Cyc7","Cyc8","Cyc9","Cyc10"])
+        # if save_dir != None:
+        #    plt.savefig(os.path.join(save_dir,"Charge capacity vs. Potential.png"))
+
+        discharge_cyc_potentials = np.zeros((out_df.shape[0], neg_count))
+        discharge_cyc_capacities = np.zeros((out_df.shape[0], neg_count))
+
+        for coln in range(neg_count):
+            discharge_cyc_potentials[:, coln] = out_df["Ecell/V(D%d)" % (coln+1)]
+            discharge_cyc_capacities[:,
+                                     coln] = out_df["Capacity/mA.h.g^-1(D%d)" % (coln+1)]
+
+        # plt.figure()
+        # plt.plot(discharge_cyc_capacities[:,coln],discharge_cyc_potentials[:,coln], linewidth=0.5)
+        # plt.xlabel("Capacity $mAh g^{-1}$", fontsize=14)
+        # plt.xticks(fontsize=14)
+        # plt.ylabel("Potential / $V$", fontsize=14)
+        # plt.yticks(fontsize=14)
+        # plt.tight_layout()
+        # plt.legend(["Cyc1","Cyc2","Cyc3","Cyc4","Cyc5","Cyc6","Cyc7","Cyc8","Cyc9","Cyc10"])
+        # if save_dir != None:
+        #     plt.savefig(os.path.join(save_dir,"Disharge capacity vs. Potential.png"))
+
+        charge_curves = [(charge_cyc_capacities[:, coln], charge_cyc_potentials[:, coln])
+                         for coln in range(pos_count)]
+        discharge_curves = [(discharge_cyc_capacities[:, coln], discharge_cyc_potentials[:, coln])
+                            for coln in range(neg_count)]
+
+    # all curves are drawn as one collection, in the order discharge 1, charge 1, discharge 2, ...
+    curves, curve_colors = [], []
     for coln in range(neg_count):
-        discharge_cyc_potentials[:, coln] = out_df["Ecell/V(D%d)" % (coln+1)]
-        discharge_cyc_capacities[:,
-                                 coln] = out_df["Capacity/mA.h.g^-1(D%d)" % (coln+1)]
-
-    # plt.figure()
-    # plt.plot(discharge_cyc_capacities[:,coln],discharge_cyc_potentials[:,coln], linewidth=0.5)
-    # plt.xlabel("Capacity $mAh g^{-1}$", fontsize=14)
-    # plt.xticks(fontsize=14)
-    # plt.ylabel("Potential / $V$", fontsize=14)
-    # plt.yticks(fontsize=14)
-    # plt.tight_layout()
-    # plt.legend(["Cyc1","Cyc2","Cyc3","Cyc4","Cyc5","Cyc6","Cyc7","Cyc8","Cyc9","Cyc10"])
-    # if save_dir != None:
-    #     plt.savefig(os.path.join(save_dir,"Disharge capacity vs. Potential.png"))
+        curves += [discharge_curves[coln], charge_curves[coln]]
+        curve_colors += [colors[coln % 10]] * 2
 
-    plt.figure(figsize=(6, 5))
-    for coln in range(neg_count):
-        plt.plot(discharge_cyc_capacities[:, coln], discharge_cyc_potentials[:, coln],
-                 linewidth=1, color=colors[coln % 10])
-        plt.plot(charge_cyc_capacities[:, coln], charge_cyc_potentials[:, coln],
-                 linewidth=1, color=colors[coln % 10])
+    segments = []
+    for capacity, potential in curves:
+        capacity, potential = np.asarray(capacity, dtype=float), np.asarray(potential, dtype=float)
+        valid = np.isfinite(capacity) & np.isfinite(potential)
+        segments.append(np.column_stack((capacity[valid], potential[valid])))
+
+    fig = plt.figure(figsize=(6, 5))
+    ax = plt.gca()
+    lines = LineCollection(segments, colors=curve_colors, linewidths=1,
+                           capstyle='projecting', joinstyle='round')
+    ax.add_collection(lines)
+    ax.autoscale_view()
     plt.xlabel("Capacity / $\mathrm{mAh}$ $\mathrm{g^{-1}}$", fontsize=14)
     plt.xticks(fontsize=14)
     plt.ylabel("Potential / $\mathrm{V}$", fontsize=14)
     plt.yticks(fontsize=14)
-    ax = plt.gca()
     box = ax.get_position()
     ax.set_position([box.x0, box.y0 + box.height * 0.035,
                     box.width, box.height * 0.975])
-    plt.legend(["D1", "C1", "D2", "C2", "D3", "C3", "D4", "C4", "D5", "C5"], loc='lower center',
-               bbox_to_anchor=(0.5, 1.01), ncol=5)
+    labels = ["D1", "C1", "D2", "C2", "D3", "C3", "D4", "C4", "D5", "C5"][:len(curves)]
+    plt.legend([Line2D([], [], linewidth=1, color=color) for color in curve_colors[:len(labels)]],
+               labels, loc='lower center', bbox_to_anchor=(0.5, 1.01), ncol=5)
     plt.tight_layout()
+
+    # keep the points the saved figure can show
+    dpi = PLOT_DPI if dpi is None else dpi
+    lines.set_segments(simplify_curves(segments, ax.transData + Affine2D().scale(dpi / fig.dpi)))
     if save_dir != None:
-        plt.savefig(os.path.join(
-            save_dir, "Capacity vs. Potential (all cycles).png"), dpi=600)
+        save_plot(save_dir, "Capacity vs. Potential (all cycles)", dpi, fmt)
 
     return charge_cyc_potentials, charge_cyc_capacities, discharge_cyc_potentials, discharge_cyc_capacities
 
 
+def resample_cycles(cycle_id, x, y, grid, n_cycles):
+    """
+    Interpolates y onto a common grid of x for every cycle at once.
+
+    The x values of each cycle are made non-decreasing (running maximum) and the cycles are placed one
+    after the other along the x axis, each shifted past the range of the previous ones, so that a single
+    np.interp call resamples all cycles.
+
+    Args:
+    - cycle_id: a non-decreasing numpy array giving the row (0 to n_cycles-1) of each sample
+    - x: a numpy array of the values the grid refers to
+    - y: a numpy array of the values to interpolate
+    - grid: a numpy array of increasing x values
+    - n_cycles: the number of rows of the result
+
+    Returns:
+    - matrix: a (n_cycles x grid) numpy array, NaN where the grid lies outside the x range of a cycle
+    """
+    matrix = np.full((n_cycles, len(grid)), np.nan)
+    valid = np.isfinite(x) & np.isfinite(y)
+    cycle_id, x, y = cycle_id[valid], x[valid], y[valid]
+    if len(x) == 0:
+        return matrix
+
+    low = min(x.min(), grid[0])
+    width = max(x.max(), grid[-1]) - low + 1
+    stacked = np.maximum.accumulate(x - low + cycle_id * width)
+
+    counts = np.bincount(cycle_id, minlength=n_cycles)
+    rows = np.flatnonzero(counts)
+    last = np.cumsum(counts)[rows] - 1
+    first = last - counts[rows] + 1
+    query = grid[None, :] - low + rows[:, None] * width
+    inside = (query >= stacked[first, None]) & (query <= stacked[last, None])
+    values = np.interp(query.ravel(), stacked, y).reshape(query.shape)
+    matrix[rows] = np.where(inside, values, np.nan)
+    return matrix
+
+
+def cycle_heatmaps(out_df, grid_points=None):
+    """
+    Resamples every cycle onto common grids, giving one row per cycle for heatmaps of the cell ageing.
+
+    The potential of each cycle is interpolated onto a grid of the capacity divided by the maximum
+    capacity of that cycle, and the capacity onto a grid of potentials spanning all cycles. Discharges
+    are read in the direction of falling potential.
+
+    Args:
+    - out_df: a pandas DataFrame containing the data from the battery cycling experiment (wide or long layout),
+      or a clean_data.CyclingResult
+    - grid_points: the number of points of each grid (defaults to HEATMAP_GRID_POINTS)
+
+    Returns:
+    - heatmaps: a dictionary with the cycle numbers ('cycles'), the grids ('capacity_grid', 'potential_grid')
+      and a (cycles x grid) matrix for each direction and grid ('potential_C', 'potential_D', 'capacity_C',
+      'capacity_D'). Rows of cycles without a charge or discharge are NaN.
+    """
+    grid_points = HEATMAP_GRID_POINTS if grid_points is None else grid_points
+    index, _, capacity, potential = cycle_arrays(out_df)
+    cycles = np.unique(index['cycle'].to_numpy())
+    finite = potential[np.isfinite(potential)]
+    heatmaps = {'cycles': cycles,
+                'capacity_grid': np.linspace(0, 1, grid_points),
+                'potential_grid': (np.linspace(finite.min(), finite.max(), grid_points) if len(finite)
+                                   else np.full(grid_points, np.nan))}
+
+    for direction in ('C', 'D'):
+        rows = index[index['direction'] == direction]
+        starts, stops = rows['start'].to_numpy(), rows['stop'].to_numpy()
+        lengths = stops - starts
+        # the samples of the cycles of this direction, one cycle after the other
+        cycle_id = np.repeat(np.searchsorted(cycles, rows['cycle'].to_numpy()), lengths)
+        order = np.argsort(cycle_id, kind='stable')
+        samples = (np.arange(lengths.sum()) +
+                   np.repeat(starts - np.cumsum(lengths) + lengths, lengths))[order]
+        cycle_id = cycle_id[order]
+        cap, pot = capacity[samples], potential[samples]
+
+        max_cap = np.full(len(cycles), np.nan)
+        np.fmax.at(max_cap, cycle_id, cap)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalised = cap / max_cap[cycle_id]
+        heatmaps['potential_' + direction] = resample_cycles(
+            cycle_id, normalised, pot, heatmaps['capacity_grid'], len(cycles))
+
+        if direction == 'C':
+            heatmaps['capacity_C'] = resample_cycles(
+                cycle_id, pot, cap, heatmaps['potential_grid'], len(cycles))
+        else:
+            heatmaps['capacity_D'] = resample_cycles(
+                cycle_id, -pot, cap, -heatmaps['potential_grid'][::-1], len(cycles))[:, ::-1]
+    return heatmaps
+
+
+def plot_cycle_heatmaps(heatmaps, save_dir=None, dpi=None, fmt=None):
+    """
+    Plots the resampled cycles of cycle_heatmaps as four heatmaps (cycle number against the grid) and saves the plot.
+
+    Args:
+    - heatmaps: the dictionary returned by cycle_heatmaps
+    - save_dir: the directory to save the figure in (not saved if None)
+    - dpi: the resolution in dots per inch (defaults to PLOT_DPI)
+    - fmt: the file format, e.g. 'png' or 'svg' (defaults to PLOT_FORMAT)
+    """
+    cycles = heatmaps['cycles']
+    if len(cycles) == 0:
+        logging.warning('No cycles to plot in the cycle heatmaps')
+        return
+    bottom, top = cycles[0] - 0.5, cycles[-1] + 0.5
+    capacity_grid, potential_grid = heatmaps['capacity_grid'], heatmaps['potential_grid']
+    panels = [('potential_C', capacity_grid, "Charge", "Capacity / max. capacity", "Potential / $\mathrm{V}$"),
+              ('potential_D', capacity_grid, "Discharge", "Capacity / max. capacity", "Potential / $\mathrm{V}$"),
+              ('capacity_C', potential_grid, "Charge", "Potential / $\mathrm{V}$",
+               "Capacity / $\mathrm{mAh}$ $\mathrm{g^{-1}}$"),
+              ('capacity_D', potential_grid, "Discharge", "Potential / $\mathrm{V}$",
+               "Capacity / $\mathrm{mAh}$ $\mathrm{g^{-1}}$")]
+
+    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+    for ax, (key, grid, title, xlabel, clabel) in zip(axes.ravel(), panels):
+        image = ax.imshow(heatmaps[key], aspect='auto', origin='lower', interpolation='nearest',
+                          extent=(grid[0], grid[-1], bottom, top))
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel("Cycle number")
+        fig.colorbar(image, ax=ax, label=clabel)
+    plt.tight_layout()
+    if save_dir != None:
+        save_plot(save_dir, "Cycle heatmaps", dpi, fmt)
+
+
+def save_cycle_heatmaps(save_dir, heatmaps):
+    """
+    Saves the resampled cycles of cycle_heatmaps to a compressed numpy file (Cycle_heatmaps.npz), with the
+    matrices in single precision. Load them with numpy.load.
+
+    Args:
+    - save_dir: the directory to save the file in
+    - heatmaps: the dictionary returned by cycle_heatmaps
+    """
+    arrays = {key: value.astype(np.float32) if value.ndim == 2 else value
+              for key, value in heatmaps.items()}
+    path = os.path.join(save_dir, "Cycle_heatmaps.npz")
+    np.savez_compressed(path, **arrays)
+    run_report.add_file(path)
+
+
 def plot_hysteresis(c_capacity, c_potential, d_capacity, d_potential, cycle_no, save_dir=None, charge_first=True):
     """
     Plots the hysteresis of the charge and discharge curves for a given cycle number.
@@ -246,7 +631,7 @@ def plot_hysteresis(c_capacity, c_potential, d_capacity, d_potential, cycle_no,
     plt.tight_layout()
 
     if save_dir is not None:
-        plt.savefig(os.path.join(save_dir, f"Cycle {cycle_no} Hysteresis.png"), dpi=600)
+        save_plot(save_dir, f"Cycle {cycle_no} Hysteresis")
 
         if charge_first:
             hysteresis_df = dict(zip(["Ecell/V (C raw)",
@@ -268,8 +653,9 @@ def plot_hysteresis(c_capacity, c_potential, d_capacity, d_potential, cycle_no,
                                           d_capacity)))
 
         hysteresis_df = pd.DataFrame.from_dict(hysteresis_df, orient="columns")
-        hysteresis_df.to_csv(os.path.join(
-            save_dir, f"Cycle {cycle_no} Hysteresis.csv"), index=True)
+        hysteresis_path = os.path.join(save_dir, f"Cycle {cycle_no} Hysteresis.csv")
+        hysteresis_df.to_csv(hysteresis_path, index=True)
+        run_report.add_file(hysteresis_path)
 
 
 def hysteresis_data_from_frame(cycle_df, cycle_no):
@@ -277,8 +663,9 @@ def hysteresis_data_from_frame(cycle_df, cycle_no):
     Extracts the potential and capacity data for a given cycle number from a DataFrame.
 
     Args:
-        cycle_df (pd.DataFrame): The DataFrame containing the data.
-        cycle_no (int): The cycle number to extract.
+        cycle_df (pd.DataFrame): The DataFrame containing the data (wide or long layout),
+            or a clean_data.CyclingResult.
+        cycle_no (str): The cycle number to extract.
 
     Returns:
         pd.Series: The capacity data for the charge curve.
@@ -289,6 +676,20 @@ def hysteresis_data_from_frame(cycle_df, cycle_no):
     potential_head = "Ecell/V"
     capacity_head = "Capacity/mA.h.g^-1"
 
+    if isinstance(cycle_df, cld.CyclingResult):
+        _, c_capacity, c_potential = cycle_df.charge(int(cycle_no))
+        _, d_capacity, d_potential = cycle_df.discharge(int(cycle_no))
+        return (pd.Series(c_capacity, name=capacity_head), pd.Series(c_potential, name=potential_head),
+                pd.Series(d_capacity, name=capacity_head), pd.Series(d_potential, name=potential_head))
+
+    if cld.is_long_frame(cycle_df):
+        in_cycle = cycle_df['cycle'].to_numpy() == int(cycle_no)
+        is_charge = cycle_df['direction'].to_numpy() == 'C'
+        charge = cycle_df[in_cycle & is_charge].reset_index(drop=True)
+        discharge = cycle_df[in_cycle & ~is_charge].reset_index(drop=True)
+        return (charge[capacity_head], charge[potential_head],
+                discharge[capacity_head], discharge[potential_head])
+
     c_pot_name = potential_head + "(C" + cycle_no + ")"
     c_cap_name = capacity_head + "(C" + cycle_no + ")"
 
@@ -303,7 +704,117 @@ def hysteresis_data_from_frame(cycle_df, cycle_no):
     return c_capacity, c_potential, d_capacity, d_potential
 
 
+def run_cycling(file, active_mass, is_constant=True, do_parquet=False, separate_cycles=False,
+                charge_first=True, layout="wide", incycle_thresh=None, capacity_method=None,
+                cycles_single_file=False, heatmaps=False):
+    """
+    Runs the full analysis of one data file: creates the cycling data frame, optionally saves the
+    individual cycles, and saves the max capacity and cycle summary tables and the capacity, potential and
+    cycle 1 hysteresis plots.
+
+    Args:
+        file (str or list): The name of the input file containing the cycling data, or the names of
+            the parts of a test split over several files, in order (see clean_data.stitch_parts).
+        active_mass (str): The active mass of the electrode material in mg.
+        is_constant (bool, optional): Whether the cycling current is constant. Defaults to True.
+        do_parquet (bool, optional): Whether to save outputs in the Parquet format. Defaults to False.
+        separate_cycles (bool, optional): Whether to save each cycle to a separate file. Defaults to False.
+        charge_first (bool, optional): Whether the first cycle is a charge. Defaults to True.
+        layout (str, optional): "wide" or "long" output layout (see clean_data.create_data_frame). Defaults to "wide".
+        incycle_thresh (float, optional): Current threshold (mA) for variable currents. Defaults to None.
+        capacity_method (str, optional): "trapezoid" or "legacy" capacity calculation
+            (see clean_data.integrate_capacity). Defaults to clean_data.CAPACITY_METHOD.
+        cycles_single_file (bool, optional): Save the separate cycles to one Parquet file with a row group
+            per cycle (see clean_data.save_cycles_dataset). Defaults to False.
+        heatmaps (bool, optional): Save heatmaps of all cycles resampled onto common capacity and potential
+            grids, and the resampled matrices (see cycle_heatmaps). Defaults to False.
+
+    Returns:
+        out_df (pd.DataFrame): The cycling data.
+        save_dir (str): The directory the outputs were saved to.
+        pos_count (int): The number of charge cycles.
+        neg_count (int): The number of discharge cycles.
+    """
+    report_file = cld.stitched_file(file) if isinstance(file, (list, tuple)) else file
+    with run_report.run(report_file, active_mass=active_mass, is_constant=is_constant, do_parquet=do_parquet,
+                        separate_cycles=separate_cycles, layout=layout, incycle_thresh=incycle_thresh,
+                        capacity_method=capacity_method or cld.CAPACITY_METHOD,
+                        parquet_engine=cld.PARQUET_ENGINE if do_parquet else None,
+                        parquet_compression=cld.PARQUET_COMPRESSION if do_parquet else None,
+                        plot_dpi=PLOT_DPI, plot_format=PLOT_FORMAT, heatmaps=heatmaps):
+        (out_df, _, save_dir,
+         pos_count, neg_count, result) = cld.create_data_frame(file,
+                                                               active_mass,
+                                                               is_constant,
+                                                               do_parquet,
+                                                               layout,
+                                                               incycle_thresh,
+                                                               capacity_method,
+                                                               return_result=True)
+
+        if separate_cycles:
+            logging.warning('Saving individual cycles...')
+            with run_report.stage('create_cycles_separate'):
+                cld.create_cycles_separate(out_df, save_dir, do_parquet, cycles_single_file)
+
+        cld.report_progress('Calculating the maximum capacities')
+        with run_report.stage('calculate_max_cap_and_coulombic_eff'):
+            (coulombic_efficiency, max_charge_cap,
+             max_discharge_cap) = calculate_max_cap_and_coulombic_eff(result, pos_count, neg_count)
+            run_report.record(cycles=pos_count)
+
+        cycle_no = get_cycle_no(pos_count)
+
+        # max cap and coulombic efficiency plot
+        logging.warning('Plotting maximum capacity and efficiency...')
+        cld.report_progress('Plotting the maximum capacities')
+        with run_report.stage('plot_max_cap_and_efficiency'):
+            cld.call_in_gui(plot_max_cap_and_efficiency,
+                            cycle_no, max_charge_cap, max_discharge_cap, coulombic_efficiency, save_dir)
+
+        logging.warning('Saving table of max capacities...')
+        with run_report.stage('save_max_cap_csv'):
+            save_max_cap_csv(save_dir, cycle_no, max_charge_cap,
+                             max_discharge_cap, coulombic_efficiency)
+
+        logging.warning('Saving cycle summary...')
+        cld.report_progress('Saving the cycle summary')
+        with run_report.stage('cycle_summary'):
+            save_cycle_summary(save_dir, cycle_summary(result))
+
+        logging.warning('Creating capacity vs potential plot...')
+        cld.report_progress('Plotting capacity vs. potential')
+        with run_report.stage('plot_caps_vs_potentials'):
+            cld.call_in_gui(plot_caps_vs_potentials, result, pos_count, neg_count, save_dir)
+            run_report.record(rows=len(result.time), cycles=pos_count)
+
+        if heatmaps:
+            logging.warning('Creating cycle heatmaps...')
+            cld.report_progress('Plotting the cycle heatmaps')
+            with run_report.stage('cycle_heatmaps'):
+                cycle_maps = cycle_heatmaps(result)
+                cld.call_in_gui(plot_cycle_heatmaps, cycle_maps, save_dir)
+                save_cycle_heatmaps(save_dir, cycle_maps)
+                run_report.record(cycles=len(cycle_maps['cycles']))
+
+        # plot first cycle hysteresis
+        logging.warning('Creating hysteresis plot for cycle 1...')
+        cld.report_progress('Plotting the hysteresis of cycle 1')
+        with run_report.stage('plot_hysteresis'):
+            c_capacity, c_potential, d_capacity, d_potential = hysteresis_data_from_frame(
+                result, str(1))
+            if charge_first is True:
+                logging.warning('Assuming first cycle is charge')
+            else:
+                logging.warning('Assuming first cycle is discharge')
+            cld.call_in_gui(plot_hysteresis, c_capacity, c_potential, d_capacity,
+                            d_potential, str(1), save_dir, charge_first)
+
+    return out_df, save_dir, pos_count, neg_count
+
+
 if __name__ == "__main__":
+    cld.load_config()
     out_df, filename, save_dir, pos_count, neg_count = cld.create_data_frame()
     cld.create_cycles_separate(out_df, save_dir)
 
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Caches of data parsed from files.
+
+SessionCache is an in-process cache, so that a GUI session reads and parses
+each file once. Entries are keyed on the absolute path of the file and a tag
+describing what was loaded from it, and are only returned while the
+modification time and size of the file are unchanged. The least recently used
+entries are evicted when the cache grows beyond its memory cap.
+
+The sidecar is an on-disk cache: the parsed time, potential and current columns
+are saved as raw float64 files in a <name>_CACHE folder next to the data file,
+together with the headings found and a fingerprint of the source file. Later
+reads memory-map these columns instead of parsing the text again.
+"""
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# default memory cap of the session cache (MB)
+SESSION_CACHE_MB: int = 1024
+
+# version of the sidecar layout, bumped when it changes
+SIDECAR_VERSION: int = 1
+# number of bytes hashed at the start and end of a file for its fingerprint
+FINGERPRINT_BYTES: int = 65536
+SIDECAR_COLUMNS = ('time', 'potential', 'current')
+
+
+def file_stamp(path):
+    """
+    Returns the modification time and size of a file, used to detect changes.
+
+    Parameters:
+    path (str): Path of the file.
+
+    Returns:
+    tuple: (modification time in ns, size in bytes)
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _nbytes(value):
+    """Estimates the memory used by a cached value."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=False))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return 64
+
+
+class SessionCache:
+    """LRU cache of values loaded from files, with a cap on the memory used."""
+
+    def __init__(self, max_mb=SESSION_CACHE_MB):
+        """Initialize an empty cache.
+
+        Args:
+            max_mb (float): Memory cap of the cache in MB.
+        """
+        self.max_bytes = int(max_mb * 2**20)
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def get(self, path, tag):
+        """
+        Returns a cached value, or None if it is missing or the file has changed.
+
+        Parameters:
+        path (str): Path of the file the value was loaded from.
+        tag (hashable): What was loaded from the file.
+        """
+        key = (os.path.abspath(path), tag)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stamp, value, nbytes = entry
+        try:
+            current_stamp = file_stamp(path)
+        except OSError:
+            current_stamp = None
+        if current_stamp != stamp:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, path, tag, value):
+        """
+        Stores a value loaded from a file, evicting the least recently used entries if needed.
+
+        Parameters:
+        path (str): Path of the file the value was loaded from.
+        tag (hashable): What was loaded from the file.
+        value (object): The value to store.
+        """
+        key = (os.path.abspath(path), tag)
+        if key in self._entries:
+            self._drop(key)
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (file_stamp(path), value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def load(self, path, tag, loader):
+        """
+        Returns a cached value, calling loader(path) and caching its result on a miss.
+
+        Parameters:
+        path (str): Path of the file to load.
+        tag (hashable): What is loaded from the file.
+        loader (callable): Function loading the value from the path.
+        """
+        value = self.get(path, tag)
+        if value is None:
+            value = loader(path)
+            self.put(path, tag, value)
+        return value
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def _drop(self, key):
+        """Remove one entry."""
+        _, _, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+
+# cache shared by the GUI and the analysis functions
+SESSION_CACHE = SessionCache()
+
+
+def file_fingerprint(path):
+    """
+    Fingerprints a file by its size, modification time and a hash of its first and last bytes.
+
+    Parameters:
+    path (str): Path of the file.
+
+    Returns:
+    dict: The fingerprint.
+    """
+    mtime_ns, size = file_stamp(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        digest.update(fh.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            fh.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            digest.update(fh.read(FINGERPRINT_BYTES))
+    return {'size': size, 'mtime_ns': mtime_ns, 'hash': digest.hexdigest()}
+
+
+def sidecar_dir(file):
+    """
+    Returns the sidecar folder of a data file.
+
+    Parameters:
+    file (str): Path of the data file.
+
+    Returns:
+    str: Path of the sidecar folder.
+    """
+    return os.path.splitext(file)[0] + "_CACHE"
+
+
+class ColumnSpill:
+    """Appends blocks of a column to a raw float64 file and maps it back into memory."""
+
+    def __init__(self, path, n=0):
+        """Open the spill file for writing.
+
+        Args:
+            path (str): Path of the spill file.
+            n (int): Number of values already in the file to keep and append to.
+        """
+        self.path = path
+        self.n = n
+        if n == 0:
+            self._fh = open(path, 'wb')
+            return
+        if os.path.getsize(path) < 8*n:
+            raise OSError(f"{path} holds fewer than {n} values.")
+        self._fh = open(path, 'r+b')
+        self._fh.truncate(8*n)
+        self._fh.seek(8*n)
+
+    def append(self, values):
+        """Append a block of values to the spill file."""
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        values.tofile(self._fh)
+        self.n += len(values)
+
+    def open(self):
+        """Finish writing and return the column as a read-only memory map."""
+        self._fh.close()
+        return map_column(self.path, self.n)
+
+
+def map_column(path, n):
+    """Memory-maps a raw float64 column file with n values."""
+    if n == 0:
+        return np.empty(0)
+    return np.memmap(path, dtype=np.float64, mode='r', shape=(n,))
+
+
+class SidecarWriter:
+    """
+    Writes the parsed time, potential (V) and current (mA) columns of a data file
+    to its sidecar, block by block.
+    """
+
+    def __init__(self, file, headings, folder=None, n_rows=0):
+        """Start a new sidecar, invalidating any existing one.
+
+        Args:
+            file (str): Path of the data file.
+            headings (dict): The 'time', 'potential' and 'current' headings of the file and the
+                'current_scale' converting the current column to mA.
+            folder (str, optional): Folder of the column files. Defaults to the sidecar folder
+                of the file.
+            n_rows (int): Number of rows already in the sidecar to keep and append to.
+        """
+        self.file = file
+        self.headings = headings
+        self.fingerprint = file_fingerprint(file)
+        self.folder = sidecar_dir(file) if folder is None else folder
+        os.makedirs(self.folder, exist_ok=True)
+        meta_file = os.path.join(self.folder, 'meta.json')
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        self.spills = {name: ColumnSpill(os.path.join(self.folder, name + '.bin'), n_rows)
+                       for name in SIDECAR_COLUMNS}
+
+    def append(self, time, potential, current):
+        """Append a block of samples."""
+        self.spills['time'].append(time)
+        self.spills['potential'].append(potential)
+        self.spills['current'].append(current)
+
+    def close(self, complete=True):
+        """
+        Finish the sidecar and return its columns.
+
+        Parameters:
+        complete (bool): Whether all of the data file was written. If not, the sidecar is
+            left without its meta data so that it is not used in place of the file.
+
+        Returns:
+        dict: The 'time', 'potential' and 'current' columns as read-only memory maps.
+        """
+        columns = {name: spill.open() for name, spill in self.spills.items()}
+        if not complete:
+            return columns
+        meta = {'version': SIDECAR_VERSION,
+                'source': os.path.basename(self.file),
+                'fingerprint': self.fingerprint,
+                'n_rows': self.spills['time'].n,
+                'headings': self.headings}
+        with open(os.path.join(self.folder, 'meta.json'), 'w') as fh:
+            json.dump(meta, fh, indent=1)
+        return columns
+
+
+def write_sidecar(file, time, potential, current, headings):
+    """
+    Saves the parsed columns of a data file to its sidecar. Failures are logged and ignored.
+
+    Parameters:
+    file (str): Path of the data file.
+    time, potential, current (array-like): The parsed columns (current in mA).
+    headings (dict): The headings of the columns (see SidecarWriter).
+    """
+    try:
+        writer = SidecarWriter(file, headings)
+        writer.append(time, potential, current)
+        writer.close()
+    except (OSError, ValueError, TypeError) as e:
+        logging.warning(f"Could not save the binary cache of {file}: {e}")
+
+
+def read_sidecar(file):
+    """
+    Memory-maps the sidecar of a data file if it exists and matches the current file.
+
+    Parameters:
+    file (str): Path of the data file.
+
+    Returns:
+    tuple: the 'time', 'potential' and 'current' columns (dict of read-only memory maps) and
+        the headings (dict), or None if there is no valid sidecar.
+    """
+    folder = sidecar_dir(file)
+    try:
+        with open(os.path.join(folder, 'meta.json')) as fh:
+            meta = json.load(fh)
+        if (meta.get('version') != SIDECAR_VERSION or
+                meta['fingerprint'] != file_fingerprint(file)):
+            return None
+        columns = {name: map_column(os.path.join(folder, name + '.bin'), meta['n_rows'])
+                   for name in SIDECAR_COLUMNS}
+    except (OSError, ValueError, KeyError):
+        return None
+    return columns, meta['headings']
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental processing of cycler exports that are still being written to
+during a test ("follow" mode).
+
+Each run of follow_data_frame only parses the lines appended to the file since
+the previous run. The state needed to carry on is saved as a checkpoint in the
+output folder: the byte offset reached, the delimiter of the file, the current
+thresholds, the state of the charge/discharge classifier and of the open
+segments, and the number of cycles and rows written so far. The parsed columns are appended to the sidecar
+of the file (see data_cache), so that earlier samples are still available when
+a cycle spanning two runs is written.
+
+A cycle is only written once both its charge and discharge are closed. The long
+output (see clean_data.LONG_COLUMNS), its offsets index and
+Max_capacities_per_cycle.csv are extended in place.
+
+Runs starting at the first or second sample of the file get no lead sample in
+this mode, since the original wrap-around to the end of the record is not
+defined for a file that is still growing.
+"""
+import os
+import io
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import clean_data as cld
+import cycling_plots as cyc
+import streaming
+from data_cache import SidecarWriter, sidecar_dir, FINGERPRINT_BYTES
+
+# version of the checkpoint layout, bumped when it changes
+CHECKPOINT_VERSION: int = 2
+
+
+def checkpoint_path(save_dir, filename):
+    """Returns the path of the follow-mode checkpoint of a data file."""
+    return os.path.join(save_dir, "%s_follow.json" % os.path.splitext(filename)[0])
+
+
+def _head_hash(file, n_bytes):
+    """Hashes the first n_bytes of a file, to detect a file that was replaced rather than appended to."""
+    with open(file, 'rb') as fh:
+        return hashlib.blake2b(fh.read(n_bytes), digest_size=16).hexdigest()
+
+
+def load_checkpoint(path, file, settings):
+    """
+    Reads the follow-mode checkpoint of a data file, if it can be continued from.
+
+    Parameters:
+    path (str): Path of the checkpoint.
+    file (str): Path of the data file.
+    settings (dict): The settings of the current run, which must match the checkpoint.
+
+    Returns:
+    dict: The checkpoint, or None if processing has to start from the beginning of the file.
+    """
+    try:
+        with open(path) as fh:
+            state = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    try:
+        if state['version'] != CHECKPOINT_VERSION:
+            reason = "it was saved by another version"
+        elif state['settings'] != settings:
+            reason = "the settings have changed"
+        elif (os.path.getsize(file) < state['offset'] or
+              _head_hash(file, state['head_bytes']) != state['head_hash']):
+            reason = "the data file was replaced"
+        elif any(os.path.getsize(os.path.join(sidecar_dir(file), name + '.bin')) <
+                 8*state['n_rows'] for name in ('time', 'potential', 'current')):
+            reason = "the binary cache of the file is incomplete"
+        else:
+            return state
+    except (OSError, KeyError) as e:
+        reason = str(e)
+    logging.warning(f"Processing {file} from the beginning, because {reason}.")
+    return None
+
+
+def save_checkpoint(path, state):
+    """Writes a checkpoint, replacing the previous one only once it is complete."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(state, fh, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _line_blocks(fh, start, end, block_bytes):
+    """Yields the bytes in [start, end) of a file in blocks of whole lines."""
+    fh.seek(start)
+    rest = b''
+    remaining = end - start
+    while remaining > 0:
+        chunk = fh.read(min(block_bytes, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        chunk = rest + chunk
+        cut = chunk.rfind(b'\n') + 1
+        if cut == 0 and remaining > 0:
+            rest = chunk
+            continue
+        rest = chunk[cut:]
+        if cut:
+            yield chunk[:cut]
+    if rest:
+        yield rest
+
+
+def _complete_end(fh, offset):
+    """Returns the offset one past the last complete line of a file, at or after offset."""
+    size = fh.seek(0, os.SEEK_END)
+    pos = size
+    while pos > offset:
+        step = min(FINGERPRINT_BYTES, pos - offset)
+        fh.seek(pos - step)
+        cut = fh.read(step).rfind(b'\n')
+        if cut >= 0:
+            return pos - step + cut + 1
+        pos -= step
+    return offset
+
+
+def final_segments(tracker, final=False):
+    """
+    Builds the segment table of the cycle pairs that can no longer change.
+
+    A run is final once at least two samples follow it, since a run starting
+    right after a one-sample gap takes over its last sample (see
+    clean_data._runs_to_segments).
+
+    Parameters:
+    tracker (streaming.SegmentTracker): The segment tracker.
+    final (bool): Whether the record is complete, so that all runs are final.
+
+    Returns:
+    n_pairs (int): The number of complete charge/discharge pairs.
+    segments (pandas.DataFrame): The segment table of these pairs (see clean_data.get_cycle_segments).
+    """
+    pos_starts, pos_stops, neg_starts, neg_stops = tracker.runs()
+    n_samples = tracker.n_samples
+    if final:
+        n_pairs = min(len(pos_starts), len(neg_starts))
+    else:
+        n_pairs = min(np.count_nonzero(pos_stops + 2 <= n_samples),
+                      np.count_nonzero(neg_stops + 2 <= n_samples))
+
+    columns = {'cycle': [], 'direction': [], 'lead': [], 'start': [], 'stop': []}
+    for direction, starts, stops in (('C', pos_starts, pos_stops), ('D', neg_starts, neg_stops)):
+        leads, stops = cld._runs_to_segments(starts, stops, n_samples)
+        leads[starts < 2] = -1
+        columns['cycle'].append(np.arange(1, n_pairs+1))
+        columns['direction'].append(np.repeat(direction, n_pairs))
+        columns['lead'].append(leads[:n_pairs])
+        columns['start'].append(starts[:n_pairs])
+        columns['stop'].append(stops[:n_pairs])
+    return n_pairs, pd.DataFrame({k: np.concatenate(v) for k, v in columns.items()})
+
+
+def follow_data_frame(file=None, active_mass=None, is_constant=True, do_parquet=False,
+                      max_memory_mb=streaming.STREAM_MEMORY_MB, incycle_thresh=None,
+                      final=False, capacity_method=None):
+    """
+    Processes the lines appended to a cycler export since the previous run and writes the
+    newly completed cycles.
+
+    The first run processes the whole file. Thresholds are fixed at the first run: for
+    constant currents they are found from the data available then, and for variable
+    currents incycle_thresh (or the suggested threshold) is kept for later runs.
+
+    Parameters:
+    file (str): The name of the input file containing the cycling data.
+    active_mass (float): The active mass of the electrode material in mg.
+    is_constant (bool): A boolean indicating whether or not the cycling current is constant.
+    do_parquet (bool): A boolean indicating whether or not to save the output in the Parquet format.
+    max_memory_mb (float): Approximate ceiling on the memory used for processing, in MB.
+    incycle_thresh (float): Threshold for variable currents. If None, it is suggested from the data
+        at the first run (see clean_data.current_thresholds).
+    final (bool): Whether the test has finished, so that the last cycle is written even though
+        no samples follow it.
+    capacity_method (str): How the capacity is calculated (see clean_data.integrate_capacity).
+
+    Returns:
+    out_file (str): The path of the long-layout output file.
+    filename (str): The name of the input file.
+    save_dir (str): The path to the directory where the output file(s) will be saved.
+    pos_count (int): The number of charge cycles written so far.
+    neg_count (int): The number of discharge cycles written so far.
+    """
+    if file is None:
+        file = cld.select_file()
+    active_mass = cld.get_active_mass(active_mass)
+    rows = streaming.rows_per_block(max_memory_mb)
+
+    save_dir = cld.make_save_dir(file)
+    filename = os.path.basename(file)
+    out_file = os.path.join(save_dir, "%s_long.%s" % (os.path.splitext(filename)[0],
+                                                      'parquet' if do_parquet else 'csv'))
+    offsets_file = os.path.join(save_dir, "%s_long_offsets.csv" % os.path.splitext(filename)[0])
+    state_file = checkpoint_path(save_dir, filename)
+    if capacity_method is None:
+        capacity_method = cld.CAPACITY_METHOD
+    settings = {'active_mass': active_mass, 'is_constant': bool(is_constant),
+                'do_parquet': bool(do_parquet), 'capacity_method': capacity_method}
+    state = load_checkpoint(state_file, file, settings)
+
+    with open(file, 'rb') as fh:
+        if state is None:
+            header_line = fh.readline()
+            try:
+                delimiter, header = cld.sniff_header(file)
+            except pd.errors.EmptyDataError as e:
+                logging.error(e)
+                logging.error("No data found in the file.")
+                cld.show_error("No data found in the file.")
+                raise(e)
+            potential_head, time_head, current_head, current_scale = cld.find_headings(header)
+            if None in (potential_head, time_head, current_head):
+                logging.warning("Non-valid column headings! Check if your data has headings and that they are supported.")
+                cld.show_error("Non-valid column headings found!")
+                raise Exception("Non-valid column headings found!")
+            state = {'version': CHECKPOINT_VERSION, 'settings': settings,
+                     'header': header_line.decode('latin-1'), 'delimiter': delimiter,
+                     'headings': {'time': time_head, 'potential': potential_head,
+                                  'current': current_head, 'current_scale': current_scale},
+                     'offset': len(header_line), 'n_rows': 0,
+                     'classifier': None, 'tracker': None,
+                     'n_cycles': 0, 'n_long_rows': 0, 'efficiency': None}
+        start = state['offset']
+        end = _complete_end(fh, start)
+        size = fh.seek(0, os.SEEK_END)
+
+        # parse the appended lines into the sidecar
+        headings = state['headings']
+        header_line = state['header'].encode('latin-1')
+        usecols = [headings['time'], headings['potential'], headings['current']]
+        sidecar = SidecarWriter(file, headings, n_rows=state['n_rows'])
+        try:
+            for lines in _line_blocks(fh, start, end, rows * 64):
+                block = pd.read_csv(io.BytesIO(header_line + lines),
+                                    delimiter=state['delimiter'], usecols=usecols,
+                                    dtype=np.float64)
+                sidecar.append(block[headings['time']].to_numpy(),
+                               block[headings['potential']].to_numpy(),
+                               block[headings['current']].to_numpy() * headings['current_scale'])
+        except ValueError as e:
+            logging.error(e)
+            logging.error('Loaded data is not numeric!')
+            cld.show_error("Non-numeric data found in the file.")
+            raise Exception("Non-numeric data found in the file")
+        finally:
+            columns = sidecar.close(complete=end == size)
+    time, potential, current = columns['time'], columns['potential'], columns['current']
+    n_new = len(current) - state['n_rows']
+    logging.warning(f"Following file: {n_new} new samples after sample {state['n_rows']}.")
+
+    if state['classifier'] is None:
+        if len(current) == 0:
+            logging.warning('No data found yet.')
+            return out_file, filename, save_dir, 0, 0
+        classifier = streaming.stream_thresholds(current, rows, 0.98, is_constant,
+                                                 incycle_thresh)
+        tracker = streaming.SegmentTracker()
+    else:
+        classifier = streaming.CurrentClassifier.from_state(state['classifier'])
+        tracker = streaming.SegmentTracker.from_state(state['tracker'])
+    for s in range(state['n_rows'], len(current), rows):
+        tracker.update(*classifier(current[s:s+rows]))
+
+    # write the cycles completed since the previous run
+    n_pairs, segments = final_segments(tracker, final)
+    new = segments[segments['cycle'] > state['n_cycles']]
+    if len(new):
+        writer = streaming.LongWriter(out_file, do_parquet, rows, append=state['n_cycles'] > 0)
+        try:
+            max_cap = streaming.write_long_cycles(writer, time, potential, current, new,
+                                                  active_mass, rows, capacity_method)
+        finally:
+            writer.close()
+
+        offsets = cld.offsets_from_segments(new)
+        offsets[['start', 'stop']] += state['n_long_rows']
+        offsets.to_csv(offsets_file, index=False, mode='a' if state['n_cycles'] else 'w',
+                       header=not state['n_cycles'])
+
+        max_charge_cap = max_cap[(offsets['direction'] == 'C').to_numpy()]
+        max_discharge_cap = max_cap[(offsets['direction'] == 'D').to_numpy()]
+        if state['efficiency'] is None:
+            state['efficiency'] = ('C/D' if max_discharge_cap[0] > max_charge_cap[0]
+                                   else 'D/C')
+        if state['efficiency'] == 'C/D':
+            coulombic_efficiency = 100*max_charge_cap/max_discharge_cap
+        else:
+            coulombic_efficiency = 100*max_discharge_cap/max_charge_cap
+        cycle_no = np.arange(state['n_cycles'] + 1, n_pairs + 1)
+        cyc.save_max_cap_csv(save_dir, cycle_no, max_charge_cap, max_discharge_cap,
+                             coulombic_efficiency, append=state['n_cycles'] > 0)
+
+        max_caps = pd.read_csv(os.path.join(save_dir, "Max_capacities_per_cycle.csv"))
+        cyc.plot_max_cap_and_efficiency(*(max_caps[col].to_numpy() for col in max_caps.columns),
+                                        save_dir)
+        plt.close()
+        state['n_long_rows'] = int(offsets['stop'].iloc[-1])
+    logging.warning(f"Wrote {len(new) // 2} new cycles ({n_pairs} in total).")
+
+    state.update(offset=end, n_rows=len(current), n_cycles=int(n_pairs),
+                 classifier=classifier.state(), tracker=tracker.state(),
+                 head_bytes=min(end, FINGERPRINT_BYTES),
+                 head_hash=_head_hash(file, min(end, FINGERPRINT_BYTES)))
+    save_checkpoint(state_file, state)
+    return out_file, filename, save_dir, n_pairs, n_pairs
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Interactive previews of long records that stay responsive with tens of millions of samples.
+
+A DecimatedLine draws only the minimum and maximum sample of each pixel column of the
+visible range, which looks the same as drawing every sample, and recomputes them whenever
+the x limits change (zooming or panning). Charge and discharge cycles are shaded with one
+rectangle per cycle rather than per sample.
+"""
+import numpy as np
+from matplotlib.collections import PolyCollection
+from matplotlib.transforms import blended_transform_factory
+
+# number of pixel columns assumed before the axes have been drawn
+PREVIEW_COLUMNS: int = 2000
+
+
+def minmax_decimate(x, y, x_min, x_max, n_columns=PREVIEW_COLUMNS):
+    """
+    Picks the samples needed to draw a line at a given horizontal resolution.
+
+    The range [x_min, x_max] is divided into n_columns columns and the samples with the minimum
+    and maximum y of each column are kept, in their original order, together with the samples
+    just outside the range so that the line runs to the edges of the axes.
+
+    Parameters:
+    x (ndarray): Non-decreasing x values.
+    y (ndarray): y values.
+    x_min, x_max (float): The visible range of x.
+    n_columns (int): The number of pixel columns of the visible range.
+
+    Returns:
+    ndarray: The indices of the kept samples.
+    """
+    first = max(np.searchsorted(x, x_min, 'left') - 1, 0)
+    last = min(np.searchsorted(x, x_max, 'right') + 1, len(x))
+    if last - first <= 4 * n_columns:
+        return np.arange(first, last)
+
+    edges = np.searchsorted(x, np.linspace(x_min, x_max, n_columns + 1), 'left')
+    edges = np.unique(np.clip(edges, first, last))
+    values = y[edges[0]:edges[-1]]
+    counts = np.diff(edges)
+    starts = edges[:-1][counts > 0] - edges[0]
+    counts = counts[counts > 0]
+    column = np.repeat(np.arange(len(starts)), counts)
+
+    kept = [np.array([first, last - 1])]
+    for reduce in (np.fmin, np.fmax):
+        extreme = reduce.reduceat(values, starts)
+        hits = np.flatnonzero(values == extreme[column])
+        _, first_hit = np.unique(column[hits], return_index=True)
+        kept.append(hits[first_hit] + edges[0])
+    return np.unique(np.concatenate(kept))
+
+
+class DecimatedLine:
+    """A line of a long record that is decimated to the resolution of its axes whenever they are zoomed."""
+
+    def __init__(self, ax, x, y, *args, **kwargs):
+        """Draw a line of y against x on an axes.
+
+        Args:
+            ax (matplotlib.axes.Axes): The axes to draw on.
+            x (array-like): The x values, usually the time or the sample number.
+            y (array-like): The y values.
+            *args, **kwargs: The format and properties of the line, as for Axes.plot.
+        """
+        self.ax = ax
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        # searching needs non-decreasing x, which small time resets would break
+        self._search_x = np.fmax.accumulate(np.where(np.isnan(self.x), -np.inf, self.x))
+        x_min, x_max = np.nanmin(self.x), np.nanmax(self.x)
+        kept = minmax_decimate(self._search_x, self.y, x_min, x_max, self._columns())
+        (self.line,) = ax.plot(self.x[kept], self.y[kept], *args, **kwargs)
+        ax.set_xlim(x_min, x_max)
+        # bound methods are only weakly referenced by the callbacks, which would drop the line
+        ax.callbacks.connect('xlim_changed', lambda ax: self.update())
+
+    def _columns(self):
+        """Return the width of the axes in pixels."""
+        width = int(self.ax.bbox.width)
+        return width if width > 0 else PREVIEW_COLUMNS
+
+    def update(self):
+        """Decimate the line again for the visible range of x."""
+        x_min, x_max = sorted(self.ax.get_xlim())
+        kept = minmax_decimate(self._search_x, self.y, x_min, x_max, self._columns())
+        self.line.set_data(self.x[kept], self.y[kept])
+        self.ax.figure.canvas.draw_idle()
+
+
+def shade_cycles(ax, x, starts, stops, color, alpha=0.3, label=None):
+    """
+    Shades the x ranges of cycles over the full height of an axes, with one rectangle per cycle.
+
+    Parameters:
+    ax (matplotlib.axes.Axes): The axes to draw on.
+    x (array-like): The x value of each sample.
+    starts, stops (array-like): The samples [start, stop) of each cycle (see clean_data.get_cycle_segments).
+    color: The color of the rectangles.
+    alpha (float): The opacity of the rectangles.
+    label (str): The legend label.
+
+    Returns:
+    PolyCollection: The rectangles.
+    """
+    x = np.asarray(x, dtype=float)
+    starts, stops = np.asarray(starts, dtype=np.int64), np.asarray(stops, dtype=np.int64)
+    left, right = x[starts], x[np.maximum(stops - 1, starts)]
+    rectangles = np.stack([np.column_stack((left, np.zeros(len(left)))),
+                           np.column_stack((left, np.ones(len(left)))),
+                           np.column_stack((right, np.ones(len(left)))),
+                           np.column_stack((right, np.zeros(len(left))))], axis=1)
+    shading = PolyCollection(rectangles, facecolors=color, edgecolors=color, alpha=alpha,
+                             label=label,
+                             transform=blended_transform_factory(ax.transData, ax.transAxes))
+    ax.add_collection(shading, autolim=False)
+    return shading
+
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the analysis pipeline.
+
+While a run is recorded (see run), every stage of the pipeline wrapped in stage() records
+its wall time, CPU time and the peak resident memory of the process, together with the rows
+and cycles it processed and the bytes it wrote. At the end of the run the stages are saved as
+a JSON report next to the log of the data file (<name>_RUN_REPORT.json):
+
+    with run_report.run(file, layout='long'):
+        with run_report.stage('load_parsed'):
+            potential, time, current = load_parsed(file)
+            run_report.record(rows=len(time))
+
+Outside of a run, stage, record and add_file do nothing, so that the pipeline functions
+can be used on their own. Set ENABLED to False (or 'enabled = false' in the [report]
+section of the config file, see clean_data.load_config) to switch the reports off, and
+TRACE_MEMORY to True ('trace_memory = true') to also measure the peak memory allocated in
+each stage with tracemalloc.
+"""
+import os
+import sys
+import json
+import time as timer
+import logging
+import datetime
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# record and save a report for each run
+ENABLED: bool = True
+# trace the peak memory of each stage with tracemalloc. This makes runs several times slower
+# (plotting allocates many small objects), so it is off unless asked for; the peak resident
+# memory of the process is always recorded, as it costs nothing
+TRACE_MEMORY: bool = False
+
+# the run being recorded and its open stages, innermost last
+_run = None
+_open = []
+
+
+def report_path(file):
+    """
+    Returns the path of the run report of a data file, next to its log file.
+
+    Parameters:
+    file (str): Path of the data file.
+
+    Returns:
+    str: Path of the report.
+    """
+    return os.path.splitext(file)[0] + '_RUN_REPORT.json'
+
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident memory of the process so far, its high-water mark since it
+    started.
+
+    Returns:
+    int: The peak resident set size (peak working set on Windows) in bytes, or None if it
+        cannot be read.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if sys.platform != 'win32':
+        return None
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                'PagefileUsage', 'PeakPagefileUsage')]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    kernel32, psapi = ctypes.windll.kernel32, ctypes.windll.psapi
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters),
+                                           wintypes.DWORD]
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters),
+                                      counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+class Stage:
+    """The measurements of one stage of a run."""
+
+    def __init__(self, name, level):
+        """Start measuring a stage.
+
+        Parameters:
+        name (str): Name of the stage, usually the function it runs.
+        level (int): Number of stages it is nested in.
+        """
+        self.name = name
+        self.level = level
+        self.rows = None
+        self.cycles = None
+        self.bytes_written = 0
+        self.peak_bytes = 0
+        self.peak_rss = None
+        self.status = 'ok'
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self._wall = timer.perf_counter()
+        self._cpu = timer.process_time()
+
+    def stop(self):
+        """Stop measuring the stage."""
+        self.wall_s = timer.perf_counter() - self._wall
+        self.cpu_s = timer.process_time() - self._cpu
+        self.peak_rss = peak_rss_bytes()
+        if tracemalloc.is_tracing():
+            self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1])
+
+    def to_dict(self):
+        """Return the measurements as a dictionary."""
+        return {'stage': self.name,
+                'level': self.level,
+                'status': self.status,
+                'wall_s': round(self.wall_s, 6),
+                'cpu_s': round(self.cpu_s, 6),
+                'peak_memory_mb': (round(self.peak_bytes / 2**20, 3)
+                                   if tracemalloc.is_tracing() else None),
+                'peak_rss_mb': (None if self.peak_rss is None
+                                else round(self.peak_rss / 2**20, 3)),
+                'rows': self.rows,
+                'cycles': self.cycles,
+                'bytes_written': self.bytes_written}
+
+
+@contextmanager
+def run(file, **settings):
+    """
+    Records a run of the pipeline on a data file and saves its report when the run ends,
+    also if it fails. Runs inside a recorded run are part of it.
+
+    Parameters:
+    file (str): Path of the data file.
+    **settings: The settings of the run, saved in the report.
+    """
+    global _run
+    if not ENABLED or _run is not None:
+        yield
+        return
+    started_tracing = TRACE_MEMORY and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _run = {'file': os.path.abspath(file),
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'settings': {key: value if isinstance(value, (bool, int, float, str, type(None)))
+                         else str(value) for key, value in settings.items()},
+            'stages': []}
+    total = Stage('run', -1)
+    _open.append(total)
+    try:
+        yield
+    except BaseException as e:
+        total.status = type(e).__name__
+        raise
+    finally:
+        while _open:
+            _open.pop().stop()
+        report, _run = _run, None
+        report.update(status=total.status,
+                      **{key: value for key, value in total.to_dict().items()
+                         if key not in ('stage', 'level', 'status', 'rows', 'cycles')})
+        report['rows'] = next((s['rows'] for s in report['stages'] if s['rows'] is not None), None)
+        report['cycles'] = next((s['cycles'] for s in report['stages'] if s['cycles'] is not None),
+                                None)
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            with open(report_path(file), 'w') as fh:
+                json.dump(report, fh, indent=2)
+        except OSError as e:
+            logging.warning(f"Could not save the run report: {e}")
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures a stage of the recorded run. Does nothing outside of a run.
+
+    Parameters:
+    name (str): Name of the stage, usually the function it runs.
+    """
+    if _run is None:
+        yield
+        return
+    current = Stage(name, len(_open) - 1)
+    entry = len(_run['stages'])
+    _run['stages'].append(None)
+    _open.append(current)
+    try:
+        yield
+    except BaseException as e:
+        current.status = type(e).__name__
+        raise
+    finally:
+        if _open and _open[-1] is current:
+            _open.pop()
+            current.stop()
+            # the peak of the enclosing stage includes this one (the peak was reset for it)
+            _open[-1].peak_bytes = max(_open[-1].peak_bytes, current.peak_bytes)
+            _open[-1].bytes_written += current.bytes_written
+            _run['stages'][entry] = current.to_dict()
+
+
+def record(rows=None, cycles=None):
+    """
+    Records the number of rows or cycles processed by the current stage.
+
+    Parameters:
+    rows (int): The number of rows (samples).
+    cycles (int): The number of cycles.
+    """
+    if _run is None or len(_open) < 2:
+        return
+    if rows is not None:
+        _open[-1].rows = int(rows)
+    if cycles is not None:
+        _open[-1].cycles = int(cycles)
+
+
+def add_file(path):
+    """
+    Adds the size of a file that was written to the bytes written by the current stage.
+
+    Parameters:
+    path (str): Path of the file.
+    """
+    if _run is None or not os.path.isfile(path):
+        return
+    _open[-1].bytes_written += os.path.getsize(path)
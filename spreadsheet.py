@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Reader of spreadsheet exports (.xlsx) of Neware and Arbin cyclers.
+
+The workbooks hold several sheets (test information, statistics per cycle or step, and the
+record of every sample). The sheets are read with the fastest installed engine (see
+XLSX_ENGINES): calamine parses 1M-row sheets many times faster than openpyxl. Durations
+written as text, such as the "Total Time" of Neware records, are converted to seconds with
+durations_to_seconds.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+# engines of pandas.read_excel in order of preference, with the module each needs
+XLSX_ENGINES = (('calamine', 'python_calamine'), ('openpyxl', 'openpyxl'))
+# parts of the names of sheets that usually hold the record of every sample, tried first
+RECORD_SHEET_HINTS = ('record', 'detail', 'channel', 'data')
+
+
+def is_xlsx_file(file):
+    """
+    Returns whether a file is a spreadsheet, by its extension.
+
+    Parameters:
+    file (str): Path of the file.
+
+    Returns:
+    bool: Whether the file is an .xlsx file.
+    """
+    return os.path.splitext(str(file))[1].lower() in ('.xlsx', '.xlsm')
+
+
+def xlsx_engine():
+    """
+    Returns the first installed engine of XLSX_ENGINES.
+
+    Returns:
+    str: The name of the engine for pandas.read_excel.
+    """
+    for engine, module in XLSX_ENGINES:
+        try:
+            __import__(module)
+            return engine
+        except ImportError:
+            pass
+    raise ImportError("Reading .xlsx files needs python-calamine (pip install python-calamine) "
+                      "or openpyxl.")
+
+
+def open_workbook(file):
+    """
+    Opens a workbook with the fastest installed engine.
+
+    Parameters:
+    file (str): Path of the file.
+
+    Returns:
+    pandas.ExcelFile: The workbook.
+    """
+    return pd.ExcelFile(file, engine=xlsx_engine())
+
+
+def find_sheet(workbook, accept):
+    """
+    Finds the sheet holding the record of every sample: the first sheet whose headings are
+    accepted, trying the sheets named like RECORD_SHEET_HINTS first.
+
+    Parameters:
+    workbook (pandas.ExcelFile): The workbook.
+    accept (callable): Called with the headings of a sheet, returns whether it is the record.
+
+    Returns:
+    str: The name of the sheet.
+    """
+    names = sorted(workbook.sheet_names,
+                   key=lambda name: not any(hint in name.lower() for hint in RECORD_SHEET_HINTS))
+    for name in names:
+        if accept(workbook.parse(name, nrows=0).columns):
+            return name
+    raise ValueError(f"None of the sheets {workbook.sheet_names} has supported column headings.")
+
+
+def durations_to_seconds(values):
+    """
+    Converts durations to seconds. Durations are text of hours, minutes and seconds, with
+    any number of hours and decimals of seconds and optionally a number of days first, e.g.
+    '25:13:04', '2:03:04.250', '1-02:03:04' or '1 day, 02:03:04'. Numbers are taken as seconds
+    and timedeltas are converted. All values are parsed at once from a byte array of the text
+    rather than one by one.
+
+    Parameters:
+    values (array-like): The durations.
+
+    Returns:
+    numpy.ndarray: The durations in seconds, NaN where a value is not a duration.
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.float64)
+    if pd.api.types.is_timedelta64_dtype(values):
+        return values.dt.total_seconds().to_numpy()
+    if len(values) == 0:
+        return np.zeros(0)
+    # timedelta and time objects are written like the text, e.g. '1 day, 2:03:04'
+    text = values.astype(str).str.strip().to_numpy()
+    try:
+        text = text.astype('S')
+    except UnicodeEncodeError:
+        text = np.array([str(value).encode('ascii', 'replace') for value in text])
+    # one row per character position, so that each position is a contiguous array
+    chars = text.view(np.uint8).reshape(len(text), text.dtype.itemsize).T.copy()
+    width = len(chars)
+    position = np.arange(width)[:, None]
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    digits = chars - ord('0')
+    end = (chars != 0).sum(axis=0)
+
+    def last(mask):
+        """The position of the last True of each value, -1 if there is none."""
+        return np.where(mask.any(axis=0), width - 1 - np.argmax(mask[::-1], axis=0), -1)
+
+    def number(mask):
+        """The integer written by the digits in mask of each value, and its number of digits."""
+        value = np.zeros(len(text))
+        for k in range(width):
+            value = np.where(mask[k], value * 10 + digits[k], value)
+        return value, mask.sum(axis=0)
+
+    is_colon = chars == ord(':')
+    second_colon = last(is_colon)
+    first_colon = last(is_colon & (position < second_colon))
+    point = last((chars == ord('.')) & (position > second_colon))
+    point = np.where(point < 0, end, point)
+    hours_start = last(~is_digit & (position < first_colon)) + 1
+
+    days = is_digit & (position < hours_start)
+    hours = (position >= hours_start) & (position < first_colon)
+    minutes = (position > first_colon) & (position < second_colon)
+    whole_seconds = (position > second_colon) & (position < point)
+    fraction = (position > point) & (position < end)
+    valid = ((is_colon.sum(axis=0) == 2) & (first_colon >= 0)
+             & hours.any(axis=0) & minutes.any(axis=0) & whole_seconds.any(axis=0)
+             & ~((hours | minutes | whole_seconds | fraction) & ~is_digit).any(axis=0))
+
+    fraction, decimals = number(fraction)
+    seconds = (number(days)[0] * 86400 + number(hours)[0] * 3600 + number(minutes)[0] * 60
+               + number(whole_seconds)[0] + fraction / 10.0**decimals)
+    return np.where(valid, seconds, np.nan)
@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming, bounded-memory processing of cycler exports that are too large to
+load at once.
+
+The input is parsed once in blocks of rows into binary column files, which are
+kept as the sidecar cache of the file (see data_cache) so that later runs skip
+the parsing. Thresholds and cycle segments are then found block by block, and
+finished cycles are written in blocks to a long output file with one row per
+sample (see clean_data.LONG_COLUMNS) and its offsets index.
+"""
+import os
+import shutil
+import tempfile
+import logging
+import numpy as np
+import pandas as pd
+import clean_data as cld
+from data_cache import SidecarWriter, read_sidecar
+from biologic import is_mpr_file
+
+# default memory ceiling for streaming (MB)
+STREAM_MEMORY_MB: int = 256
+# conservative estimate of the memory used per row of a block while parsing and writing
+STREAM_BYTES_PER_ROW: int = 512
+
+
+def rows_per_block(max_memory_mb=STREAM_MEMORY_MB):
+    """
+    Converts a memory ceiling into the number of rows processed per block.
+
+    Parameters:
+    max_memory_mb (float): The memory ceiling in MB.
+
+    Returns:
+    rows (int): The number of rows per block.
+    """
+    return max(1000, int(max_memory_mb * 2**20 // STREAM_BYTES_PER_ROW))
+
+
+def spill_columns(file, workdir, rows):
+    """
+    Reads the time, potential and current columns of a file in blocks and spills them to disk.
+
+    The columns are spilled to the sidecar of the file if clean_data.USE_SIDECAR is set, and
+    the sidecar is used directly if it is up to date. BioLogic .mpr files are memory-mapped
+    directly instead.
+
+    Parameters:
+    file (str): The name of the input file containing the cycling data.
+    workdir (str): Directory for the spill files when the sidecar is not used.
+    rows (int): The number of rows read per block.
+
+    Returns:
+    time (numpy.memmap): The time data.
+    potential (numpy.memmap): The potential data.
+    current (numpy.memmap): The current data in mA.
+    """
+    if is_mpr_file(file):
+        potential, time, current = cld.parse_mpr(file)
+        return time.to_numpy(), potential.to_numpy(), current.to_numpy()
+
+    sidecar = read_sidecar(file) if cld.USE_SIDECAR else None
+    if sidecar is not None:
+        columns, _ = sidecar
+        if columns['current'].size > 0:
+            return columns['time'], columns['potential'], columns['current']
+
+    try:
+        delimiter, header = cld.sniff_header(file)
+    except pd.errors.EmptyDataError as e:
+        logging.error(e)
+        logging.error("No data found in the file.")
+        cld.show_error("No data found in the file.")
+        raise(e)
+
+    potential_head, time_head, current_head, current_scale = cld.find_headings(header)
+    if None in (potential_head, time_head, current_head):
+        logging.warning("Non-valid column headings! Check if your data has headings and that they are supported.")
+        cld.show_error("Non-valid column headings found!")
+        raise Exception("Non-valid column headings found!")
+
+    headings = {'time': time_head, 'potential': potential_head, 'current': current_head,
+                'current_scale': current_scale}
+    spills = None
+    if cld.USE_SIDECAR:
+        try:
+            spills = SidecarWriter(file, headings)
+        except OSError as e:
+            logging.warning(f"Could not save the binary cache of {file}: {e}")
+    if spills is None:
+        spills = SidecarWriter(file, headings, folder=workdir)
+    reader = pd.read_csv(file, delimiter=delimiter,
+                         usecols=[time_head, potential_head, current_head],
+                         dtype=np.float64, chunksize=rows)
+    try:
+        for block in reader:
+            spills.append(block[time_head].to_numpy(), block[potential_head].to_numpy(),
+                          block[current_head].to_numpy() * current_scale)
+    except ValueError as e:
+        logging.error(e)
+        logging.error('Loaded data is not numeric!')
+        cld.show_error("Non-numeric data found in the file.")
+        raise Exception("Non-numeric data found in the file")
+    finally:
+        reader.close()
+
+    columns = spills.close()
+    time, potential, current = columns['time'], columns['potential'], columns['current']
+    if current.size == 0:
+        logging.warning('Insufficient data found!')
+        cld.show_error("Insufficient data found in the file.")
+        raise Exception("Insufficient data found in the file.")
+    return time, potential, current
+
+
+class CurrentClassifier:
+    """
+    Classifies blocks of current samples as charge or discharge, applying the
+    same thresholds as clean_data.current_thresholds and carrying the state
+    needed across block boundaries.
+    """
+
+    def __init__(self, is_constant, posthresh=None, negthresh=None, incycle_thresh=None):
+        """Initialize the classifier.
+
+        Parameters:
+        is_constant (bool): Whether the cycling current is constant.
+        posthresh (float): Charge threshold (constant current only).
+        negthresh (float): Discharge threshold (constant current only).
+        incycle_thresh (float): Threshold on the change in current (variable current only).
+        """
+        self.is_constant = is_constant
+        self.posthresh = posthresh
+        self.negthresh = negthresh
+        self.incycle_thresh = incycle_thresh
+        self.prev_current = 0.0
+        self.leading = True
+        self.n_removed = 0
+
+    def __call__(self, current):
+        """Return the is_pos and is_neg flags of the next block of current samples."""
+        current = np.asarray(current)
+        if self.is_constant:
+            return current > self.posthresh, current < self.negthresh
+
+        absgrad = np.abs(np.diff(current, prepend=self.prev_current))
+        if len(current):
+            self.prev_current = current[-1]
+        in_cycle = absgrad < self.incycle_thresh
+
+        # remove initial period
+        if self.leading and len(in_cycle):
+            n_lead = np.argmin(in_cycle) if not in_cycle.all() else len(in_cycle)
+            if self.n_removed == 0 and n_lead == 0:
+                self.leading = False
+            else:
+                in_cycle[:n_lead] = False
+                self.n_removed += n_lead
+                self.leading = n_lead == len(in_cycle)
+
+        return in_cycle & (current > 0), in_cycle & (current < 0)
+
+    def state(self):
+        """Return the thresholds and the state carried across blocks as a JSON-serializable dict."""
+        return {'is_constant': bool(self.is_constant),
+                'posthresh': None if self.posthresh is None else float(self.posthresh),
+                'negthresh': None if self.negthresh is None else float(self.negthresh),
+                'incycle_thresh': (None if self.incycle_thresh is None
+                                   else float(self.incycle_thresh)),
+                'prev_current': float(self.prev_current),
+                'leading': bool(self.leading),
+                'n_removed': int(self.n_removed)}
+
+    @classmethod
+    def from_state(cls, state):
+        """Recreate a classifier from the dict returned by state()."""
+        classifier = cls(state['is_constant'], state['posthresh'], state['negthresh'],
+                         state['incycle_thresh'])
+        classifier.prev_current = state['prev_current']
+        classifier.leading = state['leading']
+        classifier.n_removed = state['n_removed']
+        return classifier
+
+
+def stream_thresholds(current, rows, rel_cutoff=0.98, is_constant=True, incycle_thresh=None):
+    """
+    Finds the current thresholds block by block and returns a classifier using them.
+
+    Parameters:
+    current (array-like): An array of current values.
+    rows (int): The number of samples processed per block.
+    rel_cutoff (float): A relative cutoff value for finding the current thresholds.
+    is_constant (bool): A boolean value indicating whether the current is constant or not.
+    incycle_thresh (float): Threshold for variable currents. If None, it is suggested from the data
+        (see clean_data.current_thresholds).
+
+    Returns:
+    classifier (CurrentClassifier): Classifier for blocks of current samples.
+    """
+    if is_constant:
+        cmax, cmin = -np.inf, np.inf
+        for s in range(0, len(current), rows):
+            block = current[s:s+rows]
+            cmax = max(cmax, np.nanmax(block))
+            cmin = min(cmin, np.nanmin(block))
+        posthresh = rel_cutoff * cmax
+        negthresh = rel_cutoff * cmin
+        logging.warning(f"Assuming constant current. Using {rel_cutoff}x max/min of applied current as threshold\n({posthresh} and {negthresh} respectively)")
+        return CurrentClassifier(True, posthresh=posthresh, negthresh=negthresh)
+
+    if incycle_thresh is None:
+        min_step = np.inf
+        prev = 0.0
+        for s in range(0, len(current), rows):
+            block = current[s:s+rows]
+            absgrad = np.abs(np.diff(block, prepend=prev))
+            prev = block[-1]
+            steps = absgrad[absgrad > 0]
+            if steps.size:
+                min_step = min(min_step, steps.min())
+        incycle_thresh = min_step
+        if cld.SHOW_DIALOGS:
+            incycle_thresh = cld.check_min_curr_correct(min_step)
+    logging.warning(f"Assuming variable current.\n Using {incycle_thresh} as threshold.")
+    return CurrentClassifier(False, incycle_thresh=incycle_thresh)
+
+
+class SegmentTracker:
+    """
+    Finds the charge and discharge runs in consecutive blocks of is_pos/is_neg
+    flags, carrying runs that are still open across block boundaries.
+    """
+
+    def __init__(self):
+        """Initialize an empty tracker."""
+        self.n_samples = 0
+        self.open_start = {'C': None, 'D': None}
+        self.starts = {'C': [], 'D': []}
+        self.stops = {'C': [], 'D': []}
+
+    def update(self, is_pos, is_neg):
+        """Add the flags of the next block of samples."""
+        n_block = len(is_pos)
+        if n_block == 0:
+            return
+        for direction, flags in (('C', is_pos), ('D', is_neg)):
+            starts, stops = cld._find_runs(flags)
+            starts, stops = starts + self.n_samples, stops + self.n_samples
+
+            open_start = self.open_start[direction]
+            if open_start is not None:
+                if len(starts) and starts[0] == self.n_samples:
+                    starts[0] = open_start
+                else:
+                    self.starts[direction].append(open_start)
+                    self.stops[direction].append(self.n_samples)
+                self.open_start[direction] = None
+
+            if len(stops) and stops[-1] == self.n_samples + n_block:
+                self.open_start[direction] = int(starts[-1])
+                starts, stops = starts[:-1], stops[:-1]
+
+            self.starts[direction].extend(starts.tolist())
+            self.stops[direction].extend(stops.tolist())
+        self.n_samples += n_block
+
+    def state(self):
+        """Return the runs found so far and the open runs as a JSON-serializable dict."""
+        return {'n_samples': int(self.n_samples),
+                'open_start': {d: None if s is None else int(s)
+                               for d, s in self.open_start.items()},
+                'starts': {d: [int(s) for s in v] for d, v in self.starts.items()},
+                'stops': {d: [int(s) for s in v] for d, v in self.stops.items()}}
+
+    @classmethod
+    def from_state(cls, state):
+        """Recreate a tracker from the dict returned by state()."""
+        tracker = cls()
+        tracker.n_samples = state['n_samples']
+        tracker.open_start = dict(state['open_start'])
+        tracker.starts = {d: list(v) for d, v in state['starts'].items()}
+        tracker.stops = {d: list(v) for d, v in state['stops'].items()}
+        return tracker
+
+    def runs(self):
+        """
+        Return the runs found so far, closing any open run at the last sample.
+
+        Returns:
+        pos_starts, pos_stops, neg_starts, neg_stops (ndarray): Start and stop offsets of the runs.
+        """
+        out = []
+        for direction in ('C', 'D'):
+            starts, stops = list(self.starts[direction]), list(self.stops[direction])
+            if self.open_start[direction] is not None:
+                starts.append(self.open_start[direction])
+                stops.append(self.n_samples)
+            out += [np.array(starts, dtype=np.int64), np.array(stops, dtype=np.int64)]
+        return tuple(out)
+
+
+class LongWriter:
+    """Buffers blocks of long-layout rows and appends them to a CSV or Parquet file."""
+
+    def __init__(self, path, do_parquet=False, rows=100000, append=False):
+        """Open the output file.
+
+        Parameters:
+        path (str): Path of the output file.
+        do_parquet (bool): Whether to write Parquet instead of CSV.
+        rows (int): Number of buffered rows after which the buffer is written.
+        append (bool): Whether to append to an existing output file instead of replacing it.
+        """
+        self.path = path
+        self.do_parquet = do_parquet
+        self.rows = rows
+        self._buffer = []
+        self._n_buffered = 0
+        self._first = not (append and os.path.exists(path) and os.path.getsize(path) > 0)
+        self._fh = None
+        self._pq_writer = None
+        if do_parquet and not self._first and cld.PARQUET_ENGINE == 'pyarrow':
+            raise Exception("Appending to a Parquet file needs the fastparquet engine.")
+        if not do_parquet:
+            self._fh = open(path, 'w' if self._first else 'a', newline='')
+
+    def write(self, frame):
+        """Add a block of rows to the output."""
+        self._buffer.append(frame)
+        self._n_buffered += len(frame)
+        if self._n_buffered >= self.rows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the output file."""
+        if not self._buffer and not self._first:
+            return
+        frame = (pd.concat(self._buffer, ignore_index=True) if self._buffer
+                 else pd.DataFrame(columns=list(cld.LONG_COLUMNS)))
+        self._buffer, self._n_buffered = [], 0
+        if not self.do_parquet:
+            frame.to_csv(self._fh, header=self._first, index=False)
+        elif cld.PARQUET_ENGINE == 'pyarrow':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._pq_writer is None:
+                self._pq_writer = pq.ParquetWriter(self.path, table.schema,
+                                                   **cld.pyarrow_writer_kwargs())
+            self._pq_writer.write_table(table, row_group_size=cld.PARQUET_ROW_GROUP_SIZE)
+        else:
+            frame.to_parquet(self.path, index=False, **cld.parquet_kwargs(frame=frame),
+                             append=not self._first)
+        self._first = False
+
+    def close(self):
+        """Write any buffered rows and close the output file."""
+        self.flush()
+        if self._fh is not None:
+            self._fh.close()
+        if self._pq_writer is not None:
+            self._pq_writer.close()
+
+
+def _segment_blocks(lead, start, stop, rows):
+    """
+    Yields indices covering the samples of one cycle, in record order, in blocks of at most `rows` samples.
+    """
+    first = start
+    if 0 <= lead < start:
+        first = min(stop, start + rows - 1)
+        yield np.r_[lead, start:first]
+    for s in range(first, stop, rows):
+        yield slice(s, min(s + rows, stop))
+    if lead >= stop:
+        yield np.r_[lead]
+
+
+def write_long_cycles(writer, time, potential, current, segments, active_mass, rows,
+                      capacity_method=None):
+    """
+    Writes the samples of every cycle to a long-layout writer, block by block.
+
+    Parameters:
+    writer (LongWriter): The output writer.
+    time (array-like): An array of time values.
+    potential (array-like): An array of potential values.
+    current (array-like): An array of current values.
+    segments (pandas.DataFrame): The segment table from clean_data.get_cycle_segments.
+    active_mass (float): The active mass of the electrode material in grams.
+    rows (int): The maximum number of samples per block.
+    capacity_method (str): How the capacity is calculated (see clean_data.integrate_capacity).
+
+    Returns:
+    max_cap (ndarray): The maximum capacity of each cycle, in the order of the long layout.
+    """
+    if capacity_method is None:
+        capacity_method = cld.CAPACITY_METHOD
+    time_head, capacity_head, potential_head = cld.LONG_COLUMNS[2:]
+    segments = segments.sort_values(['cycle', 'direction'], kind='stable')
+    max_cap = np.full(len(segments), np.nan)
+    for k, (cycle, direction, lead, start, stop) in enumerate(zip(segments['cycle'],
+                                                                  segments['direction'],
+                                                                  segments['lead'],
+                                                                  segments['start'],
+                                                                  segments['stop'])):
+        t0 = time[lead] if 0 <= lead < start else time[start]
+        scale = 3600*active_mass if direction == 'C' else -(3600*active_mass)
+        prev = None
+        for idx in _segment_blocks(lead, start, stop, rows):
+            cyc_time = time[idx] - t0
+            cyc_current = current[idx]
+            if prev is None:
+                charge = cld.integrate_capacity(cyc_time, cyc_current, [0], capacity_method)
+            else:
+                # continue the integral from the last sample of the previous block. A lead
+                # sample that wrapped around from the end of the record adds no charge
+                wrapped = [1] if lead >= stop and not isinstance(idx, slice) else None
+                charge = cld.integrate_capacity(np.r_[prev[0], cyc_time],
+                                                np.r_[prev[1], cyc_current],
+                                                [0], capacity_method, wrapped)[1:]
+                if capacity_method == "trapezoid":
+                    charge += prev[2]
+            prev = (cyc_time[-1], cyc_current[-1], charge[-1])
+            capacity = charge / scale
+            max_cap[k] = np.fmax(max_cap[k], np.nanmax(capacity))
+            block = pd.DataFrame({'cycle': cycle,
+                                  'direction': direction,
+                                  time_head: cyc_time,
+                                  capacity_head: capacity,
+                                  potential_head: potential[idx]})
+            writer.write(block)
+    return max_cap
+
+
+def stream_data_frame(file=None, active_mass=None, is_constant=True, do_parquet=False,
+                      max_memory_mb=STREAM_MEMORY_MB, incycle_thresh=None, capacity_method=None):
+    """
+    Processes an input file in blocks of rows and writes the cycles in the long layout.
+
+    Unlike create_data_frame, neither the raw data nor the cycles are held in memory
+    at once, so files larger than the available memory can be processed. The
+    threshold diagnostic plot is not drawn in this mode.
+
+    A test split over several files is processed as one by passing the list of its files in
+    order: each part is spilled in blocks and appended to one record with a continuous time
+    (see clean_data.stitch_parts), so the memory used stays that of one block.
+
+    Parameters:
+    file (str or list): The name of the input file containing the cycling data, or the names
+        of the parts of a test in order.
+    active_mass (float): The active mass of the electrode material in mg.
+    is_constant (bool): A boolean indicating whether or not the cycling current is constant.
+    do_parquet (bool): A boolean indicating whether or not to save the output in the Parquet format.
+    max_memory_mb (float): Approximate ceiling on the memory used for processing, in MB.
+    incycle_thresh (float): Threshold for variable currents. If None, it is suggested from the data
+        (see clean_data.current_thresholds).
+    capacity_method (str): How the capacity is calculated (see clean_data.integrate_capacity).
+
+    Returns:
+    out_file (str): The path of the long-layout output file.
+    filename (str): The name of the input file (see clean_data.stitched_file for several files).
+    save_dir (str): The path to the directory where the output file(s) will be saved.
+    pos_count (int): The number of positive cycles in the input data.
+    neg_count (int): The number of negative cycles in the input data.
+    """
+    if file is None:
+        file = cld.select_file()
+    parts = None
+    if isinstance(file, (list, tuple)):
+        parts, file = (list(file) if len(file) > 1 else None), cld.stitched_file(file)
+    active_mass = cld.get_active_mass(active_mass)
+    rows = rows_per_block(max_memory_mb)
+    logging.warning(f"Streaming file in blocks of {rows} rows ({max_memory_mb} MB memory limit).")
+
+    save_dir = cld.make_save_dir(file)
+    filename = os.path.basename(file)
+    workdir = tempfile.mkdtemp(prefix='.stream_', dir=save_dir)
+    try:
+        if parts is None:
+            time, potential, current = spill_columns(file, workdir, rows)
+        else:
+            def load_part(part):
+                time, potential, current = spill_columns(part, tempfile.mkdtemp(dir=workdir),
+                                                         rows)
+                return potential, time, current
+            potential, time, current = (column.to_numpy() for column in cld.stitch_parts(
+                parts, os.path.join(workdir, 'stitched'), load_part, rows))
+
+        classifier = stream_thresholds(current, rows, 0.98, is_constant, incycle_thresh)
+        tracker = SegmentTracker()
+        for s in range(0, len(current), rows):
+            tracker.update(*classifier(current[s:s+rows]))
+        if classifier.n_removed:
+            logging.warning(f"removed {classifier.n_removed} points from the beginning")
+
+        pos_count, neg_count, segments = cld.segments_from_runs(*tracker.runs(),
+                                                                tracker.n_samples)
+        logging.warning(f"Assuming {pos_count} charge and {neg_count} discharge cycles.")
+
+        out_file = os.path.join(save_dir, "%s_long.%s" % (os.path.splitext(filename)[0],
+                                                          'parquet' if do_parquet else 'csv'))
+        writer = LongWriter(out_file, do_parquet, rows)
+        try:
+            write_long_cycles(writer, time, potential, current, segments, active_mass, rows,
+                              capacity_method)
+        finally:
+            writer.close()
+        cld.offsets_from_segments(segments).to_csv(
+            os.path.join(save_dir, "%s_long_offsets.csv" % os.path.splitext(filename)[0]), index=False)
+    finally:
+        time = potential = current = None
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return out_file, filename, save_dir, pos_count, neg_count
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup of the tests: the modules of the program and the synthetic cycler exports of
+benchmarks/synthetic_cell.py are importable, plots are drawn without a display and no
+dialogs are shown.
+"""
+import os
+import sys
+import matplotlib
+matplotlib.use('Agg')
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import clean_data as cld
+
+
+@pytest.fixture(autouse=True)
+def headless():
+    """Runs each test without dialogs and with an empty session cache."""
+    cld.SHOW_DIALOGS = False
+    cld.SESSION_CACHE.clear()
+    yield
+    cld.SESSION_CACHE.clear()
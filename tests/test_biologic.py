@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Tests of the reader of BioLogic .mpr files (biologic)."""
+import numpy as np
+import pytest
+import biologic
+import clean_data as cld
+from synthetic_cell import synthetic_cycles, write_export, write_mpr
+
+
+@pytest.fixture
+def columns():
+    """The time, potential and current of a short synthetic test, with the time in whole ms
+    so that the text export holds it exactly."""
+    time, potential, current = synthetic_cycles(n_cycles=5, points_per_cycle=300)
+    return np.round(time, 3), potential, current
+
+
+def data_module_offset(path):
+    """Returns the offset of the body of the data module of an .mpr file."""
+    with open(path, 'rb') as fh:
+        modules = biologic.read_modules(fh.read())
+    return next(m['offset'] for m in modules if m['shortname'] == biologic.DATA_MODULE)
+
+
+@pytest.mark.parametrize('version', sorted(biologic.DATA_OFFSETS))
+def test_mpr_matches_text_export(tmp_path, columns, version):
+    """An .mpr file gives the same cycles as the text export of the same test."""
+    mpr_file = write_mpr(str(tmp_path / 'test.mpr'), *columns, version=version)
+    text_file = write_export(str(tmp_path / 'test.txt'), *columns, headings='ewe')
+
+    mpr_df, filename, _, pos_count, neg_count = cld.create_data_frame(mpr_file, '1', True,
+                                                                      False, 'long')
+    text_df, _, _, text_pos, text_neg = cld.create_data_frame(text_file, '1', True, False,
+                                                             'long')
+    assert filename == 'test.mpr'
+    assert (pos_count, neg_count) == (text_pos, text_neg) == (5, 5)
+    assert mpr_df['cycle'].tolist() == text_df['cycle'].tolist()
+    assert mpr_df['direction'].tolist() == text_df['direction'].tolist()
+    # the potential and current of .mpr files are float32
+    for column in cld.LONG_COLUMNS[2:]:
+        np.testing.assert_allclose(mpr_df[column], text_df[column], rtol=1e-6, atol=1e-6)
+
+
+def test_columns_are_views_of_the_file(tmp_path, columns):
+    """The columns are read without copying them."""
+    records = biologic.read_mpr(write_mpr(str(tmp_path / 'test.mpr'), *columns))
+    assert not records.flags.writeable and not records.flags.owndata
+    np.testing.assert_array_equal(records['time/s'], columns[0])
+
+
+def test_wrong_magic(tmp_path):
+    """A file that does not start with the magic string is rejected."""
+    path = tmp_path / 'test.mpr'
+    path.write_bytes(b'EC-Lab ASCII FILE\n' + bytes(200))
+    with pytest.raises(ValueError, match="Not a BioLogic .mpr file"):
+        biologic.read_mpr(str(path))
+    with pytest.raises(ValueError):
+        cld.parse_mpr(str(path))
+
+
+def test_unknown_column(tmp_path, columns):
+    """A column type ID that is not in COLUMN_TYPES or FLAG_COLUMNS is rejected."""
+    path = write_mpr(str(tmp_path / 'test.mpr'), *columns)
+    offset = data_module_offset(path)
+    with open(path, 'r+b') as fh:
+        fh.seek(offset + 5)
+        fh.write(np.uint16(999).tobytes())
+    with pytest.raises(ValueError, match="Unsupported column type 999"):
+        biologic.read_mpr(path)
+
+
+def test_unsupported_version(tmp_path, columns, monkeypatch):
+    """A data module of a version without a known record offset is rejected."""
+    monkeypatch.setitem(biologic.DATA_OFFSETS, 9, 500)
+    path = write_mpr(str(tmp_path / 'test.mpr'), *columns, version=9)
+    monkeypatch.delitem(biologic.DATA_OFFSETS, 9)
+    with pytest.raises(ValueError, match="Unsupported version 9"):
+        biologic.read_mpr(path)
+
+
+def test_truncated_data_module(tmp_path, columns):
+    """A data module shorter than its records is rejected."""
+    path = write_mpr(str(tmp_path / 'test.mpr'), *columns)
+    offset = data_module_offset(path)
+    with open(path, 'r+b') as fh:
+        # one point more than the records written
+        fh.seek(offset)
+        fh.write(np.uint32(len(columns[0]) + 1).tobytes())
+    with pytest.raises(ValueError, match="shorter than its records"):
+        biologic.read_mpr(path)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Tests of the capacity calculation (clean_data.integrate_capacity and its callers)."""
+import numpy as np
+import pandas as pd
+import clean_data as cld
+import streaming
+
+
+def record_starting_in_charge():
+    """Two cycles sampled every second, with the first charge starting at sample 0."""
+    run = np.ones(50)
+    rest = np.zeros(10)
+    current = np.concatenate((run, rest, -run, rest, run, rest, -run, rest))
+    time = np.arange(len(current), dtype=np.float64)
+    potential = 3.5 + 0.001 * time
+    return time, potential, current
+
+
+def test_wrapped_lead_adds_no_charge(tmp_path):
+    """The lead sample of a run at sample 0 wraps to the end of the record but adds no charge."""
+    time, potential, current = record_starting_in_charge()
+    pos_count, neg_count, segments = cld.get_cycle_segments(current > 0.5, current < -0.5)
+    assert (pos_count, neg_count) == (2, 2)
+    charge = segments[(segments['cycle'] == 1) & (segments['direction'] == 'C')].iloc[0]
+    assert charge['start'] == 0 and charge['lead'] >= charge['stop']
+
+    # 1 mA over 1 g for 49 s, plus 1 mA.s from the lead sample at rest 2 s before the
+    # other runs
+    expected_charge = np.array([49, 50]) / 3600
+    expected_discharge = np.array([50, 50]) / 3600
+    result = cld.cycles_to_result(time, potential, current, segments, 1.0, "trapezoid")
+    np.testing.assert_allclose(result.max_capacity('C'), expected_charge)
+    np.testing.assert_allclose(result.max_capacity('D'), expected_discharge)
+    _, capacity, _ = result.charge(1)
+    assert capacity[-1] == capacity[-2]
+
+    out_df = cld.cycles_to_frame(time, potential, current, segments, 1.0, "trapezoid")
+    np.testing.assert_allclose(out_df['Capacity/mA.h.g^-1(C1)'].max(), expected_charge[0])
+
+    # the streaming writer integrates block by block, with the wrapped lead in its own block
+    out_file = str(tmp_path / 'long.csv')
+    writer = streaming.LongWriter(out_file, rows=7)
+    max_cap = streaming.write_long_cycles(writer, time, potential, current, segments, 1.0,
+                                          rows=7, capacity_method="trapezoid")
+    writer.close()
+    np.testing.assert_allclose(max_cap, np.column_stack((expected_charge,
+                                                         expected_discharge)).ravel())
+    np.testing.assert_allclose(pd.read_csv(out_file)['Capacity/mA.h.g^-1'],
+                               result.capacity, rtol=1e-9)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Tests of random access to single cycles (cycle_store.CycleStore)."""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import clean_data as cld
+from cycle_store import CycleStore
+from synthetic_cell import make_export
+
+N_CYCLES = 12
+
+
+@pytest.fixture(scope='module')
+def export(tmp_path_factory):
+    """A synthetic export and the single cycles file of its long output (save_cycles_dataset)."""
+    cld.SHOW_DIALOGS = False
+    folder = tmp_path_factory.mktemp('store')
+    file = make_export(str(folder / 'test.txt'), 300 * N_CYCLES, points_per_cycle=300)
+    out_df, _, save_dir, pos_count, _ = cld.create_data_frame(file, '1', True, True, 'long')
+    assert pos_count == N_CYCLES
+    cld.save_cycles_dataset(out_df, save_dir)
+    return file, save_dir, os.path.join(save_dir, cld.CYCLES_DATASET)
+
+
+def open_store(export, source):
+    """Writes the output of a layout and format, and opens it."""
+    file, save_dir, dataset = export
+    if source == 'dataset':
+        return CycleStore(dataset)
+    if source == 'data file':
+        return CycleStore.from_data_file(file, '1')
+    layout, ext = source.split()
+    cld.create_data_frame(file, '1', True, ext == 'parquet', layout)
+    suffix = '_long' if layout == 'long' else ''
+    return CycleStore(os.path.join(save_dir, f"test{suffix}.{ext}"))
+
+
+@pytest.mark.parametrize('source', ['long csv', 'long parquet', 'wide csv', 'wide parquet',
+                                    'dataset', 'data file'])
+def test_random_access(export, source):
+    """Cycles fetched in any order are those read_cycle reads from the single cycles file."""
+    store = open_store(export, source)
+    dataset = export[2]
+    assert len(store) == N_CYCLES
+    assert list(store.cycles) == list(range(1, N_CYCLES + 1))
+
+    for cycle in np.random.default_rng(0).permutation(np.arange(1, N_CYCLES + 1)):
+        expected = cld.read_cycle(dataset, cycle)
+        pd.testing.assert_frame_equal(store[cycle], expected, check_dtype=False,
+                                      check_categorical=False, rtol=1e-12)
+        charge = expected[expected['direction'] == 'C'].reset_index(drop=True)
+        pd.testing.assert_frame_equal(store.charge(cycle), charge, check_dtype=False,
+                                      check_categorical=False, rtol=1e-12)
+
+    assert N_CYCLES + 1 not in store
+    with pytest.raises(KeyError):
+        store[N_CYCLES + 1]
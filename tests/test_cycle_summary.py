@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Tests of the summary statistics of each cycle (cycling_plots.cycle_summary)."""
+import numpy as np
+import pandas as pd
+import clean_data as cld
+import cycling_plots as cyc
+
+
+def long_frame(potentials):
+    """A long-layout frame with the given potentials of each (cycle, direction)."""
+    time_head, capacity_head, potential_head = cld.LONG_COLUMNS[2:]
+    return pd.concat([pd.DataFrame({'cycle': cycle, 'direction': direction,
+                                    time_head: np.arange(len(values), dtype=float),
+                                    capacity_head: np.arange(len(values), dtype=float),
+                                    potential_head: values})
+                      for (cycle, direction), values in potentials.items()],
+                     ignore_index=True)
+
+
+def test_median_ignores_nan():
+    """A NaN potential is left out of the median of its cycle, as in np.nanmedian."""
+    potentials = {(1, 'C'): [3.0, 3.1, np.nan, 3.4, 4.0, 4.2],
+                  (1, 'D'): [4.1, 3.9, 3.6, 3.2, 3.0],
+                  (2, 'C'): [3.2, 3.3, 3.5, 3.9],
+                  (2, 'D'): [4.0, np.nan, 3.5]}
+    summary = cyc.cycle_summary(long_frame(potentials))
+    expected = [np.nanmedian(values) for values in potentials.values()]
+    np.testing.assert_allclose(summary['Median Potential V'], expected, rtol=1e-15)
+
+
+def test_median_of_cycle_without_potentials():
+    """The median of a cycle whose potentials are all NaN is NaN."""
+    summary = cyc.cycle_summary(long_frame({(1, 'C'): [np.nan, np.nan],
+                                            (1, 'D'): [4.0, 3.0]}))
+    np.testing.assert_equal(summary['Median Potential V'].to_numpy(), [np.nan, 3.5])
+
+
+def test_mean_ignores_nan():
+    """A NaN potential is left out of the mean of its cycle, as in np.nanmean."""
+    potentials = {(1, 'C'): [3.0, 3.1, np.nan, 3.4, 4.0, 4.2],
+                  (1, 'D'): [4.1, 3.9, 3.6, 3.2, 3.0],
+                  (2, 'C'): [np.nan, np.nan]}
+    summary = cyc.cycle_summary(long_frame(potentials))
+    np.testing.assert_allclose(summary['Mean Potential V'].to_numpy(),
+                               [np.nanmean(potentials[1, 'C']), np.mean(potentials[1, 'D']),
+                                np.nan], rtol=1e-15)
+
+
+def test_wrapped_lead_cycle():
+    """A charge starting at sample 0 ends at its last sample, before the wrapped lead sample."""
+    run = np.ones(50)
+    rest = np.zeros(10)
+    current = np.concatenate((run, rest, -run, rest, run, rest, -run, rest))
+    time = np.arange(len(current), dtype=np.float64)
+    potential = 3.5 + 0.001 * time
+    _, _, segments = cld.get_cycle_segments(current > 0.5, current < -0.5)
+    result = cld.cycles_to_result(time, potential, current, segments, 1.0, "trapezoid")
+    assert len(result.wrapped) == 1
+
+    charge = cyc.cycle_summary(result).iloc[0]
+    assert (charge['Cycle Number'], charge['Direction']) == (1, 'C')
+    assert charge['Duration s'] == 49
+    assert charge['Start Potential V'] == potential[0]
+    assert charge['End Potential V'] == potential[49]
+    assert charge['Mean Potential V'] == np.mean(potential[:50])
+    assert charge['Median Potential V'] == np.median(potential[:50])
+    assert charge['Max Capacity mA.h.g^-1'] == result.max_capacity('C')[0]
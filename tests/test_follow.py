@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Tests of follow mode (follow.follow_data_frame)."""
+import os
+import json
+import pandas as pd
+import follow
+from synthetic_cell import synthetic_cycles, write_export
+
+
+def test_follow_comma_separated(tmp_path):
+    """A comma-separated export is followed across two runs like a tab-separated one."""
+    time, potential, current = synthetic_cycles(n_cycles=6, points_per_cycle=200)
+    tab_file = write_export(str(tmp_path / 'tab.txt'), time, potential, current)
+    comma_file = str(tmp_path / 'comma.txt')
+
+    # the test is still running at the first run: only part of the export is written
+    n_first = len(time) // 2
+    write_export(comma_file, time[:n_first], potential[:n_first], current[:n_first],
+                 delimiter=',')
+    follow.follow_data_frame(comma_file, '1')
+    checkpoint = follow.checkpoint_path(str(tmp_path / 'comma_OUTPUTS'), 'comma.txt')
+    with open(checkpoint) as fh:
+        assert json.load(fh)['delimiter'] == ','
+
+    write_export(comma_file, time, potential, current, delimiter=',')
+    out_file, _, _, pos_count, _ = follow.follow_data_frame(comma_file, '1', final=True)
+    ref_file, _, _, ref_count, _ = follow.follow_data_frame(tab_file, '1', final=True)
+
+    assert pos_count == ref_count == 6
+    assert os.path.basename(out_file) == 'comma_long.csv'
+    pd.testing.assert_frame_equal(pd.read_csv(out_file), pd.read_csv(ref_file))
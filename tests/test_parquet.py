@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Tests of the Parquet outputs with every engine, codec and compression level."""
+import os
+import pytest
+import pandas as pd
+import clean_data as cld
+import streaming
+from synthetic_cell import make_export
+
+
+@pytest.fixture
+def parquet_options():
+    """Restores the Parquet settings after a test."""
+    saved = (cld.PARQUET_ENGINE, cld.PARQUET_COMPRESSION, cld.PARQUET_COMPRESSION_LEVEL,
+             cld.PARQUET_ROW_GROUP_SIZE)
+    yield cld.set_parquet_options
+    cld.set_parquet_options(*saved)
+
+
+@pytest.mark.parametrize('level', [None, 3])
+@pytest.mark.parametrize('codec', cld.PARQUET_CODECS)
+@pytest.mark.parametrize('engine', cld.PARQUET_ENGINES)
+def test_write_parquet(tmp_path, parquet_options, engine, codec, level):
+    """Every output in the long layout can be written and read back with each setting."""
+    file = make_export(str(tmp_path / 'test.txt'), 2000, points_per_cycle=200)
+    parquet_options(engine, codec, compression_level=level)
+
+    out_df, _, save_dir, pos_count, _ = cld.create_data_frame(file, '1', True, True, 'long')
+    written = pd.read_parquet(os.path.join(save_dir, 'test_long.parquet'))
+    pd.testing.assert_frame_equal(written, out_df, check_dtype=False, check_categorical=False)
+
+    cld.save_cycles_dataset(out_df, save_dir)
+    cycle = cld.read_cycle(os.path.join(save_dir, cld.CYCLES_DATASET), pos_count)
+    assert len(cycle) == len(out_df[out_df['cycle'] == pos_count])
+
+    cld.create_cycles_separate(out_df, save_dir, do_parquet=True)
+    assert os.path.exists(os.path.join(save_dir, 'Individual Cycles', 'Cycle_1.parquet'))
+
+    out_file = streaming.stream_data_frame(file, '1', True, True, max_memory_mb=1)[0]
+    streamed = pd.read_parquet(out_file)
+    pd.testing.assert_frame_equal(streamed, out_df, check_dtype=False, check_categorical=False)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Tests of the cycling data as a CyclingResult and of the frames made from it."""
+import numpy as np
+import pandas as pd
+import clean_data as cld
+from synthetic_cell import make_export
+
+
+def test_wide_frame_from_result(tmp_path):
+    """The wide frame of create_data_frame holds the samples of the result it returns."""
+    file = make_export(str(tmp_path / 'test.txt'), 5000, points_per_cycle=250)
+    out_df, _, _, pos_count, _, result = cld.create_data_frame(file, '1', True, False, 'wide',
+                                                               return_result=True)
+    assert pos_count == result.pos_count == 20
+    assert list(out_df.columns[:3]) == ['Elapsed_time/s(C1)', 'Capacity/mA.h.g^-1(C1)',
+                                        'Ecell/V(C1)']
+    assert out_df.columns[3*pos_count] == 'Elapsed_time/s(D1)'
+
+    from_frame = cld.CyclingResult.from_frame(out_df)
+    for cycle in (1, 7, pos_count):
+        for fetch in ('charge', 'discharge'):
+            for expected, value in zip(getattr(result, fetch)(cycle),
+                                       getattr(from_frame, fetch)(cycle)):
+                np.testing.assert_array_equal(value, expected)
+
+    pd.testing.assert_frame_equal(result.to_wide_frame(), out_df)
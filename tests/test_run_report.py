@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""Tests of the run reports (run_report)."""
+import json
+import numpy as np
+import run_report
+
+
+def test_report_records_peak_rss(tmp_path):
+    """The peak resident memory is recorded without tracing the allocations."""
+    file = str(tmp_path / 'test.txt')
+    with run_report.run(file):
+        with run_report.stage('allocate'):
+            buffer = np.ones(2**23)
+            run_report.record(rows=len(buffer))
+    with open(run_report.report_path(file)) as fh:
+        report = json.load(fh)
+
+    stage = report['stages'][0]
+    assert stage['stage'] == 'allocate' and stage['rows'] == 2**23
+    assert stage['peak_memory_mb'] is None
+    assert stage['peak_rss_mb'] >= 64
+    assert report['peak_rss_mb'] >= stage['peak_rss_mb']
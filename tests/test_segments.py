@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the cycle segmentation (clean_data.get_cycle_segments and get_cycle_counts) against
+the per-sample loop it replaced (benchmarks/bench_cycle_counts.loop_cycle_counts).
+"""
+import numpy as np
+import pytest
+import clean_data as cld
+from bench_cycle_counts import loop_cycle_counts, square_wave_current, check_equal
+from synthetic_cell import make_export
+
+
+def check_segments(is_pos, is_neg):
+    """The segment table labels the same samples of each cycle as the loop."""
+    time = np.arange(len(is_pos), dtype=np.float64)
+    reference = loop_cycle_counts(time, is_pos, is_neg)
+    check_equal(reference, cld.get_cycle_counts(time, is_pos, is_neg))
+
+    pos_count, _, segments = cld.get_cycle_segments(is_pos, is_neg)
+    idx, first, lengths = cld.segment_sample_indices(segments)
+    labels = {'C': reference[2], 'D': reference[3]}
+    for (cycle, direction), at, length in zip(zip(segments['cycle'], segments['direction']),
+                                              first, lengths):
+        expected = np.flatnonzero(labels[direction] == cycle)
+        np.testing.assert_array_equal(np.sort(idx[at:at + length]), expected)
+    return pos_count, segments
+
+
+@pytest.mark.parametrize('current', ['constant', 'stepped'])
+def test_synthetic_export(tmp_path, current):
+    """The cycles of a synthetic export are those of the loop."""
+    file = make_export(str(tmp_path / 'test.txt'), 20_000, points_per_cycle=400,
+                       current=current)
+    _, _, parsed_current = cld.parse_data(cld.read_data_file(file))
+    is_constant = current == 'constant'
+    thresh = None if is_constant else cld.get_incycle_thresh(parsed_current)
+    is_pos, is_neg = cld.current_thresholds(parsed_current, 0.98, is_constant, thresh)
+    pos_count, _ = check_segments(is_pos, is_neg)
+    assert pos_count == 50
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_square_wave(seed):
+    """Charges and discharges of jittered length with rests of one to three samples."""
+    current = square_wave_current(20_000, points_per_cycle=200, seed=seed)
+    check_segments(current > 0.98, current < -0.98)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pulses(seed):
+    """
+    Pulses of random sign and length with rests of one to three samples: the lead of a pulse
+    can be the last sample of the previous pulse in the same direction.
+    """
+    rng = np.random.default_rng(seed)
+    steps = [np.concatenate((np.full(rng.integers(2, 20), rng.choice([-1.0, 1.0])),
+                             np.zeros(rng.integers(1, 4))))
+             for _ in range(500)]
+    current = np.concatenate(steps)
+    check_segments(current > 0.5, current < -0.5)
+
+
+@pytest.mark.parametrize('offset', [0, 1])
+@pytest.mark.parametrize('first_sign', [1, -1])
+@pytest.mark.parametrize('end_in_run', [False, True])
+def test_run_at_first_samples(offset, first_sign, end_in_run):
+    """
+    A run starting at sample 0 or 1 has its lead sample (i-2) at the end of the record, or
+    none if that sample is in a run.
+    """
+    run = np.ones(30)
+    rest = np.zeros(5)
+    current = np.concatenate((np.zeros(offset), run, rest, -run, rest, run, rest, -run, rest))
+    if end_in_run:
+        current = np.concatenate((current, run))
+    current *= first_sign
+    _, segments = check_segments(current > 0.5, current < -0.5)
+    first = segments.iloc[np.argmin(segments['start'].to_numpy())]
+    if end_in_run:
+        assert first['lead'] == -1
+    else:
+        assert first['lead'] == len(current) - 2 + offset
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Tests of the analysis of a test split over several files (clean_data.stitch_parts)."""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import clean_data as cld
+import streaming
+from synthetic_cell import synthetic_cycles, write_export
+
+POINTS_PER_CYCLE = 200
+
+
+def split_export(folder, restart):
+    """
+    Writes a synthetic test as one file and as three parts, split inside a charge and inside
+    a rest. With restart set, the time of each part starts at zero as when a cycler resumes
+    a test in a new file. Without capacity fade the sampling intervals are whole seconds, so
+    the exported times are exact in every part.
+    """
+    time, potential, current = synthetic_cycles(n_cycles=10, points_per_cycle=POINTS_PER_CYCLE,
+                                                capacity_fade=0)
+    single = write_export(str(folder / 'test.txt'), time, potential, current)
+    bounds = [0, 2*POINTS_PER_CYCLE + 50, 6*POINTS_PER_CYCLE + 105, len(time)]
+    parts = []
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        part_time = time[start:stop] - (time[start] if restart else 0)
+        parts.append(write_export(str(folder / f"test_{i + 1:02d}.txt"), part_time,
+                                  potential[start:stop], current[start:stop]))
+    return single, parts
+
+
+def long_offsets(file):
+    """Reads the offsets index saved next to the long output of a file."""
+    stem = os.path.splitext(os.path.basename(file))[0]
+    return pd.read_csv(os.path.join(cld.make_save_dir(file), f"{stem}_long_offsets.csv"))
+
+
+@pytest.mark.parametrize('restart', [True, False])
+def test_stitched_parts_match_single_file(tmp_path, restart):
+    """The cycles, offsets and samples of the stitched parts are those of the single file."""
+    single, parts = split_export(tmp_path, restart)
+    assert cld.stitched_file(parts) == str(tmp_path / 'test_stitched.txt')
+
+    ref_df, _, _, ref_count, _ = cld.create_data_frame(single, '1', True, False, 'long')
+    out_df, filename, _, pos_count, _ = cld.create_data_frame(parts, '1', True, False, 'long')
+    assert filename == 'test_stitched.txt'
+    assert pos_count == ref_count == 10
+    pd.testing.assert_frame_equal(long_offsets(cld.stitched_file(parts)), long_offsets(single))
+    pd.testing.assert_frame_equal(out_df, ref_df, check_exact=True)
+    assert not [name for name in os.listdir(cld.make_save_dir(cld.stitched_file(parts)))
+                if name.startswith('.stitch_')]
+
+    # the streaming mode stitches the parts block by block
+    ref_file = streaming.stream_data_frame(single, '1', True, False, max_memory_mb=1)[0]
+    out_file = streaming.stream_data_frame(parts, '1', True, False, max_memory_mb=1)[0]
+    assert os.path.basename(out_file) == 'test_stitched_long.csv'
+    pd.testing.assert_frame_equal(pd.read_csv(out_file), pd.read_csv(ref_file),
+                                  check_exact=True)
+
+
+def test_part_time_offset():
+    """A part restarting at zero continues one sampling interval after the previous part."""
+    assert cld.part_time_offset(100.0, 2.0, 0.0) == 102.0
+    assert cld.part_time_offset(100.0, 2.0, 102.0) == 0.0
+    assert cld.part_time_offset(-np.inf, 0.0, 5.0) == 0.0